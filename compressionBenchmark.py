@@ -0,0 +1,69 @@
+from sheets import *
+from sheets.compression import CODECS, compressed_text
+from sheets.utils import *
+import io
+import json
+import sys
+import time
+
+def create_square_workbook_json(N: int):
+    # Like the workbook of performanceAnalysis.py: every cell of the top row
+    # and the left column is 1, and every other cell is the sum of the cells
+    # above it and to its left.
+    cell_contents = {}
+    for i in range(1, N + 1):
+        cell_contents[coordinates_to_location((1, i))] = "1"
+        cell_contents[coordinates_to_location((i, 1))] = "1"
+    for i in range(2, N + 1):
+        for j in range(2, N + 1):
+            top = coordinates_to_location((i, j - 1))
+            left = coordinates_to_location((i - 1, j))
+            cell_contents[coordinates_to_location((i, j))] = f'={top}+{left}'
+
+    s = json.dumps({
+        "sheets": [{
+            "name": "Sheet1",
+            "cell-contents": cell_contents
+        }]
+    })
+    return io.StringIO(s)
+
+def timed(f):
+    start = time.perf_counter()
+    result = f()
+    return (result, time.perf_counter() - start)
+
+def benchmark_codecs(w: Workbook):
+    # For each codec, report the size of the saved workbook, the time to save
+    # it, the time to only decompress it, and the time to load it (which
+    # includes parsing every formula, the same for every codec).
+    text = io.StringIO()
+    (_, save_time) = timed(lambda: w.save_workbook(text, sort_cells=True))
+    raw = len(text.getvalue().encode('utf-8'))
+    (_, load_time) = timed(lambda: Workbook.load_workbook(io.StringIO(text.getvalue())))
+    print(f'{"codec":6} {"bytes":>10} {"ratio":>6} {"save s":>8} {"MB/s":>7} '
+          f'{"inflate s":>9} {"MB/s":>7} {"load s":>7}')
+    print(f'{"none":6} {raw:>10} {1:>6.1f} {save_time:>8.3f} {raw / save_time / 1e6:>7.1f} '
+          f'{0:>9.3f} {"-":>7} {load_time:>7.3f}')
+
+    for codec in CODECS:
+        fp = io.BytesIO()
+        (_, save_time) = timed(lambda: w.save_compressed(fp, codec))
+        size = len(fp.getvalue())
+
+        def inflate():
+            with compressed_text(io.BytesIO(fp.getvalue()), 'r') as t:
+                while t.read(1 << 16):
+                    pass
+        (_, inflate_time) = timed(inflate)
+        (_, load_time) = timed(lambda: Workbook.load_compressed(io.BytesIO(fp.getvalue())))
+        print(f'{codec:6} {size:>10} {raw / size:>6.1f} {save_time:>8.3f} '
+              f'{raw / save_time / 1e6:>7.1f} {inflate_time:>9.3f} '
+              f'{raw / inflate_time / 1e6:>7.1f} {load_time:>7.3f}')
+
+
+if __name__ == '__main__':
+    N = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    (w, load_time) = timed(lambda: Workbook.load_workbook(create_square_workbook_json(N)))
+    print(f'{N}x{N} square workbook, built in {load_time:.1f} s')
+    benchmark_codecs(w)
@@ -1,35 +1,231 @@
 
-from copy import deepcopy
-from typing import Callable, Optional, Any, Set, Tuple, Union
+from typing import Callable, Dict, Hashable, List, Optional, Any, Set, Tuple, Union
 import decimal
+import functools
+import operator
 from lark import LarkError
 import lark
 from lark.visitors import Interpreter, Visitor
-from sheets.function import FunctionRegistry
 from sheets.sheet_range import Contents
+from sheets.cell_range import CellRange, range_location
 
 
 from .utils import absolute_location_to_location, cell_value_type, convert_to_decimal, \
-    convert_to_str, get_sheet_name, string_to_error, strip_trailing_zeros, zero_value
-from .cell_error import CellError, CellErrorType
-from .formula import formula_parse, formula_rename_sheet
+    convert_to_str, error_to_string, get_sheet_name, location_to_coordinates, \
+    string_to_error, strip_trailing_zeros, zero_value
+from .cell_error import CellError, CellErrorType, STANDARD_ERRORS
+from .compiler import formula_compile
+from .formula import formula_parse, formula_rename_sheet, formula_template
 
 
 CellReference = Tuple[str, str]
 
 
+GetRange = Callable[[str, str, str], CellRange]
+
+
+class SheetsVersion:
+    '''
+    SheetsVersion identifies one arrangement of the sheets of a workbook. The
+    workbook replaces its version whenever a sheet is added, removed or
+    renamed, and invalidates the old one, so that cell handles resolved
+    against it are resolved again.
+    '''
+    __slots__ = ('valid',)
+
+    def __init__(self):
+        self.valid = True
+
+
+# A version that is never invalidated, for handles that do not depend on the
+# sheets of the workbook.
+_ALWAYS_VALID = SheetsVersion()
+
+
+class CellHandle:
+    '''
+    CellHandle is a cell reference of a formula resolved to the storage of
+    the referenced sheet and the packed key of the cell, so that reading the
+    referenced value is a single dict lookup. A handle to a missing sheet or
+    an invalid location holds the error value to return instead.
+    '''
+    __slots__ = ('_cells', '_key', '_version', '_error')
+
+    def __init__(self, cells: Optional[Dict[int, 'Cell']], key: int,
+                 version: SheetsVersion, error: Optional[CellError] = None):
+        self._cells = cells
+        self._key = key
+        self._version = version
+        self._error = error
+
+    @staticmethod
+    def error(error: CellError, version: SheetsVersion = _ALWAYS_VALID) -> 'CellHandle':
+        return CellHandle(None, 0, version, error)
+
+    def valid(self) -> bool:
+        return self._version.valid
+
+    def value(self) -> Any:
+        if self._cells is None:
+            return self._error
+        cell = self._cells.get(self._key)
+        return None if cell is None else cell.value()
+
+
+# Resolves a (sheet name, location) pair to a CellHandle.
+ResolveCell = Callable[[str, str], CellHandle]
+
+
+def _literal_value(contents: Optional[str]) -> Any:
+    # Return the value of cell contents that are not a formula.
+    if contents is None:
+        return None
+    if contents[0] == "'":
+        return contents[1:]
+
+    # Attempt to parse the string as an error.
+    value = string_to_error(contents)
+    if value is not None:
+        return value
+
+    if contents.lower() == "true":
+        return True
+    if contents.lower() == "false":
+        return False
+
+    # Attempt to parse the string as a number.
+    # If parsing fails, then assume that the value is a string.
+    try:
+        d = decimal.Decimal(contents)
+        if d.is_normal() or d.is_zero():
+            return strip_trailing_zeros(d)
+        return str(d)
+    except decimal.InvalidOperation:
+        return contents
+
+
+class LiteralValue:
+    '''
+    LiteralValue is the contents of a cell that was given a value directly
+    rather than as text. The value is stored as the cell's value as is, and
+    the text of the contents is only produced when it is asked for.
+    '''
+    __slots__ = ('value', '_text')
+
+    def __init__(self, value: Any, text: Optional[str] = None):
+        self.value = value
+        self._text = text
+
+    @staticmethod
+    def of(value: Any) -> Optional['LiteralValue']:
+        # Return the contents of a cell holding `value`, or None if the cell
+        # is empty. Numbers become Decimals the same way as the text of the
+        # number would, and strings lose leading and trailing whitespace the
+        # same way as contents do. Raises a TypeError for any other kind of
+        # value.
+        if value is None:
+            return None
+        if isinstance(value, bool):
+            return LiteralValue(value)
+        if isinstance(value, (int, float)):
+            value = decimal.Decimal(value if isinstance(value, int) else repr(value))
+        if isinstance(value, decimal.Decimal):
+            if value.is_normal() or value.is_zero():
+                return LiteralValue(strip_trailing_zeros(value))
+            return LiteralValue(str(value))
+        if isinstance(value, str):
+            value = value.strip()
+            return LiteralValue(value) if value != "" else None
+        raise TypeError(f"Cannot store a value of type {type(value).__name__} in a cell")
+
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.__text()
+        return self._text
+
+    def __text(self) -> str:
+        if isinstance(self.value, bool):
+            return "TRUE" if self.value else "FALSE"
+        if isinstance(self.value, decimal.Decimal):
+            return str(self.value)
+        # Strings that would be read back as something else are quoted.
+        text = self.value
+        if text != text.strip() or text[0] in ("=", "'") or _literal_value(text) != text:
+            return "'" + text
+        return text
+
+
+def value_to_text(value: Any) -> Optional[str]:
+    # Return text that reads back as `value` with text_to_value(), or None
+    # for an empty value. Errors keep their type but not their detail.
+    if value is None:
+        return None
+    if isinstance(value, CellError):
+        return error_to_string(value)
+    if value == "":
+        return "'"
+    return LiteralValue(value).text()
+
+
+def text_to_value(text: Optional[str]) -> Any:
+    # Return the value written as `text` by value_to_text().
+    return _literal_value(text) if text else None
+
+
+class StoredFormula:
+    '''
+    StoredFormula is the contents of a formula cell restored together with
+    its value and dependencies, e.g. from a snapshot. The formula is only
+    parsed once it has to be evaluated or rewritten. If the dependencies are
+    not known, they are found from the formula when they are first needed.
+    '''
+    __slots__ = ('text', 'value', 'dependencies')
+
+    def __init__(self, text: str, value: Any,
+                 dependencies: Optional[List[CellReference]] = None):
+        self.text = text
+        self.value = value
+        self.dependencies = dependencies
+
+
 class Cell:
     def __init__(self,
                  reference: CellReference,
-                 contents: Optional[Union[str, Contents]],
+                 contents: Optional[Union[str, Contents, LiteralValue, StoredFormula]],
                  get_cell_value: Callable[[str,
                                            str],
-                                          Any]):
+                                          Any],
+                 get_range: Optional[GetRange] = None,
+                 resolve_cell: Optional[ResolveCell] = None):
         self._reference = reference
         self._dependencies = None
         self._tree = None
+        self._template = None
+        # The contents of the cell if they are a formula shared with other
+        # cells; the string and tree of the formula are only produced when
+        # needed.
+        self._shared = None
+        # Whether the cell holds a literal rather than a formula. The value of
+        # a literal is computed once, when the contents are set.
+        self._literal = False
+        # The contents of the cell if it was given a value directly.
+        self._typed_contents = None
+        # Whether the formula in _contents has yet to be parsed.
+        self._parse_pending = False
         self._value = None
         self._get_cell_value = get_cell_value
+        self._get_range = get_range
+        self._resolve_cell = resolve_cell
+        # The compiled formula and the interpreter evaluating it, which are
+        # kept between evaluations.
+        self._compiled = None
+        self._interpreter = None
+        # Resolved handles of the cell references in the formula, by the id
+        # of their node in the (immutable) compiled formula.
+        self._handles: Dict[int, CellHandle] = {}
+        # Called with the cell whenever its contents or value change after it
+        # was created (see watch).
+        self._watcher: Optional[Callable[['Cell'], None]] = None
         self.__set_contents(contents)
         # Immediately recompute the value of the cell. This behavior is useful for testing
         # the behavior of Cell.
@@ -40,44 +236,157 @@ class Cell:
         # dependent cells will not change when the value of this cell is changed. If this
         # cell is part of a circular reference, then its value will later be changed to
         # a CIRCULAR_REFERENCE error.
-        self.recompute_value()
-
-    def __set_contents(self, contents: Optional[Union[str, Contents]]) -> None:
+        #
+        # Cells with a shared formula are created by copying cells, which
+        # recomputes the workbook afterwards; evaluating them here would
+        # translate the formula of every cell.
+        #
+        # Stored formulas come with their value.
+        if self._shared is None and not self._parse_pending:
+            self.recompute_value()
+
+    def __set_contents(self, contents: Optional[Union[str, Contents, LiteralValue,
+                                                      StoredFormula]]) -> None:
+        self._template = None
+        self._compiled = None
+        self._interpreter = None
+        self._handles = {}
+        self._shared = None
+        self._literal = False
+        self._typed_contents = None
+        self._parse_pending = False
+        if isinstance(contents, StoredFormula):
+            self._contents = contents.text
+            self._tree = None
+            self._parse_pending = True
+            self._value = contents.value
+            self._dependencies = None
+            if contents.dependencies is not None:
+                self._dependencies = list(contents.dependencies)
+            return
+        if isinstance(contents, LiteralValue):
+            self._typed_contents = contents
+            self._literal = True
+            self._contents = None
+            self._tree = None
+            self._value = contents.value
+            self._dependencies = []
+            return
+        if isinstance(contents, Contents) and contents.is_shared() \
+                and contents.references() is not None:
+            self._shared = contents
+            self._contents = None
+            self._tree = None
+            self.calculate_dependencies()
+            return
         if isinstance(contents, Contents):
             self._contents = str(contents)
             self._tree = contents.tree()
-            self.calculate_dependencies()
-            return
-        if contents is None or contents.strip() == "":
-            self._contents = None
         else:
-            self._contents = contents.strip()
-        if self._contents is not None:
-            if self._contents.startswith('='):
+            if contents is None or contents.strip() == "":
+                self._contents = None
+            else:
+                self._contents = contents.strip()
+            self._tree = None
+            if self._contents is not None and self._contents.startswith('='):
                 try:
                     self._tree = formula_parse(self._contents)
                 except LarkError:
                     pass
+        if self._contents is None or not self._contents.startswith('='):
+            self._literal = True
+            self._value = _literal_value(self._contents)
         self.calculate_dependencies()
 
     def contents(self) -> Optional[str]:
+        if self._shared is not None:
+            return str(self._shared)
+        if self._typed_contents is not None:
+            return self._typed_contents.text()
         return self._contents
 
     def tree(self) -> Optional[lark.Tree]:
-        return deepcopy(self._tree)
+        # Formula trees are immutable, so the tree is shared with the caller.
+        return self.__formula_tree()
+
+    def copied_contents(self) -> Contents:
+        # Return the contents of the cell for copying it elsewhere. Copies of
+        # a formula share it with this cell rather than each holding a
+        # translated tree.
+        if self._shared is not None:
+            return self._shared
+        return Contents(self.contents(), self.tree(),
+                        location_to_coordinates(self._reference[1]))
+
+    def __formula_tree(self) -> Optional[lark.Tree]:
+        # Produce the tree of a shared or stored formula the first time it is
+        # needed.
+        if self._tree is None and self._shared is not None:
+            self._tree = self._shared.tree()
+        if self._parse_pending:
+            self._parse_pending = False
+            try:
+                self._tree = formula_parse(self._contents)
+            except LarkError:
+                pass
+        return self._tree
 
     def value(self) -> Any:
         return self._value
 
-    def rename_sheet(self, old: str, new: str):
+    def set_value(self, value: Any) -> None:
+        # Store a value computed outside of the cell, e.g. by evaluating a run
+        # of cells with the same formula template in one batch.
+        self._value = value
+        self.__changed()
+
+    def watch(self, watcher: Optional[Callable[['Cell'], None]]) -> None:
+        # Have `watcher` called with the cell whenever the contents or the
+        # value of the cell change, e.g. to write the cell back to storage.
+        self._watcher = watcher
+
+    def __changed(self) -> None:
+        if self._watcher is not None:
+            self._watcher(self)
+
+    def template(self) -> Optional[Hashable]:
+        # Return the R1C1-normalized template of the cell's formula, or None
+        # if the cell does not contain a valid formula.
+        if self._template is None and self._shared is not None:
+            self._template = self._shared.template()
+        if self._template is None and self.__formula_tree() is not None:
+            origin = location_to_coordinates(self._reference[1])
+            self._template = formula_template(self._tree, origin)
+        return self._template
+
+    def rename_sheet(self, old: str, new: str) -> bool:
+        # Update references to the sheet `old` to refer to `new` instead.
+        # Returns true if the contents of the cell changed.
         if self._reference[0].lower() == old.lower():
-            self._reference = (old.lower(), self._reference[1])
-        if self._tree is not None:
+            self._reference = (new.lower(), self._reference[1])
+            self._handles = {}
+            # References without a sheet name now resolve to the new sheet.
+            self.calculate_dependencies()
+        if self._shared is not None and \
+                all(sheet != old.lower() for (sheet, _, _) in self._shared.references()):
+            return False
+        if self.__formula_tree() is not None:
+            contents = self._contents
             updated = formula_rename_sheet(self._tree, old, new)
             self.__set_contents(updated)
+            self.__changed()
+            return self._contents != contents
+        return False
 
     def calculate_dependencies(self):
-        if self._tree is None:
+        if self._shared is not None:
+            dependencies = set()
+            for (sheet, start, end) in self._shared.references():
+                sheet = (sheet or self._reference[0]).lower()
+                dependencies.add((sheet, range_location(start, end)))
+            self._dependencies = list(dependencies)
+            return
+        if self.__formula_tree() is None:
             self._dependencies = []
             return
         dependencies = set()
@@ -88,33 +397,63 @@ class Cell:
 
         self._dependencies = list(dependencies)
 
+    def __read_cell(self, sheet: Optional[str], location: str) -> Any:
+        if sheet is None:
+            sheet = self._reference[0]
+        if (sheet.lower(), location.upper()) == self._reference:
+            return STANDARD_ERRORS[CellErrorType.CIRCULAR_REFERENCE]
+        return self._get_cell_value(sheet, location)
+
+    def __read_range(self, sheet: Optional[str], start_location: str,
+                     end_location: str) -> CellRange:
+        if sheet is None:
+            sheet = self._reference[0]
+        if self._get_range is None:
+            return CellRange(sheet, start_location, end_location, self.__read_cell)
+        return self._get_range(sheet, start_location, end_location)
+
+    def __get_handle(self, tree: lark.Tree) -> CellHandle:
+        # Return the handle of a cell reference in the formula, resolving it
+        # the first time it is read and after the workbook's sheets change.
+        handle = self._handles.get(id(tree))
+        if handle is None or not handle.valid():
+            handle = self.__resolve_handle(tree)
+            self._handles[id(tree)] = handle
+        return handle
+
+    def __resolve_handle(self, tree: lark.Tree) -> CellHandle:
+        sheet = self._reference[0]
+        if len(tree.children) == 2:
+            sheet = get_sheet_name(tree).lower()
+        location = absolute_location_to_location(str(tree.children[-1])).upper()
+        if (sheet, location) == self._reference:
+            return CellHandle.error(STANDARD_ERRORS[CellErrorType.CIRCULAR_REFERENCE])
+        return self._resolve_cell(sheet, location)
+
     def dependencies(self):
         if self._dependencies is None:
             self.calculate_dependencies()
         return self._dependencies
 
     def mark_cyclical(self) -> None:
-        self._value = CellError(
-            CellErrorType.CIRCULAR_REFERENCE,
-            "A cell is part of a circular reference.")
+        self._value = STANDARD_ERRORS[CellErrorType.CIRCULAR_REFERENCE]
+        self.__changed()
 
     def _recompute_formula(self) -> None:
-        if self._tree is None:
-            self._value = CellError(
-                CellErrorType.PARSE_ERROR,
-                "A formula doesn't parse successfully.")
+        if self.__formula_tree() is None:
+            self._value = STANDARD_ERRORS[CellErrorType.PARSE_ERROR]
             return
 
-        def get_cell_value(sheet, location):
-            if sheet is None:
-                sheet = self._reference[0]
-            if (sheet.lower(), location.upper()) == self._reference:
-                return CellError(
-                    CellErrorType.CIRCULAR_REFERENCE,
-                    "A cell is part of a circular reference.")
-            return self._get_cell_value(sheet, location)
+        if self._compiled is None:
+            self._compiled = formula_compile(self._tree)
+        if self._interpreter is None:
+            get_handle = None
+            if self._resolve_cell is not None:
+                get_handle = self.__get_handle
+            self._interpreter = FormulaInterpreter(
+                self.__read_cell, self.__read_range, get_handle)
 
-        v = FormulaInterpreter(get_cell_value).visit(self._tree)
+        v = self._interpreter.visit(self._compiled)
         if isinstance(v, decimal.Decimal):
             if v.is_normal() or v.is_zero():
                 self._value = strip_trailing_zeros(v)
@@ -123,37 +462,16 @@ class Cell:
         else:
             self._value = v
 
+    def is_literal(self) -> bool:
+        # Return true if the cell holds a literal value rather than a formula.
+        # The value of a literal never needs to be recomputed.
+        return self._literal
+
     def recompute_value(self) -> None:
-        if self._contents is None:
-            self._value = None
-        elif self._contents[0] == "'":
-            self._value = self._contents[1:]
-        elif self._contents[0] == "=":
+        # Literal values are computed when the contents are set.
+        if not self._literal:
             self._recompute_formula()
-        else:
-            # Attempt to parse the string as an error.
-            self._value = string_to_error(self._contents)
-            if self._value is not None:
-                return
-
-            if self._contents.lower() == "true":
-                self._value = True
-                return
-
-            if self._contents.lower() == "false":
-                self._value = False
-                return
-
-            # Attempt to parse the string as a number.
-            # If parsing fails, then assume that the value is a string.
-            try:
-                d = decimal.Decimal(self._contents)
-                if d.is_normal() or d.is_zero():
-                    self._value = strip_trailing_zeros(d)
-                else:
-                    self._value = str(d)
-            except decimal.InvalidOperation:
-                self._value = self._contents
+            self.__changed()
 
 
 class DependencyFinder(Visitor):
@@ -166,17 +484,65 @@ class DependencyFinder(Visitor):
             sheet = str(tree.children[0]).lower()
             if tree.children[0].type == 'QUOTED_SHEET_NAME':
                 sheet = sheet[1:-1]
-            loc = str(tree.children[1]).upper()
+            loc = absolute_location_to_location(str(tree.children[1])).upper()
         else:
             sheet = self.sheet_name.lower()
-            loc = str(tree.children[0]).upper()
+            loc = absolute_location_to_location(str(tree.children[0])).upper()
         self.dependencies.add((sheet, loc))
 
+    def cell_range(self, tree):
+        if len(tree.children) == 3:
+            sheet = get_sheet_name(tree).lower()
+        else:
+            sheet = self.sheet_name.lower()
+        # A range is one dependency, e.g. ("sheet1", "A1:A10"), rather than a
+        # dependency on every cell in it; see RangeIndex.
+        try:
+            start = location_to_coordinates(absolute_location_to_location(str(tree.children[-2])))
+            end = location_to_coordinates(absolute_location_to_location(str(tree.children[-1])))
+        except ValueError:
+            return
+        self.dependencies.add((sheet, range_location(start, end)))
+
+# Comparison operators of bool_expr.
+_COMPARISONS = {
+    "=": operator.eq,
+    "==": operator.eq,
+    "<>": operator.ne,
+    "!=": operator.ne,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+}
+
+# Value of a cell range used where a single value is expected.
+_RANGE_AS_VALUE = CellError(CellErrorType.TYPE_ERROR,
+                            "A cell range cannot be used as a value.")
+
 # pylint: disable=no-self-use
 class FormulaInterpreter(Interpreter):
 
-    def __init__(self, get_cell_value: Callable[[str, str], Any]):
+    def __init__(self, get_cell_value: Callable[[str, str], Any],
+                 get_range: Optional[GetRange] = None,
+                 get_handle: Optional[Callable[[lark.Tree], CellHandle]] = None):
         self._get_cell_value = get_cell_value
+        self._get_range = get_range
+        self._get_handle = get_handle
+        # Argument thunks of the bound function calls evaluated so far, by the
+        # id of the call's node.
+        self._arguments: Dict[int, Tuple[Callable[[], Any], ...]] = {}
+        # Bound method of each rule, by rule name.
+        self._dispatch: Dict[str, Callable[[lark.Tree], Any]] = {}
+
+    def visit(self, tree):
+        # Same as Interpreter.visit, without looking the method up by name on
+        # every node.
+        method = self._dispatch.get(tree.data)
+        if method is None:
+            method = getattr(self, tree.data)
+            self._dispatch[tree.data] = method
+        return method(tree)
 
     def error(self, tree):
         err = string_to_error(tree.children[0])
@@ -201,31 +567,27 @@ class FormulaInterpreter(Interpreter):
     def parens(self, tree):
         return self.visit(tree.children[0])
 
-    def expr_list(self, tree):
-        if len(tree.children) == 2:
-            if tree.children[1].data == 'expr_list':
-                return [tree.children[0], *self.visit(tree.children[1])]
-            return [tree.children[0], tree.children[1]]
-        return [tree.children[0]]
-
-    def function_call(self, tree):
-        name = str(tree.children[0])
-        args = []
-        if len(tree.children) == 2:
-            if tree.children[1].data != 'expr_list':
-                args = [tree.children[1]]
-            else:
-                args = self.visit(tree.children[1])
-            args = list(map(lambda t: lambda: self.visit(t), args))
-        registry = FunctionRegistry()
-        func = registry.find(name)
-        if func is None:
-            return CellError(CellErrorType.BAD_NAME, f'function "{name}" not found')
-        value = func(args)
+    def value(self, tree):
+        # A value computed when the formula was compiled.
+        return tree.children[0]
+
+    def bound_call(self, tree):
+        function = tree.children[0]
+        args = self._arguments.get(id(tree))
+        if args is None:
+            visit = self.range_or_value if function.accepts_ranges else self.visit
+            args = tuple(functools.partial(visit, t) for t in tree.children[1:])
+            self._arguments[id(tree)] = args
+        value = function.func(args)
         if isinstance(value, lark.Tree):
             return self.visit(value)
         return value
 
+    def bound_cell(self, tree):
+        if self._get_handle is not None:
+            return self._get_handle(tree).value()
+        return self.cell(tree)
+
     def cell(self, tree):
         sheet = None
         location = None
@@ -238,12 +600,32 @@ class FormulaInterpreter(Interpreter):
             location = absolute_location_to_location(location)
             return self._get_cell_value(sheet, location)
         except (KeyError, ValueError):
-            return CellError(CellErrorType.BAD_REFERENCE,
-                             "A cell-reference is invalid in some way.")
+            return STANDARD_ERRORS[CellErrorType.BAD_REFERENCE]
+
+    def cell_range(self, tree):
+        # A range is only meaningful as the argument of a function that
+        # accepts ranges; anywhere else it is a type error.
+        return _RANGE_AS_VALUE
+
+    def range_or_value(self, tree):
+        # Evaluate a function argument, producing a CellRange if the argument
+        # is a range reference.
+        if tree.data != 'cell_range':
+            return self.visit(tree)
+        sheet = None
+        if len(tree.children) == 3:
+            sheet = get_sheet_name(tree).lower()
+        try:
+            return self._get_range(
+                sheet,
+                absolute_location_to_location(str(tree.children[-2])),
+                absolute_location_to_location(str(tree.children[-1])))
+        except (KeyError, ValueError):
+            return STANDARD_ERRORS[CellErrorType.BAD_REFERENCE]
 
     def bool_expr(self, tree):
         value1 = self.visit(tree.children[0])
-        op = str(tree.children[1])
+        op = tree.children[1]
         value2 = self.visit(tree.children[2])
         # If either value is an error, propogate it higher...
         if isinstance(value1, CellError):
@@ -274,19 +656,8 @@ class FormulaInterpreter(Interpreter):
             value1 = value1.lower()
             value2 = value2.lower()
 
-        ops = {
-            "=": lambda a, b: a == b,
-            "==": lambda a, b: a == b,
-            "<>": lambda a, b: a != b,
-            "!=": lambda a, b: a != b,
-            ">": lambda a, b: a > b,
-            ">=": lambda a, b: a >= b,
-            "<": lambda a, b: a < b,
-            "<=": lambda a, b: a <= b,
-        }
-        assert op in ops
-        func = ops[op]
-        return func(value1, value2)
+        assert op in _COMPARISONS
+        return _COMPARISONS[op](value1, value2)
 
     def concat_expr(self, tree):
         # If the left value is a CellError, return the error,
@@ -313,11 +684,10 @@ class FormulaInterpreter(Interpreter):
         if isinstance(value, CellError):
             return value
 
-        operator = str(tree.children[0])
-        assert operator in ["+", "-"]
-        if operator == "+":
+        op = tree.children[0]
+        if op == "+":
             return value
-        if operator == "-":
+        if op == "-":
             return value.__neg__()
         raise ValueError("unreachable")
 
@@ -336,15 +706,12 @@ class FormulaInterpreter(Interpreter):
         if isinstance(value2, CellError):
             return value2
 
-        operator = tree.children[1]
-        assert(operator in ["*", "/"])
-        if operator == "*":
+        op = tree.children[1]
+        if op == "*":
             return value1 * value2
-        if operator == "/":
-            if value2 == decimal.Decimal(0):
-                return CellError(
-                    CellErrorType.DIVIDE_BY_ZERO,
-                    "A divide-by-zero was encountered during evaluation.")
+        if op == "/":
+            if value2.is_zero():
+                return STANDARD_ERRORS[CellErrorType.DIVIDE_BY_ZERO]
             return value1 / value2
         raise ValueError("unreachable")
 
@@ -363,10 +730,9 @@ class FormulaInterpreter(Interpreter):
         if isinstance(value2, CellError):
             return value2
 
-        operator = tree.children[1]
-        assert(operator in ["+", "-"])
-        if operator == "+":
+        op = tree.children[1]
+        if op == "+":
             return value1 + value2
-        if operator == "-":
+        if op == "-":
             return value1 - value2
         raise ValueError("unreachable")
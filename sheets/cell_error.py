@@ -1,5 +1,5 @@
 import enum
-from typing import Optional
+from typing import Any, Dict, Optional
 
 
 class CellErrorType(enum.Enum):
@@ -29,14 +29,22 @@ class CellErrorType(enum.Enum):
 class CellError:
     '''
     This class represents an error value from user input, cell parsing, or
-    evaluation.
+    evaluation. Error values are immutable, and two errors are equal if they
+    have the same type and detail.
     '''
+    __slots__ = ('_error_type', '_detail', '_exception')
 
     def __init__(self, error_type: CellErrorType, detail: str,
                  exception: Optional[Exception] = None):
-        self._error_type = error_type
-        self._detail = detail
-        self._exception = exception
+        object.__setattr__(self, '_error_type', error_type)
+        object.__setattr__(self, '_detail', detail)
+        object.__setattr__(self, '_exception', exception)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"CellError is immutable; cannot set {name}")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"CellError is immutable; cannot delete {name}")
 
     def get_type(self) -> CellErrorType:
         ''' The category of the cell error. '''
@@ -53,8 +61,45 @@ class CellError:
         '''
         return self._exception
 
+    def __reduce__(self):
+        # Copies and pickles are made through __init__.
+        return (CellError, (self._error_type, self._detail, self._exception))
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, CellError):
+            return NotImplemented
+        return self._error_type == other._error_type and self._detail == other._detail
+
+    def __hash__(self) -> int:
+        return hash((self._error_type, self._detail))
+
     def __str__(self) -> str:
         return f'ERROR[{self._error_type}, "{self._detail}"]'
 
     def __repr__(self) -> str:
         return self.__str__()
+
+
+# The error value of each type with its standard detail. Error values are
+# never modified, so these are shared by every cell and every evaluation that
+# produces such an error rather than allocated each time.
+STANDARD_ERRORS: Dict[CellErrorType, CellError] = {
+    CellErrorType.PARSE_ERROR: CellError(
+        CellErrorType.PARSE_ERROR,
+        "A formula doesn't parse successfully."),
+    CellErrorType.CIRCULAR_REFERENCE: CellError(
+        CellErrorType.CIRCULAR_REFERENCE,
+        "A cell is part of a circular reference."),
+    CellErrorType.BAD_REFERENCE: CellError(
+        CellErrorType.BAD_REFERENCE,
+        "A cell-reference is invalid in some way."),
+    CellErrorType.BAD_NAME: CellError(
+        CellErrorType.BAD_NAME,
+        "Unrecognized function name."),
+    CellErrorType.TYPE_ERROR: CellError(
+        CellErrorType.TYPE_ERROR,
+        "A value of the wrong type was encountered during evaluation."),
+    CellErrorType.DIVIDE_BY_ZERO: CellError(
+        CellErrorType.DIVIDE_BY_ZERO,
+        "A divide-by-zero was encountered during evaluation."),
+}
@@ -0,0 +1,146 @@
+from typing import Any, Callable, Dict, Iterator, List, Set, Tuple
+
+from .criteria import CriteriaIndex
+from .utils import coordinates_to_location, in_range, location_to_coordinates
+
+
+class CellRange:
+    '''
+    CellRange is the value of a range reference such as `B1:B10` when it is
+    passed as an argument to a function that accepts ranges. Cell values are
+    read lazily through the `get_cell_value` callback, so creating a CellRange
+    is cheap.
+
+    Positions within the range are expressed as (column, row) offsets from the
+    top-left corner of the range, so two ranges with the same shape can be
+    paired position by position (e.g. the criteria and sum ranges of SUMIF).
+    '''
+    def __init__(self, sheet: str, start_location: str, end_location: str,
+                 get_cell_value: Callable[[str, str], Any], indexes: Any = None):
+        start = location_to_coordinates(start_location)
+        end = location_to_coordinates(end_location)
+        self._sheet = sheet.lower()
+        self._start = (min(start[0], end[0]), min(start[1], end[1]))
+        self._end = (max(start[0], end[0]), max(start[1], end[1]))
+        self._get_cell_value = get_cell_value
+        # The workbook-level CriteriaIndexCache, if any. Ranges that are not
+        # attached to a workbook build a throwaway index for each query.
+        self._indexes = indexes
+
+    def sheet(self) -> str:
+        return self._sheet
+
+    def start(self) -> Tuple[int, int]:
+        return self._start
+
+    def end(self) -> Tuple[int, int]:
+        return self._end
+
+    def key(self) -> Tuple[str, Tuple[int, int], Tuple[int, int]]:
+        # A hashable key identifying the cells covered by this range.
+        return (self._sheet, self._start, self._end)
+
+    def shape(self) -> Tuple[int, int]:
+        # Return a tuple (num-cols, num-rows) with the size of the range.
+        return (self._end[0] - self._start[0] + 1, self._end[1] - self._start[1] + 1)
+
+    def contains(self, coords: Tuple[int, int]) -> bool:
+        return in_range(coords, self._start, self._end)
+
+    def offset_of(self, coords: Tuple[int, int]) -> Tuple[int, int]:
+        return (coords[0] - self._start[0], coords[1] - self._start[1])
+
+    def offsets(self) -> Iterator[Tuple[int, int]]:
+        # Iterate over all positions in the range in row-major order.
+        (cols, rows) = self.shape()
+        for row in range(rows):
+            for col in range(cols):
+                yield (col, row)
+
+    def value_at(self, offset: Tuple[int, int]) -> Any:
+        coords = (self._start[0] + offset[0], self._start[1] + offset[1])
+        return self._get_cell_value(self._sheet, coordinates_to_location(coords))
+
+    def values(self) -> List[Any]:
+        return [self.value_at(offset) for offset in self.offsets()]
+
+    def criteria_index(self) -> CriteriaIndex:
+        # Return the grouped criteria index over this range. Ranges attached to
+        # a workbook share one incrementally maintained index per range.
+        if self._indexes is None:
+            return CriteriaIndex(self)
+        return self._indexes.get(self)
+
+    def __repr__(self) -> str:
+        start = coordinates_to_location(self._start)
+        end = coordinates_to_location(self._end)
+        return f'CellRange({self._sheet}!{start}:{end})'
+
+
+# Ranges covering more columns than this are not indexed by column.
+_WIDE_RANGE = 64
+
+
+def range_location(start: Tuple[int, int], end: Tuple[int, int]) -> str:
+    # Return the location of the range spanned by two corners, e.g. "A1:B10",
+    # as used for the range dependencies of formulas. A range of one cell is
+    # just the location of the cell.
+    top_left = (min(start[0], end[0]), min(start[1], end[1]))
+    bottom_right = (max(start[0], end[0]), max(start[1], end[1]))
+    if top_left == bottom_right:
+        return coordinates_to_location(top_left)
+    return f'{coordinates_to_location(top_left)}:{coordinates_to_location(bottom_right)}'
+
+
+def is_range_location(location: str) -> bool:
+    return ':' in location
+
+
+def range_bounds(location: str) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+    # Return the top-left and bottom-right corners of a location made by
+    # range_location().
+    (start, end) = location.split(':')
+    return (location_to_coordinates(start), location_to_coordinates(end))
+
+
+class RangeIndex:
+    '''
+    RangeIndex finds the range dependencies of formulas, such as
+    ("sheet1", "A1:A9999"), that contain a given cell. This lets a range be a
+    single vertex of the dependency graph rather than an edge to every cell
+    it covers. Each range is listed under every column it covers, except for
+    ranges wider than _WIDE_RANGE columns, which are checked for every cell.
+    '''
+    def __init__(self):
+        self._columns: Dict[Tuple[str, int], List[Tuple[int, int, Tuple[str, str]]]] = {}
+        self._wide: Dict[str, List[Tuple[Tuple[int, int], Tuple[int, int], Tuple[str, str]]]] = {}
+        self._ranges: Set[Tuple[str, str]] = set()
+
+    def add(self, reference: Tuple[str, str]) -> None:
+        if reference in self._ranges:
+            return
+        self._ranges.add(reference)
+        (sheet, location) = reference
+        (start, end) = range_bounds(location)
+        if end[0] - start[0] >= _WIDE_RANGE:
+            self._wide.setdefault(sheet, []).append((start, end, reference))
+            return
+        for col in range(start[0], end[0] + 1):
+            self._columns.setdefault((sheet, col), []).append((start[1], end[1], reference))
+
+    def __len__(self) -> int:
+        return len(self._ranges)
+
+    def containing(self, reference: Tuple[str, str]) -> List[Tuple[str, str]]:
+        # Return the ranges that contain the cell `reference`.
+        (sheet, location) = reference
+        try:
+            (col, row) = location_to_coordinates(location)
+        except ValueError:
+            return []
+        result = [r for (top, bottom, r) in self._columns.get((sheet, col), ())
+                  if top <= row <= bottom]
+        for (start, end, r) in self._wide.get(sheet, ()):
+            if in_range((col, row), start, end):
+                result.append(r)
+        return result
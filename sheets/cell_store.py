@@ -0,0 +1,391 @@
+'''
+Storage of the cells of a workbook in an SQLite database.
+
+A CellDatabase holds the sheets of a workbook and the cells of every sheet:
+
+    sheets      id, name and position of every sheet
+    cells       contents, value and dependencies of every cell, keyed by
+                (sheet id, column, row)
+    cell_dependents, range_dependents
+                the formulas that refer to each cell, and to each range,
+                so that the cells affected by a change can be found
+                without reading every formula
+
+The cells table is clustered on its key, so the cells of a region of a sheet
+are read with one range scan. Values are stored with their kind (see
+_encode_value), and dependencies as a JSON list of [sheet, location] pairs.
+
+A CellStore is the storage of one sheet. It is a mapping from packed cell key
+(see utils.coordinates_to_key) to Cell, so that it can take the place of the
+dict a Spreadsheet normally keeps its cells in. Only the cells that were used
+last are kept in memory; the others are read from the database when they are
+needed again. Cells that were added, changed or removed are written back when
+the store is flushed, in the transaction of the database that is open until
+the next commit().
+'''
+import collections
+import decimal
+import functools
+import itertools
+import json
+import sqlite3
+from typing import Any, Callable, Dict, Iterator, List, MutableMapping, Optional, Set, \
+    Tuple, Union
+
+from .cell import Cell, LiteralValue, StoredFormula
+from .cell_error import CellError, CellErrorType, STANDARD_ERRORS
+from .cell_range import is_range_location, range_bounds
+from .utils import CELL_KEY_BASE, location_to_coordinates
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS sheets (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        position INTEGER NOT NULL)''',
+    '''CREATE TABLE IF NOT EXISTS cells (
+        sheet_id INTEGER NOT NULL,
+        col INTEGER NOT NULL,
+        row INTEGER NOT NULL,
+        contents TEXT NOT NULL,
+        kind INTEGER NOT NULL,
+        value TEXT,
+        dependencies TEXT,
+        PRIMARY KEY (sheet_id, col, row)) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS cell_dependents (
+        sheet TEXT NOT NULL,
+        col INTEGER NOT NULL,
+        row INTEGER NOT NULL,
+        dependent_id INTEGER NOT NULL,
+        dependent_col INTEGER NOT NULL,
+        dependent_row INTEGER NOT NULL,
+        PRIMARY KEY (sheet, col, row, dependent_id, dependent_col, dependent_row))
+        WITHOUT ROWID''',
+    '''CREATE INDEX IF NOT EXISTS cell_dependents_by_dependent
+        ON cell_dependents (dependent_id, dependent_col, dependent_row)''',
+    '''CREATE TABLE IF NOT EXISTS range_dependents (
+        sheet TEXT NOT NULL,
+        start_col INTEGER NOT NULL,
+        start_row INTEGER NOT NULL,
+        end_col INTEGER NOT NULL,
+        end_row INTEGER NOT NULL,
+        dependent_id INTEGER NOT NULL,
+        dependent_col INTEGER NOT NULL,
+        dependent_row INTEGER NOT NULL)''',
+    '''CREATE INDEX IF NOT EXISTS range_dependents_by_sheet
+        ON range_dependents (sheet, start_col)''',
+    '''CREATE INDEX IF NOT EXISTS range_dependents_by_dependent
+        ON range_dependents (dependent_id, dependent_col, dependent_row)''',
+]
+
+# Version of the schema, kept as the user_version of the database. Databases
+# of version 0 have no dependents tables yet; they are filled in on open.
+_SCHEMA_VERSION = 1
+
+# Kinds of cell values. Errors are _ERROR plus the value of their type.
+_NONE = 0
+_NUMBER = 1
+_STRING = 2
+_BOOL = 3
+_ERROR = 8
+
+# Number of rows read at a time when scanning the cells of a sheet.
+_PAGE_SIZE = 1024
+
+# Makes the Cell at a packed key holding the given contents.
+MakeCell = Callable[[int, Union[LiteralValue, StoredFormula]], Cell]
+
+
+def _encode_value(value: Any) -> Tuple[int, Optional[str]]:
+    if value is None:
+        return (_NONE, None)
+    if isinstance(value, bool):
+        return (_BOOL, "TRUE" if value else "FALSE")
+    if isinstance(value, decimal.Decimal):
+        return (_NUMBER, str(value))
+    if isinstance(value, CellError):
+        return (_ERROR + value.get_type().value, value.get_detail())
+    return (_STRING, value)
+
+
+def _dependent_rows(sheet_id: int, key: int, dependencies: List[Tuple[str, str]],
+                    cells: List[Tuple], ranges: List[Tuple]) -> None:
+    # Add the rows of the cell_dependents and range_dependents tables for the
+    # formula at `key` of the sheet with `sheet_id` to `cells` and `ranges`.
+    (col, row) = divmod(key, CELL_KEY_BASE)
+    for (sheet, location) in dependencies:
+        try:
+            if is_range_location(location):
+                (start, end) = range_bounds(location)
+                ranges.append((sheet, start[0], start[1], end[0], end[1], sheet_id, col, row))
+            else:
+                (dep_col, dep_row) = location_to_coordinates(location)
+                cells.append((sheet, dep_col, dep_row, sheet_id, col, row))
+        except ValueError:
+            continue
+
+
+def _decode_value(kind: int, text: Optional[str]) -> Any:
+    if kind == _NONE:
+        return None
+    if kind == _BOOL:
+        return text == "TRUE"
+    if kind == _NUMBER:
+        return decimal.Decimal(text)
+    if kind == _STRING:
+        return text
+    error_type = CellErrorType(kind - _ERROR)
+    standard = STANDARD_ERRORS[error_type]
+    if standard.get_detail() == text:
+        return standard
+    return CellError(error_type, text)
+
+
+def _insert_dependents(conn: sqlite3.Connection, cells: List[Tuple],
+                       ranges: List[Tuple]) -> None:
+    conn.executemany('INSERT OR IGNORE INTO cell_dependents VALUES (?, ?, ?, ?, ?, ?)', cells)
+    conn.executemany('INSERT INTO range_dependents VALUES (?, ?, ?, ?, ?, ?, ?, ?)', ranges)
+
+
+class CellStore(MutableMapping[int, Cell]):
+    '''
+    CellStore is the storage of the cells of one sheet in a CellDatabase.
+    At most `cache_size` unchanged cells are kept in memory; changed cells
+    are kept until the next flush().
+    '''
+    def __init__(self, conn: sqlite3.Connection, sheet_id: int, make_cell: MakeCell,
+                 cache_size: int):
+        self._conn = conn
+        self.sheet_id = sheet_id
+        self._make_cell = make_cell
+        self._cache_size = cache_size
+        # Cells in the order they were last used.
+        self._cache: 'collections.OrderedDict[int, Cell]' = collections.OrderedDict()
+        # Cells added or changed, and keys of cells removed, since the last
+        # flush.
+        self._dirty: Dict[int, Cell] = {}
+        self._deleted: Set[int] = set()
+
+    def __changed(self, key: int, cell: Cell) -> None:
+        self._dirty[key] = cell
+        if key in self._cache:
+            self._cache[key] = cell
+
+    def __keep(self, key: int, cell: Cell) -> None:
+        self._cache[key] = cell
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def __load(self, key: int, row: Tuple[str, int, Optional[str], Optional[str]]) -> Cell:
+        (contents, kind, text, dependencies) = row
+        value = _decode_value(kind, text)
+        if contents.startswith('='):
+            if dependencies is not None:
+                dependencies = [tuple(d) for d in json.loads(dependencies)]
+            cell = self._make_cell(key, StoredFormula(contents, value, dependencies))
+        else:
+            cell = self._make_cell(key, LiteralValue(value, contents))
+        cell.watch(functools.partial(self.__changed, key))
+        return cell
+
+    def get(self, key: int, default: Any = None) -> Any:
+        cell = self._dirty.get(key)
+        if cell is not None:
+            return cell
+        if key in self._deleted:
+            return default
+        cell = self._cache.get(key)
+        if cell is not None:
+            self._cache.move_to_end(key)
+            return cell
+        row = self._conn.execute(
+            'SELECT contents, kind, value, dependencies FROM cells '
+            'WHERE sheet_id = ? AND col = ? AND row = ?',
+            (self.sheet_id, key // CELL_KEY_BASE, key % CELL_KEY_BASE)).fetchone()
+        if row is None:
+            return default
+        cell = self.__load(key, row)
+        self.__keep(key, cell)
+        return cell
+
+    def __getitem__(self, key: int) -> Cell:
+        cell = self.get(key)
+        if cell is None:
+            raise KeyError(key)
+        return cell
+
+    def __contains__(self, key: object) -> bool:
+        return self.get(key) is not None
+
+    def __setitem__(self, key: int, cell: Cell) -> None:
+        cell.watch(functools.partial(self.__changed, key))
+        self._deleted.discard(key)
+        self._dirty[key] = cell
+        self.__keep(key, cell)
+
+    def __delitem__(self, key: int) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self._dirty.pop(key, None)
+        self._cache.pop(key, None)
+        self._deleted.add(key)
+
+    def __scan(self, start: Tuple[int, int], end: Tuple[int, int]) -> Iterator[Tuple[int, Cell]]:
+        # Iterate over the cells from `start` to `end` (inclusive) in column
+        # order, a page of rows at a time.
+        self.flush()
+        (col, row) = (start[0], start[1] - 1)
+        while True:
+            rows = self._conn.execute(
+                'SELECT col, row, contents, kind, value, dependencies FROM cells '
+                'WHERE sheet_id = ? AND (col > ? OR (col = ? AND row > ?)) AND col <= ? '
+                'AND row BETWEEN ? AND ? ORDER BY col, row LIMIT ?',
+                (self.sheet_id, col, col, row, end[0], start[1], end[1], _PAGE_SIZE)).fetchall()
+            for (col, row, *data) in rows:
+                key = col * CELL_KEY_BASE + row
+                cell = self._dirty.get(key) or self._cache.get(key)
+                if cell is None:
+                    cell = self.__load(key, data)
+                    self.__keep(key, cell)
+                yield (key, cell)
+            if len(rows) < _PAGE_SIZE:
+                return
+
+    def items_in(self, start: Tuple[int, int], end: Tuple[int, int]) -> Iterator[Tuple[int, Cell]]:
+        # Iterate over the key and cell of every cell from `start` to `end`
+        # (inclusive), using the index of the cells table.
+        return self.__scan(start, end)
+
+    def items(self) -> Iterator[Tuple[int, Cell]]:
+        return self.__scan((0, 0), (CELL_KEY_BASE, CELL_KEY_BASE))
+
+    def values(self) -> Iterator[Cell]:
+        return (cell for (_, cell) in self.items())
+
+    def __iter__(self) -> Iterator[int]:
+        self.flush()
+        rows = self._conn.execute(
+            'SELECT col, row FROM cells WHERE sheet_id = ? ORDER BY col, row',
+            (self.sheet_id,)).fetchall()
+        return (col * CELL_KEY_BASE + row for (col, row) in rows)
+
+    def __len__(self) -> int:
+        self.flush()
+        return self._conn.execute('SELECT COUNT(*) FROM cells WHERE sheet_id = ?',
+                                  (self.sheet_id,)).fetchone()[0]
+
+    def flush(self) -> None:
+        # Write the cells added, changed or removed since the last flush to
+        # the database.
+        # The reverse dependencies of every cell written or removed are
+        # replaced as well.
+        changed = [(self.sheet_id, key // CELL_KEY_BASE, key % CELL_KEY_BASE)
+                   for key in itertools.chain(self._deleted, self._dirty)]
+        if changed:
+            for table in ('cell_dependents', 'range_dependents'):
+                self._conn.executemany(
+                    f'DELETE FROM {table} WHERE dependent_id = ? AND dependent_col = ? '
+                    'AND dependent_row = ?', changed)
+        if self._deleted:
+            self._conn.executemany(
+                'DELETE FROM cells WHERE sheet_id = ? AND col = ? AND row = ?',
+                [(self.sheet_id, key // CELL_KEY_BASE, key % CELL_KEY_BASE)
+                 for key in self._deleted])
+            self._deleted = set()
+        if self._dirty:
+            rows = []
+            (cell_dependents, range_dependents) = ([], [])
+            for (key, cell) in self._dirty.items():
+                (kind, text) = _encode_value(cell.value())
+                dependencies = None
+                if not cell.is_literal():
+                    dependencies = json.dumps(cell.dependencies())
+                    _dependent_rows(self.sheet_id, key, cell.dependencies(),
+                                    cell_dependents, range_dependents)
+                rows.append((self.sheet_id, key // CELL_KEY_BASE, key % CELL_KEY_BASE,
+                             cell.contents(), kind, text, dependencies))
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO cells VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            _insert_dependents(self._conn, cell_dependents, range_dependents)
+            self._dirty = {}
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+
+class CellDatabase:
+    '''
+    CellDatabase is an SQLite database holding the sheets and cells of a
+    workbook. Changes are made in one transaction that lasts until commit().
+    '''
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path)
+        version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+        for statement in _SCHEMA:
+            self._conn.execute(statement)
+        if version < _SCHEMA_VERSION:
+            self.__index_dependents()
+            self._conn.execute(f'PRAGMA user_version = {_SCHEMA_VERSION}')
+        self._conn.commit()
+
+    def __index_dependents(self) -> None:
+        # Fill in the dependents tables from the dependencies of the cells,
+        # a page of formulas at a time.
+        cursor = self._conn.execute(
+            'SELECT sheet_id, col, row, dependencies FROM cells WHERE dependencies IS NOT NULL')
+        while True:
+            rows = cursor.fetchmany(_PAGE_SIZE)
+            if not rows:
+                return
+            (cells, ranges) = ([], [])
+            for (sheet_id, col, row, dependencies) in rows:
+                _dependent_rows(sheet_id, col * CELL_KEY_BASE + row,
+                                [tuple(d) for d in json.loads(dependencies)], cells, ranges)
+            _insert_dependents(self._conn, cells, ranges)
+
+    def sheets(self) -> List[Tuple[int, str]]:
+        # Return the id and name of every sheet, in the order of the sheets.
+        return self._conn.execute('SELECT id, name FROM sheets ORDER BY position').fetchall()
+
+    def add_sheet(self, name: str) -> int:
+        # Add a sheet at the end and return its id.
+        cursor = self._conn.execute(
+            'INSERT INTO sheets (name, position) '
+            'VALUES (?, (SELECT COALESCE(MAX(position) + 1, 0) FROM sheets))', (name,))
+        return cursor.lastrowid
+
+    def update_sheets(self, sheets: List[Tuple[int, str]]) -> None:
+        # Make the sheets the given (id, name) pairs, in the given order.
+        # Sheets that are not among them are removed with their cells.
+        ids = [sheet_id for (sheet_id, _) in sheets]
+        placeholders = ', '.join('?' * len(ids))
+        self._conn.execute(f'DELETE FROM cells WHERE sheet_id NOT IN ({placeholders})', ids)
+        self._conn.execute(f'DELETE FROM sheets WHERE id NOT IN ({placeholders})', ids)
+        for table in ('cell_dependents', 'range_dependents'):
+            self._conn.execute(
+                f'DELETE FROM {table} WHERE dependent_id NOT IN ({placeholders})', ids)
+        self._conn.executemany('UPDATE sheets SET name = ?, position = ? WHERE id = ?',
+                               [(name, i, sheet_id) for (i, (sheet_id, name)) in enumerate(sheets)])
+
+    def dependents(self, sheet: str, coords: Tuple[int, int]) -> List[Tuple[int, int, int]]:
+        # Return the sheet id, column and row of every formula that refers to
+        # the cell at `coords` of the sheet named `sheet` (in lower case),
+        # directly or through a range, as of the last flush of its sheet.
+        (col, row) = coords
+        result = self._conn.execute(
+            'SELECT dependent_id, dependent_col, dependent_row FROM cell_dependents '
+            'WHERE sheet = ? AND col = ? AND row = ?', (sheet, col, row)).fetchall()
+        result.extend(self._conn.execute(
+            'SELECT dependent_id, dependent_col, dependent_row FROM range_dependents '
+            'WHERE sheet = ? AND start_col <= ? AND end_col >= ? '
+            'AND start_row <= ? AND end_row >= ?', (sheet, col, col, row, row)).fetchall())
+        return result
+
+    def cells(self, sheet_id: int, make_cell: MakeCell, cache_size: int) -> CellStore:
+        return CellStore(self._conn, sheet_id, make_cell, cache_size)
+
+    def commit(self) -> None:
+        self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.commit()
+        self._conn.close()
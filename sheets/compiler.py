@@ -0,0 +1,147 @@
+'''
+Compilation of parsed formulas into the form evaluated by FormulaInterpreter.
+
+The tree produced by formula_parse is the source form of a formula: it is
+what gets written back out, translated and renamed. Before a formula is
+evaluated it is compiled into a separate tree in which
+
+  - function calls are bound to their implementation, with the number of
+    arguments checked and the argument list flattened (`bound_call`),
+  - calls that can never succeed are replaced by their error (`value`),
+  - cell references are marked for resolution to cell handles
+    (`bound_cell`),
+  - literals, and every sub-expression that does not depend on a cell, are
+    evaluated once and replaced by their value (`value`),
+  - IF, IFERROR and CHOOSE calls whose first argument is constant are
+    replaced by the branch they select.
+
+Constant sub-expressions are evaluated by FormulaInterpreter itself, so the
+folded values (including errors) are exactly the values that evaluating the
+sub-expression would produce. Dependencies are still found on the parsed
+tree, so folding away a branch never drops a dependency.
+
+Compiled trees are only ever evaluated, never written out.
+'''
+import sys
+from typing import Any, List
+
+import lark
+from lark.visitors import Transformer
+
+from .cell_error import CellError
+from .formula import freeze_tree
+from .function import FunctionRegistry
+
+# Rules that are evaluated at compile time when all of their operands are
+# constant.
+_FOLDABLE = {
+    'number', 'string', 'bool', 'error', 'parens',
+    'unary_op', 'mul_expr', 'add_expr', 'concat_expr', 'bool_expr',
+}
+
+# Rules with an operator token among their children.
+_OPERATORS = {'unary_op', 'mul_expr', 'add_expr', 'bool_expr'}
+
+# Functions whose value depends on more than their arguments.
+_IMPURE = {'INDIRECT'}
+
+# Functions that return one of their arguments, selected by the first one.
+_SELECTING = {'IF', 'IFERROR', 'CHOOSE'}
+
+
+def _arguments(tree: lark.Tree) -> List[lark.Tree]:
+    # Flatten the right-deep expr_list of a function call.
+    args = []
+    while isinstance(tree, lark.Tree) and tree.data == 'expr_list':
+        args.append(tree.children[0])
+        if len(tree.children) == 1:
+            return args
+        tree = tree.children[1]
+    args.append(tree)
+    return args
+
+
+def _is_constant(tree: Any) -> bool:
+    return not isinstance(tree, lark.Tree) or tree.data == 'value'
+
+
+def _read_cell(sheet, location):
+    raise ValueError(f"constant expression read cell {location}")
+
+
+class _Branch:
+    # Stands in for an argument of a selecting function that is not constant.
+    def __init__(self, index: int):
+        self.index = index
+
+
+# pylint: disable=no-self-use
+class _Compiler(Transformer):
+    def __init__(self):
+        super().__init__()
+        self._interpreter = None
+
+    def __default__(self, data, children, meta):
+        tree = lark.Tree(data, children, meta)
+        if data in _FOLDABLE and all(map(_is_constant, children)):
+            return self.__fold(tree)
+        if data in _OPERATORS:
+            # Plain interned strings compare by identity, which is much
+            # cheaper than comparing lark tokens.
+            children = [sys.intern(str(c)) if isinstance(c, lark.Token) else c
+                        for c in children]
+            return lark.Tree(sys.intern(str(data)), children, meta)
+        return tree
+
+    def cell(self, children):
+        return lark.Tree('bound_cell', children)
+
+    def function_call(self, children):
+        name = str(children[0])
+        args = _arguments(children[1]) if len(children) == 2 else []
+        function = FunctionRegistry().bind(name, len(args))
+        if isinstance(function, CellError):
+            return lark.Tree('value', [function])
+        tree = lark.Tree('bound_call', [function, *args])
+        if function.name in _IMPURE:
+            return tree
+        if all(map(_is_constant, args)):
+            return self.__fold(tree)
+        if function.name in _SELECTING and _is_constant(args[0]):
+            return self.__select(function, args)
+        return tree
+
+    def __fold(self, tree: lark.Tree) -> lark.Tree:
+        # Replace a constant expression by its value. Expressions that raise
+        # are left to raise when the formula is evaluated.
+        if self._interpreter is None:
+            # Imported here because cell.py imports this module.
+            from .cell import FormulaInterpreter
+            self._interpreter = FormulaInterpreter(_read_cell)
+        try:
+            return lark.Tree('value', [self._interpreter.visit(tree)])
+        except ArithmeticError:
+            return tree
+
+    def __select(self, function, args: List[lark.Tree]) -> lark.Tree:
+        # Call the function with its constant first argument, passing markers
+        # for the other arguments, and replace the call by whatever it
+        # returned: a constant value or the argument it selected.
+        first = args[0].children[0]
+        thunks = [lambda: first]
+        for i in range(1, len(args)):
+            thunks.append(lambda i=i: _Branch(i))
+        result = function.func(thunks)
+        if not isinstance(result, _Branch):
+            return lark.Tree('value', [result])
+        branch = args[result.index]
+        if branch.data == 'cell_range':
+            # A range selected outside of a range function is an error value,
+            # not a range.
+            return self.__fold(branch)
+        return branch
+
+
+def formula_compile(tree: lark.Tree) -> lark.Tree:
+    # Return the compiled form of a parsed formula.
+    return freeze_tree(_Compiler().transform(tree))
@@ -0,0 +1,132 @@
+'''
+Streaming compression of workbook files.
+
+compressed_text() turns a binary file object into a text stream that
+compresses what is written to it, or decompresses what is read from it, a
+chunk at a time, so that a compressed workbook is never held in memory as a
+whole. The codecs are the stdlib gzip, lzma (.xz) and zlib formats; when
+reading, the codec is found from the first bytes of the stream.
+'''
+import contextlib
+import gzip
+import io
+import lzma
+import zlib
+from typing import BinaryIO, Iterator, Optional, TextIO
+
+CODECS = ('gzip', 'lzma', 'zlib')
+
+# Number of compressed bytes read at a time.
+_CHUNK_SIZE = 1 << 16
+
+
+class _ZlibWriter(io.RawIOBase):
+    # Compresses everything written to it into a zlib stream on `fp`.
+    def __init__(self, fp: BinaryIO, level: int):
+        super().__init__()
+        self._fp = fp
+        self._compressor = zlib.compressobj(level)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._fp.write(self._compressor.compress(b))
+        return len(b)
+
+    def close(self) -> None:
+        if not self.closed:
+            self._fp.write(self._compressor.flush())
+        super().close()
+
+
+class _ZlibReader(io.RawIOBase):
+    # Decompresses the zlib stream on `fp`, without holding more than a
+    # chunk of either side in memory.
+    def __init__(self, fp: BinaryIO):
+        super().__init__()
+        self._fp = fp
+        self._decompressor = zlib.decompressobj()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._decompressor.eof:
+            data = self._decompressor.unconsumed_tail
+            if not data:
+                data = self._fp.read(_CHUNK_SIZE)
+                if not data:
+                    raise EOFError("Compressed file ended before the "
+                                   "end-of-stream marker was reached")
+            out = self._decompressor.decompress(data, len(b))
+            if out:
+                b[:len(out)] = out
+                return len(out)
+        return 0
+
+
+def detect_codec(head: bytes) -> Optional[str]:
+    # Return the codec of a compressed stream starting with `head` (at least
+    # six bytes), or None if it does not look compressed.
+    if head.startswith(b'\x1f\x8b'):
+        return 'gzip'
+    if head.startswith(b'\xfd7zXZ\x00'):
+        return 'lzma'
+    if len(head) >= 2 and head[0] & 0x0f == 8 and (head[0] * 256 + head[1]) % 31 == 0:
+        return 'zlib'
+    return None
+
+
+def _peek(fp: BinaryIO, count: int) -> bytes:
+    # Return the first bytes of `fp` without consuming them.
+    if hasattr(fp, 'peek'):
+        return fp.peek(count)[:count]
+    if fp.seekable():
+        position = fp.tell()
+        head = fp.read(count)
+        fp.seek(position)
+        return head
+    raise ValueError("The codec must be given for a stream that cannot be peeked at")
+
+
+@contextlib.contextmanager
+def compressed_text(fp: BinaryIO, mode: str, codec: Optional[str] = None,
+                    level: Optional[int] = None) -> Iterator[TextIO]:
+    # Yield a UTF-8 text stream over the binary file object `fp` that
+    # compresses (mode 'w') or decompresses (mode 'r') with `codec`. When
+    # reading, the codec is detected if it is None. `fp` is left open; when
+    # writing, the compressed stream is complete once the block exits.
+    #
+    # Raises a ValueError for an unknown codec, or for input that is not
+    # compressed with any of the codecs.
+    if mode not in ('r', 'w'):
+        raise ValueError(f"Invalid mode {mode!r}")
+    if codec is None:
+        if mode == 'w':
+            raise ValueError("A codec must be given for writing")
+        codec = detect_codec(_peek(fp, 6))
+        if codec is None:
+            raise ValueError("The stream is not compressed with a known codec")
+    if codec == 'gzip':
+        binary = gzip.GzipFile(fileobj=fp, mode=mode + 'b',
+                               compresslevel=6 if level is None else level)
+    elif codec == 'lzma':
+        binary = lzma.LZMAFile(fp, mode, preset=level if mode == 'w' else None)
+    elif codec == 'zlib':
+        if mode == 'w':
+            binary = io.BufferedWriter(_ZlibWriter(fp, 6 if level is None else level),
+                                       _CHUNK_SIZE)
+        else:
+            binary = io.BufferedReader(_ZlibReader(fp), _CHUNK_SIZE)
+    else:
+        raise ValueError(f"Unknown codec {codec!r}; expected one of {', '.join(CODECS)}")
+
+    text = io.TextIOWrapper(binary, encoding='utf-8', newline='')
+    try:
+        yield text
+        text.flush()
+    finally:
+        # Closing the compressed stream finishes it, but leaves fp open.
+        text.detach()
+        binary.close()
@@ -0,0 +1,258 @@
+import decimal
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple, Union
+
+from .cell_error import CellError
+from .utils import CellValueType
+
+Offset = Tuple[int, int]
+
+# Grouping key used for error values in a criteria range. Errors never compare
+# equal to a criteria operand, so they can only be matched by "<>".
+_ERROR_KEY = ('error', None)
+
+_OPERATORS = ['<=', '>=', '<>', '=', '<', '>']
+
+
+def criteria_key(value: Any) -> Hashable:
+    # Return the normalized grouping key of a cell value. Strings are grouped
+    # case-insensitively and the value type is part of the key so that e.g.
+    # TRUE and 1 end up in different groups.
+    if value is None:
+        return (CellValueType.NONE, None)
+    if isinstance(value, CellError):
+        return _ERROR_KEY
+    if isinstance(value, bool):
+        return (CellValueType.BOOL, value)
+    if isinstance(value, decimal.Decimal):
+        return (CellValueType.NUMBER, value)
+    return (CellValueType.STRING, str(value).lower())
+
+
+def _operand_key(text: str) -> Hashable:
+    # Classify the operand of a textual criteria the same way a literal cell
+    # would be classified.
+    if text == "":
+        return (CellValueType.NONE, None)
+    if text.lower() in ("true", "false"):
+        return (CellValueType.BOOL, text.lower() == "true")
+    try:
+        d = decimal.Decimal(text)
+        if d.is_normal() or d.is_zero():
+            return (CellValueType.NUMBER, d)
+    except decimal.InvalidOperation:
+        pass
+    return (CellValueType.STRING, text.lower())
+
+
+class Criteria:
+    '''
+    Criteria is a parsed SUMIF/COUNTIF criteria such as `"east"`, `">=10"` or
+    `"<>"`. A criteria is an operator and an operand key; cell values are
+    matched by comparing their grouping key against the operand.
+    '''
+    def __init__(self, op: str, operand: Hashable):
+        self.op = op
+        self.operand = operand
+
+    @staticmethod
+    def parse(value: Any) -> Union[CellError, 'Criteria']:
+        if isinstance(value, CellError):
+            return value
+        if not isinstance(value, str):
+            return Criteria('=', criteria_key(value))
+        for op in _OPERATORS:
+            if value.startswith(op):
+                return Criteria(op, _operand_key(value[len(op):]))
+        return Criteria('=', _operand_key(value))
+
+    def matches(self, key: Hashable) -> bool:
+        if self.op == '=':
+            return key == self.operand
+        if self.op == '<>':
+            return key != self.operand
+        # Ordering comparisons only match values of the same type.
+        if key[0] != self.operand[0] or key[0] == CellValueType.NONE:
+            return False
+        if self.op == '<':
+            return key[1] < self.operand[1]
+        if self.op == '<=':
+            return key[1] <= self.operand[1]
+        if self.op == '>':
+            return key[1] > self.operand[1]
+        if self.op == '>=':
+            return key[1] >= self.operand[1]
+        raise ValueError("unreachable")
+
+
+class _Aggregate:
+    # The sum and count of the numeric values of one group in a sum range. If
+    # any value in the group is an error, `error` holds the first one.
+    def __init__(self, total: decimal.Decimal, count: int, error: Optional[CellError]):
+        self.total = total
+        self.count = count
+        self.error = error
+
+
+class CriteriaIndex:
+    '''
+    CriteriaIndex groups the positions of a criteria range by the normalized
+    value at each position. Matching an equality criteria is a single dict
+    lookup, and other criteria only have to visit each distinct value once.
+
+    For every sum range the index has been queried with, the index also keeps
+    the partial sum of each group. Cells that change are reported through
+    invalidate(); the affected positions are re-read and regrouped the next
+    time the index is queried.
+    '''
+    def __init__(self, cell_range):
+        self._range = cell_range
+        self._groups: Dict[Hashable, Set[Offset]] = {}
+        self._keys: Dict[Offset, Hashable] = {}
+        self._dirty: Set[Offset] = set()
+        # Sum ranges by key, their cached per-group aggregates and the
+        # positions of each sum range that changed since the last query.
+        self._sum_ranges: Dict[Hashable, Any] = {}
+        self._sums: Dict[Hashable, Dict[Hashable, _Aggregate]] = {}
+        self._sum_dirty: Dict[Hashable, Set[Offset]] = {}
+        for offset in cell_range.offsets():
+            self.__add(offset, criteria_key(cell_range.value_at(offset)))
+
+    def cell_range(self):
+        return self._range
+
+    def invalidate(self, sheet: str, coords: Tuple[int, int]) -> None:
+        # Record that the value of the cell at `coords` may have changed.
+        sheet = sheet.lower()
+        if self._range.sheet() == sheet and self._range.contains(coords):
+            self._dirty.add(self._range.offset_of(coords))
+        for key, sum_range in self._sum_ranges.items():
+            if sum_range.sheet() == sheet and sum_range.contains(coords):
+                self._sum_dirty[key].add(sum_range.offset_of(coords))
+
+    def reads_sheet(self, sheet: str) -> bool:
+        # Return true if the range or any sum range of the index is on `sheet`.
+        sheet = sheet.lower()
+        return self._range.sheet() == sheet or \
+            any(sum_range.sheet() == sheet for sum_range in self._sum_ranges.values())
+
+    def matching_keys(self, criteria: Criteria) -> List[Hashable]:
+        self.__refresh()
+        if criteria.op == '=':
+            return [criteria.operand] if criteria.operand in self._groups else []
+        return [key for key in self._groups if criteria.matches(key)]
+
+    def matching(self, criteria: Criteria) -> Set[Offset]:
+        # Return the positions within the range whose value matches criteria.
+        keys = self.matching_keys(criteria)
+        if len(keys) == 1:
+            return self._groups[keys[0]]
+        result = set()
+        for key in keys:
+            result.update(self._groups[key])
+        return result
+
+    def count(self, criteria: Criteria) -> int:
+        return sum(len(self._groups[key]) for key in self.matching_keys(criteria))
+
+    def aggregate(self, criteria: Criteria,
+                  sum_range) -> Tuple[Union[CellError, decimal.Decimal], int]:
+        # Return the sum and count of the numeric values in `sum_range` at the
+        # positions matching criteria. `sum_range` must have the same shape as
+        # the criteria range.
+        keys = self.matching_keys(criteria)
+        sums = self.__sums_for(sum_range)
+        total = decimal.Decimal(0)
+        count = 0
+        for key in keys:
+            if key not in sums:
+                sums[key] = self.__compute_aggregate(sum_range, self._groups[key])
+            aggregate = sums[key]
+            if aggregate.error is not None:
+                return (aggregate.error, 0)
+            total += aggregate.total
+            count += aggregate.count
+        return (total, count)
+
+    def __sums_for(self, sum_range) -> Dict[Hashable, _Aggregate]:
+        key = sum_range.key()
+        if key not in self._sum_ranges:
+            self._sum_ranges[key] = sum_range
+            self._sums[key] = {}
+            self._sum_dirty[key] = set()
+        # Drop the cached aggregate of every group with a changed sum cell.
+        sums = self._sums[key]
+        for offset in self._sum_dirty[key]:
+            sums.pop(self._keys[offset], None)
+        self._sum_dirty[key].clear()
+        return sums
+
+    @staticmethod
+    def __compute_aggregate(sum_range, offsets: Set[Offset]) -> _Aggregate:
+        total = decimal.Decimal(0)
+        count = 0
+        for offset in sorted(offsets, key=lambda o: (o[1], o[0])):
+            value = sum_range.value_at(offset)
+            if isinstance(value, CellError):
+                return _Aggregate(total, count, value)
+            if isinstance(value, decimal.Decimal):
+                total += value
+                count += 1
+        return _Aggregate(total, count, None)
+
+    def __refresh(self) -> None:
+        # Regroup every position that changed since the last query.
+        for offset in self._dirty:
+            key = criteria_key(self._range.value_at(offset))
+            old_key = self._keys[offset]
+            if key == old_key:
+                continue
+            self.__remove(offset, old_key)
+            self.__add(offset, key)
+        self._dirty.clear()
+
+    def __add(self, offset: Offset, key: Hashable) -> None:
+        self._keys[offset] = key
+        self._groups.setdefault(key, set()).add(offset)
+        for sums in self._sums.values():
+            sums.pop(key, None)
+
+    def __remove(self, offset: Offset, key: Hashable) -> None:
+        group = self._groups[key]
+        group.discard(offset)
+        if len(group) == 0:
+            del self._groups[key]
+        for sums in self._sums.values():
+            sums.pop(key, None)
+
+
+class CriteriaIndexCache:
+    '''
+    CriteriaIndexCache holds one CriteriaIndex per distinct criteria range in
+    a workbook, so that many conditional aggregates over the same range share
+    a single grouping pass.
+    '''
+    def __init__(self):
+        self._indexes: Dict[Hashable, CriteriaIndex] = {}
+
+    def get(self, cell_range) -> CriteriaIndex:
+        key = cell_range.key()
+        if key not in self._indexes:
+            self._indexes[key] = CriteriaIndex(cell_range)
+        return self._indexes[key]
+
+    def invalidate(self, sheet: str, coords: Tuple[int, int]) -> None:
+        # Notify every index that the cell at `coords` on `sheet` changed.
+        for index in self._indexes.values():
+            index.invalidate(sheet, coords)
+
+    def drop_sheet(self, sheet: str) -> None:
+        # Drop the indexes that read cells of `sheet`, e.g. after cells were
+        # added to the sheet without invalidating them one by one.
+        self._indexes = {key: index for (key, index) in self._indexes.items()
+                         if not index.reads_sheet(sheet)}
+
+    def clear(self) -> None:
+        self._indexes.clear()
+
+    def __len__(self) -> int:
+        return len(self._indexes)
@@ -1,11 +1,10 @@
-from typing import Set, Tuple
+from typing import Hashable, List, Optional, Set, Tuple, Union
 import os
 import re
-from functools import reduce
 import lark
 from lark.visitors import Visitor, Transformer
 
-from sheets.utils import get_sheet_name, translate_cell_ref
+from sheets.utils import column_to_number, get_sheet_name, number_to_column, translate_cell_ref
 
 def quote_sheet_name(sheet_name: str):
     if len(sheet_name) <= 2:
@@ -17,47 +16,129 @@ def quote_sheet_name(sheet_name: str):
     return f"'{sheet_name}'"
 
 
+def freeze_tree(tree: lark.Tree) -> lark.Tree:
+    '''
+    Make a newly built formula tree immutable by storing the children of every
+    node as a tuple, and return it. Formula trees are never modified after
+    this; operations like translating a formula build a new tree. This lets
+    cells, copies and pastes share one tree instead of each copying it.
+    '''
+    for subtree in tree.iter_subtrees():
+        subtree.children = tuple(subtree.children)
+    return tree
+
+
 def formula_parse(formula: str):
     if formula_parse.parser is None:
         path = os.path.dirname(__file__)
         formula_parse.parser = lark.Lark.open(
             f'{path}/formulas.lark', start='formula')
-    return formula_parse.parser.parse(formula)
+    return freeze_tree(formula_parse.parser.parse(formula))
 
 formula_parse.parser = None
 
-# pylint: disable=no-self-use
-class _FormulaStringifier(Transformer):
-    def __default_token__(self, token):
-        return str(token)
-
-    def __default__(self, data, children, meta):
-        return reduce(lambda a, b: a + b, children, "")
+def _write_formula(tree: lark.Tree, out: List[Union[str, lark.Tree]]) -> None:
+    # Append the text of a formula tree to `out`. Cell and range references
+    # are appended as their trees, so that callers can decide how to write
+    # them.
+    if not isinstance(tree, lark.Tree):
+        out.append(str(tree))
+        return
+    children = tree.children
+    if tree.data in ('cell', 'cell_range'):
+        out.append(tree)
+    elif tree.data == 'concat_expr':
+        _write_formula(children[0], out)
+        out.append('&')
+        _write_formula(children[1], out)
+    elif tree.data == 'parens':
+        out.append('(')
+        _write_formula(children[0], out)
+        out.append(')')
+    elif tree.data == 'expr_list':
+        _write_formula(children[0], out)
+        if len(children) == 2:
+            out.append(',')
+            _write_formula(children[1], out)
+    elif tree.data == 'function_call':
+        out.append(str(children[0]) + '(')
+        if len(children) == 2:
+            _write_formula(children[1], out)
+        out.append(')')
+    else:
+        for child in children:
+            _write_formula(child, out)
 
-    def concat_expr(self, children):
-        return children[0] + '&' + children[1]
 
-    def parens(self, children):
-        return '(' + children[0] + ')'
+def _reference_to_string(tree: lark.Tree) -> str:
+    if tree.data == 'cell_range':
+        refs = str(tree.children[-2]) + ':' + str(tree.children[-1])
+    else:
+        refs = str(tree.children[-1])
+    if len(tree.children) > (2 if tree.data == 'cell_range' else 1):
+        return str(tree.children[0]) + '!' + refs
+    return refs
 
-    def expr_list(self, children):
-        if len(children) == 2:
-            return children[0] + "," + children[1]
-        return children[0]
 
-    def function_call(self, children):
-        if len(children) == 2:
-            return children[0] + "(" + children[1] + ")"
-        return children[0] + "()"
+def formula_to_string(tree: lark.Tree):
+    pieces = []
+    _write_formula(tree, pieces)
+    return '=' + ''.join(
+        piece if isinstance(piece, str) else _reference_to_string(piece) for piece in pieces)
 
-    def cell(self, children):
-        if len(children) == 2:
-            return children[0] + '!' + children[1]
-        return children[0]
 
+class ReferenceSplicer:
+    '''
+    ReferenceSplicer holds the text of a formula split around its cell and
+    range references. The text of the formula translated by an offset is
+    produced by splicing the translated references back between the pieces,
+    without transforming the tree or parsing any reference again. The result
+    is the same as formula_to_string() of the translated tree.
+    '''
+    def __init__(self, tree: lark.Tree):
+        # _text has one more piece than _refs; reference i is written between
+        # _text[i] and _text[i + 1].
+        self._text: List[str] = []
+        self._refs: List[Tuple[str, List[Tuple[bool, int, bool, int]]]] = []
+        pieces = []
+        _write_formula(tree, pieces)
+        current = ['=']
+        for piece in pieces:
+            if isinstance(piece, str):
+                current.append(piece)
+                continue
+            self._text.append(''.join(current))
+            current = []
+            num_refs = 2 if piece.data == 'cell_range' else 1
+            prefix = ''
+            if len(piece.children) > num_refs:
+                prefix = str(piece.children[0]) + '!'
+            refs = []
+            for ref in piece.children[-num_refs:]:
+                ((lock_col, col), (lock_row, row)) = _reference_template(str(ref), (0, 0))
+                refs.append((lock_col, col, lock_row, row))
+            self._refs.append((prefix, refs))
+        self._text.append(''.join(current))
 
-def formula_to_string(tree: lark.Tree):
-    return '=' + _FormulaStringifier().transform(tree)
+    def translated(self, offset: Tuple[int, int]) -> str:
+        out = [self._text[0]]
+        for (prefix, refs), text in zip(self._refs, self._text[1:]):
+            translated = []
+            for (lock_col, col, lock_row, row) in refs:
+                if not lock_col:
+                    col += offset[0]
+                if not lock_row:
+                    row += offset[1]
+                if 0 >= col or col > column_to_number('ZZZZ') or 0 >= row or row > 9999:
+                    translated = None
+                    break
+                translated.append(f"{'$' if lock_col else ''}{number_to_column(col)}"
+                                  f"{'$' if lock_row else ''}{row}")
+            # A reference that leaves the sheet is replaced by #REF!, along
+            # with its sheet name and the other corner of a range.
+            out.append('#REF!' if translated is None else prefix + ':'.join(translated))
+            out.append(text)
+        return ''.join(out)
 
 
 class _RenameSheetTransformer(Transformer):
@@ -77,15 +158,33 @@ class _RenameSheetTransformer(Transformer):
             return lark.Tree('cell', [sheet_name, children[1]])
         return lark.Tree('cell', children)
 
+    def cell_range(self, children):
+        if len(children) == 3:
+            sheet_name = str(children[0])
+            if children[0].type == 'QUOTED_SHEET_NAME':
+                sheet_name = sheet_name[1:-1]
+            if self.old.lower() == sheet_name.lower():
+                sheet_name = self.new
+            sheet_name = quote_sheet_name(sheet_name)
+            return lark.Tree('cell_range', [sheet_name, *children[1:]])
+        return lark.Tree('cell_range', children)
+
 class _TranslateTransformer(Transformer):
     def __init__(self, offset: Tuple[int, int]):
         super().__init__()
         self.offset = offset
 
     def cell(self, children):
-        if len(children) == 2:
-            return lark.Tree('cell', [children[0], translate_cell_ref(children[1], self.offset)])
-        return lark.Tree('cell', [translate_cell_ref(children[0], self.offset)])
+        ref = translate_cell_ref(children[-1], self.offset)
+        if ref == "#REF!":
+            return lark.Tree('error', [ref])
+        return lark.Tree('cell', [*children[:-1], ref])
+
+    def cell_range(self, children):
+        refs = [translate_cell_ref(ref, self.offset) for ref in children[-2:]]
+        if "#REF!" in refs:
+            return lark.Tree('error', ["#REF!"])
+        return lark.Tree('cell_range', [*children[:-2], *refs])
 
 class _SheetDependenciesVisitor(Visitor):
     def __init__(self, dependencies: Set[str]):
@@ -96,6 +195,11 @@ class _SheetDependenciesVisitor(Visitor):
             sheet = get_sheet_name(tree)
             self.dependencies.add(sheet.lower())
 
+    def cell_range(self, tree):
+        if len(tree.children) == 3:
+            sheet = get_sheet_name(tree)
+            self.dependencies.add(sheet.lower())
+
 def formula_rename_sheet(tree: lark.Tree, old: str, new: str):
     sheet_dependencies = set()
     _SheetDependenciesVisitor(sheet_dependencies).visit(tree)
@@ -103,6 +207,57 @@ def formula_rename_sheet(tree: lark.Tree, old: str, new: str):
         tree = _RenameSheetTransformer(old, new).transform(tree)
     return formula_to_string(tree)
 
+def formula_translate_tree(tree: lark.Tree, offset: Tuple[int, int]) -> lark.Tree:
+    return freeze_tree(_TranslateTransformer(offset).transform(tree))
+
 def formula_translate(tree: lark.Tree, offset: Tuple[int, int]) -> Tuple[str, lark.Tree]:
-    tree = _TranslateTransformer(offset).transform(tree)
+    tree = formula_translate_tree(tree, offset)
     return (formula_to_string(tree), tree)
+
+
+def _reference_template(cell_ref: str, origin: Tuple[int, int]) -> Hashable:
+    # Return a cell reference in R1C1 form: each of the column and the row is
+    # an (is_absolute, value) pair where relative values are offsets from the
+    # origin.
+    match = re.match(r"^(\$?)([A-Za-z]+)(\$?)([1-9][0-9]*)$", cell_ref)
+    if match is None:
+        return cell_ref
+    col = column_to_number(match.group(2).upper())
+    row = int(match.group(4))
+    lock_col = len(match.group(1)) > 0
+    lock_row = len(match.group(3)) > 0
+    return ((lock_col, col if lock_col else col - origin[0]),
+            (lock_row, row if lock_row else row - origin[1]))
+
+def resolve_reference(ref: Hashable, origin: Tuple[int, int]) -> Optional[Tuple[int, int]]:
+    # Return the coordinates an R1C1 reference points to from the cell at
+    # `origin`, or None if they fall outside the valid area of a sheet.
+    if not isinstance(ref, tuple):
+        return None
+    ((lock_col, col), (lock_row, row)) = ref
+    coords = (col if lock_col else origin[0] + col, row if lock_row else origin[1] + row)
+    if 0 >= coords[0] or coords[0] > column_to_number('ZZZZ') \
+            or 0 >= coords[1] or coords[1] > 9999:
+        return None
+    return coords
+
+def formula_template(tree: lark.Tree, origin: Tuple[int, int]) -> Hashable:
+    '''
+    Return a hashable, R1C1-normalized template of a formula tree for the cell
+    at `origin`. Relative references are replaced by their offset from the
+    origin, so formulas filled down or across a range (e.g. `=B2*C2` in D2 and
+    `=B3*C3` in D3) have equal templates.
+    '''
+    if not isinstance(tree, lark.Tree):
+        return str(tree)
+    if tree.data in ('cell', 'cell_range'):
+        num_refs = 2 if tree.data == 'cell_range' else 1
+        sheet = None
+        if len(tree.children) > num_refs:
+            sheet = str(tree.children[0])
+            if sheet.startswith("'"):
+                sheet = sheet[1:-1]
+            sheet = sheet.lower()
+        refs = [_reference_template(str(ref), origin) for ref in tree.children[-num_refs:]]
+        return (str(tree.data), sheet, *refs)
+    return (str(tree.data), *(formula_template(c, origin) for c in tree.children))
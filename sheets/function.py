@@ -1,8 +1,11 @@
 
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Optional, Union
+import decimal
 from sheets.cell_error import CellError, CellErrorType
 from sheets.formula import formula_parse
-from .utils import convert_to_bool, convert_to_decimal, convert_to_str, cell_range_to_list
+from .cell_range import CellRange
+from .criteria import Criteria
+from .utils import convert_to_bool, convert_to_decimal, convert_to_str
 from .version import version
 
 def _and(args) -> Any:
@@ -68,11 +71,11 @@ def _if(args) -> Any:
 def _iferror(args) -> Any:
     if len(args) not in [1, 2]:
         return CellError(CellErrorType.TYPE_ERROR, "IFERROR requires 1 or 2 arguments")
-    value1 = convert_to_bool(args[0]())
+    value1 = args[0]()
     if not isinstance(value1, CellError):
         return value1
     if len(args) == 2:
-        return args[2]()
+        return args[1]()
     return ""
 
 def _choose(args) -> Any:
@@ -117,46 +120,174 @@ def _indirect(args) -> Any:
         return CellError(CellErrorType.TYPE_ERROR, "invalid cell reference")
     return tree
 
+def _numbers(args) -> Any:
+    # Flatten the arguments of an aggregate function into a list of numbers.
+    # Values inside of ranges that are not numbers are skipped; other
+    # arguments are converted to numbers. Errors are returned immediately.
+    numbers = []
+    for arg in args:
+        value = arg()
+        if isinstance(value, CellRange):
+            for v in value.values():
+                if isinstance(v, CellError):
+                    return v
+                if isinstance(v, decimal.Decimal):
+                    numbers.append(v)
+            continue
+        value = convert_to_decimal(value)
+        if isinstance(value, CellError):
+            return value
+        numbers.append(value)
+    return numbers
+
 def _min(args) -> Any:
     if len(args) < 1:
         return CellError(CellErrorType.TYPE_ERROR, "MIN requires at least 1 argument")
-    value = convert_to_decimal(args[0]())
-    if isinstance(value, CellError):
-        return value
-    
-    minimum = min(args)
-    return minimum
+    numbers = _numbers(args)
+    if isinstance(numbers, CellError):
+        return numbers
+    return min(numbers, default=decimal.Decimal(0))
 
 def _max(args) -> Any:
     if len(args) < 1:
         return CellError(CellErrorType.TYPE_ERROR, "MAX requires at least 1 argument")
-    value = convert_to_decimal(args[0]())
-    if isinstance(value, CellError):
-        return value
-    
-    maximum = max(args)
-    return maximum
+    numbers = _numbers(args)
+    if isinstance(numbers, CellError):
+        return numbers
+    return max(numbers, default=decimal.Decimal(0))
 
 def _sum(args) -> Any:
     if len(args) < 1:
         return CellError(CellErrorType.TYPE_ERROR, "SUM requires at least 1 argument")
-    value = convert_to_decimal(args[0]())
-    if isinstance(value, CellError):
-        return value
-    
-    summation = sum(args)
-    return summation
+    numbers = _numbers(args)
+    if isinstance(numbers, CellError):
+        return numbers
+    return sum(numbers, decimal.Decimal(0))
 
 def _average(args) -> Any:
     if len(args) < 1:
         return CellError(CellErrorType.TYPE_ERROR, "AVERAGE requires at least 1 argument")
-    value = convert_to_decimal(args[0]())
-    if isinstance(value, CellError):
-        return value
-    
-    avg = sum(args) / len(args)
-    return avg
+    numbers = _numbers(args)
+    if isinstance(numbers, CellError):
+        return numbers
+    if len(numbers) == 0:
+        return CellError(CellErrorType.DIVIDE_BY_ZERO, "AVERAGE of no numbers")
+    return sum(numbers, decimal.Decimal(0)) / len(numbers)
+
+def _criteria_args(name: str, cell_range: Any, criteria: Any, *other_ranges: Any) -> Any:
+    # Validate the range and criteria arguments of a conditional aggregate and
+    # return the parsed criteria.
+    for r in (cell_range, *other_ranges):
+        if isinstance(r, CellError):
+            return r
+        if not isinstance(r, CellRange):
+            return CellError(CellErrorType.TYPE_ERROR, f"{name} requires a cell range")
+        if r.shape() != cell_range.shape():
+            return CellError(CellErrorType.TYPE_ERROR, f"{name} ranges must have the same shape")
+    return Criteria.parse(criteria)
+
+def _sumif(args) -> Any:
+    if len(args) not in [2, 3]:
+        return CellError(CellErrorType.TYPE_ERROR, "SUMIF requires 2 or 3 arguments")
+    cell_range = args[0]()
+    sum_range = args[2]() if len(args) == 3 else cell_range
+    criteria = _criteria_args("SUMIF", cell_range, args[1](), sum_range)
+    if isinstance(criteria, CellError):
+        return criteria
+    (total, _) = cell_range.criteria_index().aggregate(criteria, sum_range)
+    return total
 
+def _countif(args) -> Any:
+    if len(args) != 2:
+        return CellError(CellErrorType.TYPE_ERROR, "COUNTIF requires exactly 2 arguments")
+    cell_range = args[0]()
+    criteria = _criteria_args("COUNTIF", cell_range, args[1]())
+    if isinstance(criteria, CellError):
+        return criteria
+    return decimal.Decimal(cell_range.criteria_index().count(criteria))
+
+def _averageif(args) -> Any:
+    if len(args) not in [2, 3]:
+        return CellError(CellErrorType.TYPE_ERROR, "AVERAGEIF requires 2 or 3 arguments")
+    cell_range = args[0]()
+    average_range = args[2]() if len(args) == 3 else cell_range
+    criteria = _criteria_args("AVERAGEIF", cell_range, args[1](), average_range)
+    if isinstance(criteria, CellError):
+        return criteria
+    (total, count) = cell_range.criteria_index().aggregate(criteria, average_range)
+    if isinstance(total, CellError):
+        return total
+    if count == 0:
+        return CellError(CellErrorType.DIVIDE_BY_ZERO, "AVERAGEIF matched no numbers")
+    return total / count
+
+def _sumifs(args) -> Any:
+    if len(args) < 3 or len(args) % 2 != 1:
+        return CellError(CellErrorType.TYPE_ERROR,
+            "SUMIFS requires a sum range followed by range/criteria pairs")
+    sum_range = args[0]()
+    if isinstance(sum_range, CellError):
+        return sum_range
+    matched = None
+    for i in range(1, len(args), 2):
+        cell_range = args[i]()
+        criteria = _criteria_args("SUMIFS", cell_range, args[i + 1](), sum_range)
+        if isinstance(criteria, CellError):
+            return criteria
+        positions = cell_range.criteria_index().matching(criteria)
+        matched = set(positions) if matched is None else matched & positions
+    total = decimal.Decimal(0)
+    for offset in sorted(matched, key=lambda o: (o[1], o[0])):
+        value = sum_range.value_at(offset)
+        if isinstance(value, CellError):
+            return value
+        if isinstance(value, decimal.Decimal):
+            total += value
+    return total
+
+
+
+_RANGE_FUNCTIONS = {
+    'min', 'max', 'sum', 'average', 'sumif', 'countif', 'averageif', 'sumifs',
+}
+
+# Every function by lower-case name, with the minimum and maximum number of
+# arguments it accepts (None if there is no maximum).
+_FUNCTIONS = {
+    'and': (_and, 1, None),
+    'or': (_or, 1, None),
+    'not': (_not, 1, 1),
+    'xor': (_xor, 1, None),
+    'exact': (_exact, 2, 2),
+    'if': (_if, 2, 3),
+    'iferror': (_iferror, 1, 2),
+    'choose': (_choose, 2, None),
+    'iserror': (_iserror, 1, 1),
+    'isblank': (_isblank, 1, 1),
+    'version': (_version, 0, 0),
+    'indirect': (_indirect, 1, 1),
+    'min': (_min, 1, None),
+    'max': (_max, 1, None),
+    'sum': (_sum, 1, None),
+    'average': (_average, 1, None),
+    'sumif': (_sumif, 2, 3),
+    'countif': (_countif, 2, 2),
+    'averageif': (_averageif, 2, 3),
+    'sumifs': (_sumifs, 3, None),
+}
+
+
+class BoundFunction:
+    '''
+    BoundFunction is a function call whose implementation was looked up, and
+    whose number of arguments was checked, when the formula was compiled.
+    '''
+    __slots__ = ('name', 'func', 'accepts_ranges')
+
+    def __init__(self, name: str, func: Callable, accepts_ranges: bool):
+        self.name = name
+        self.func = func
+        self.accepts_ranges = accepts_ranges
 
 
 class FunctionRegistry():
@@ -164,29 +295,25 @@ class FunctionRegistry():
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
             cls._instance = super(FunctionRegistry, cls).__new__(cls, *args, **kwargs)
+            cls._instance.funcs = {name: f[0] for name, f in _FUNCTIONS.items()}
         return cls._instance
 
-    def __init__(self):
-        self.funcs = {
-            'and': _and,
-            'or': _or,
-            'not': _not,
-            'xor': _xor,
-            'exact': _exact,
-            'if': _if,
-            'iferror': _iferror,
-            'choose': _choose,
-            'iserror': _iserror,
-            'isblank': _isblank,
-            'version': _version,
-            'indirect': _indirect,
-            'min': _min,
-            'max': _max,
-            'sum': _sum,
-            'average': _average,
-        }
-
     def find(self, name: str) -> Optional[Callable]:
-        if name.lower() not in self.funcs:
-            return None
-        return self.funcs[name.lower()]
+        return self.funcs.get(name.lower())
+
+    def accepts_ranges(self, name: str) -> bool:
+        # Return true if the function accepts cell ranges such as `A1:B5` as
+        # arguments. Ranges passed to any other function are a TYPE_ERROR.
+        return name.lower() in _RANGE_FUNCTIONS
+
+    def bind(self, name: str, num_args: int) -> Union[BoundFunction, CellError]:
+        # Look up the function called by a formula. Returns the error value of
+        # the call instead if the function does not exist or cannot take
+        # `num_args` arguments.
+        if name.lower() not in _FUNCTIONS:
+            return CellError(CellErrorType.BAD_NAME, f'function "{name}" not found')
+        (func, min_args, max_args) = _FUNCTIONS[name.lower()]
+        if num_args < min_args or (max_args is not None and num_args > max_args):
+            return CellError(CellErrorType.TYPE_ERROR,
+                             f"{name.upper()} cannot take {num_args} arguments")
+        return BoundFunction(name.upper(), func, self.accepts_ranges(name))
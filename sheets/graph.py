@@ -74,24 +74,28 @@ class Graph(Generic[T]):
 
         # Perform a depth first traversal of the graph rooted at
         # vertex v. Do not visit any vertices that have already
-        # been visited.
+        # been visited. A vertex is emitted once all of its out
+        # neighbors have been emitted.
         def visit(v):
-            stack = [v]
-            reversed_post_order = []
+            result = []
+            visited[v] = True
+            stack = [(v, iter(self.out_neighbors(v)))]
             while len(stack) != 0:
-                v = stack[-1]
-                stack.pop()
-                if not visited[v]:
-                    reversed_post_order.append(v)
-                    visited[v] = True
-                    for u in self.out_neighbors(v):
-                        if not visited[u]:
-                            stack.append(u)
-            return reversed_post_order[::-1]
+                (v, neighbors) = stack[-1]
+                for u in neighbors:
+                    if not visited[u]:
+                        visited[u] = True
+                        stack.append((u, iter(self.out_neighbors(u))))
+                        break
+                else:
+                    stack.pop()
+                    result.append(v)
+            return result
         # Perform a depth-first traversal rooted at each vertex to ensure
         # that all vertices are visited once.
         for v in self.vertices():
-            post_order += visit(v)
+            if not visited[v]:
+                post_order += visit(v)
 
         return post_order
 
@@ -215,6 +219,7 @@ class Graph(Generic[T]):
         return self.subgraph(subgraph)
 
     def subgraph(self, vertices) -> 'Graph':
+        vertices = set(vertices)
         subgraph_adjacency_list = {}
         for u in self.adjacency_list:
             if u in vertices:
@@ -0,0 +1,179 @@
+'''
+Append-only journals of workbook operations.
+
+A journal is a text file of JSON lines. The first line is a header naming
+the checkpoint the journal applies to: the SHA-256 hash of the snapshot file
+holding the state of the workbook when the journal was started, or null if
+the journal starts from an empty workbook. Every other line is one operation,
+
+    [method name, positional arguments, keyword arguments]
+
+with the keyword arguments left out when there are none. Decimal arguments
+are written as {"$decimal": text}.
+
+Records are handed to the operating system as soon as they are appended, and
+forced to disk with fsync after every `sync_every` records, so a crash loses
+at most the records appended since the last sync. A record that was only
+partly written when the process stopped is dropped when the journal is
+opened again.
+'''
+import decimal
+import hashlib
+import json
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Version of the journal format. Journals with any other version are rejected.
+VERSION = 1
+
+# One operation of a journal: method name, arguments and keyword arguments.
+JournalRecord = Tuple[str, List[Any], Dict[str, Any]]
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, decimal.Decimal):
+        return {"$decimal": str(value)}
+    raise TypeError(f"Cannot journal a value of type {type(value).__name__}")
+
+
+def _decode(obj: Dict[str, Any]) -> Any:
+    if len(obj) == 1 and "$decimal" in obj:
+        return decimal.Decimal(obj["$decimal"])
+    return obj
+
+
+def file_hash(path: str) -> Optional[str]:
+    # Return the SHA-256 hash of the file at `path`, or None if there is no
+    # such file.
+    h = hashlib.sha256()
+    try:
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b''):
+                h.update(chunk)
+    except FileNotFoundError:
+        return None
+    return h.hexdigest()
+
+
+def sync_directory(path: str) -> None:
+    # Force the entry of the file at `path` in its directory to disk, e.g.
+    # after the file was renamed. Not every platform can open a directory.
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class Journal:
+    '''
+    Journal is an open journal file that records are appended to.
+    '''
+    def __init__(self, path: str, sync_every: int = 1):
+        if sync_every < 1:
+            raise ValueError("sync_every must be at least 1")
+        self._path = path
+        self._sync_every = sync_every
+        self._unsynced = 0
+        self._fd: Optional[int] = None
+        self._checkpoint: Optional[str] = None
+        self._records: List[JournalRecord] = []
+        # Number of records appended since the journal was started.
+        self.length = 0
+        if os.path.exists(path):
+            self.__read()
+        else:
+            self.reset(None)
+
+    def __read(self) -> None:
+        # Read the header and the records of an existing journal, dropping a
+        # partly written last record.
+        with open(self._path, 'rb') as fp:
+            data = fp.read()
+        lines = data.split(b'\n')
+        # Everything after the last newline was not completely written.
+        complete = len(data) - len(lines[-1])
+        try:
+            header = json.loads(lines[0]) if len(lines) > 1 else None
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get("journal") != VERSION:
+            raise ValueError(f"{self._path} is not a workbook journal")
+        self._checkpoint = header.get("checkpoint")
+        for (i, line) in enumerate(lines[1:-1]):
+            try:
+                record = json.loads(line, object_hook=_decode)
+            except ValueError as e:
+                raise ValueError(f"Corrupt record {i + 1} in journal {self._path}") from e
+            if isinstance(record, list) and len(record) == 2:
+                record.append({})
+            if not isinstance(record, list) or len(record) != 3 or \
+                    not isinstance(record[0], str) or not isinstance(record[1], list) or \
+                    not isinstance(record[2], dict):
+                raise ValueError(f"Corrupt record {i + 1} in journal {self._path}")
+            self._records.append((record[0], record[1], record[2]))
+        self.length = len(self._records)
+        self._fd = os.open(self._path, os.O_WRONLY)
+        os.ftruncate(self._fd, complete)
+        os.lseek(self._fd, complete, os.SEEK_SET)
+
+    def checkpoint(self) -> Optional[str]:
+        # Return the hash of the snapshot the journal applies to, or None if
+        # it applies to an empty workbook.
+        return self._checkpoint
+
+    def records(self) -> Iterator[JournalRecord]:
+        # Iterate over the records read when the journal was opened.
+        records = self._records
+        self._records = []
+        return iter(records)
+
+    def append(self, name: str, args: List[Any], kwargs: Dict[str, Any]) -> None:
+        record = [name, args, kwargs] if kwargs else [name, args]
+        line = json.dumps(record, default=_encode, separators=(',', ':')) + '\n'
+        data = line.encode('utf-8', 'surrogatepass')
+        while data:
+            data = data[os.write(self._fd, data):]
+        self.length += 1
+        self._unsynced += 1
+        if self._unsynced >= self._sync_every:
+            self.sync()
+
+    def sync(self) -> None:
+        # Force the records appended so far to disk.
+        if self._unsynced:
+            os.fsync(self._fd)
+            self._unsynced = 0
+
+    def reset(self, checkpoint: Optional[str]) -> None:
+        # Start the journal over from the snapshot with the given hash. The
+        # new journal replaces the old one atomically.
+        tmp = self._path + '.tmp'
+        header = json.dumps({"journal": VERSION, "checkpoint": checkpoint}) + '\n'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            os.write(fd, header.encode('ascii'))
+            os.fsync(fd)
+        except BaseException:
+            os.close(fd)
+            raise
+        os.replace(tmp, self._path)
+        sync_directory(self._path)
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = fd
+        self._checkpoint = checkpoint
+        self._records = []
+        self._unsynced = 0
+        self.length = 0
+
+    def close(self) -> None:
+        if self._fd is not None:
+            self.sync()
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,236 @@
+'''
+Incremental reading of JSON documents from text file objects.
+
+JsonReader reads a document a chunk at a time and lets the caller walk it
+value by value: objects and arrays are iterated over one member at a time,
+so a large document never has to be held in memory as a whole. Only the
+values the caller reads with read_value() are decoded into Python objects.
+
+Malformed input raises json.JSONDecodeError, as json.load would.
+
+The reader keeps track of where it is in the file in UTF-8 bytes, so that a
+caller can index a document once and come back to a value later by seeking
+to its offset.
+
+JsonWriter is the other direction: it buffers the text of a document being
+written piece by piece and passes it on to the file in chunks.
+'''
+import json
+import json.decoder
+import json.encoder
+import json.scanner
+from typing import Any, Iterator, List, TextIO
+
+_WHITESPACE = ' \t\n\r'
+
+# Characters that may be part of a JSON number.
+_NUMBER_CHARS = set('0123456789+-.eE')
+
+
+class JsonReader:
+    '''
+    JsonReader is a pull parser over a JSON document in a text file object.
+    Values must be consumed in document order: after iter_object() yields a
+    key, or iter_array() yields for an element, the caller reads that value
+    (with read_value() or by iterating over it) before continuing.
+    '''
+    def __init__(self, fp: TextIO, chunk_size: int = 1 << 16):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        # Length in UTF-8 bytes of the text before the buffer.
+        self._consumed = 0
+
+    def __fill(self) -> bool:
+        # Read another chunk into the buffer, dropping the part that has
+        # been consumed. Returns false at the end of the file.
+        if self._eof:
+            return False
+        chunk = self._fp.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._consumed += len(self._buffer[:self._pos].encode('utf-8', 'surrogatepass'))
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def __error(self, msg: str) -> json.JSONDecodeError:
+        return json.JSONDecodeError(msg, self._buffer, self._pos)
+
+    def peek(self) -> str:
+        # Return the next character that is not whitespace without consuming
+        # it, or '' at the end of the document.
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self.__fill():
+                return ''
+
+    def tell(self) -> int:
+        # Return the offset in UTF-8 bytes of the next character that is not
+        # whitespace.
+        self.peek()
+        return self._consumed + len(self._buffer[:self._pos].encode('utf-8', 'surrogatepass'))
+
+    def __expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise self.__error(f"Expecting '{char}'")
+        self._pos += 1
+
+    def __ensure(self, count: int) -> None:
+        # Make sure the buffer holds at least `count` unconsumed characters,
+        # unless the file ends first.
+        while len(self._buffer) - self._pos < count and self.__fill():
+            pass
+
+    def iter_object(self) -> Iterator[str]:
+        # Iterate over the keys of the object that comes next.
+        self.__expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            if self.peek() != '"':
+                raise self.__error("Expecting property name enclosed in double quotes")
+            key = self.__read_string()
+            self.__expect(':')
+            yield key
+            char = self.peek()
+            self._pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                self._pos -= 1
+                raise self.__error("Expecting ',' delimiter")
+
+    def iter_array(self) -> Iterator[None]:
+        # Iterate over the elements of the array that comes next.
+        self.__expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield None
+            char = self.peek()
+            self._pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                self._pos -= 1
+                raise self.__error("Expecting ',' delimiter")
+
+    def read_value(self) -> Any:
+        # Read and decode the value that comes next.
+        char = self.peek()
+        if char == '{':
+            result = {}
+            for key in self.iter_object():
+                result[key] = self.read_value()
+            return result
+        if char == '[':
+            return [self.read_value() for _ in self.iter_array()]
+        if char == '"':
+            return self.__read_string()
+        if char == '-' or char.isdigit():
+            return self.__read_number()
+        for (text, value) in (('true', True), ('false', False), ('null', None)):
+            if char == text[0]:
+                self.__ensure(len(text))
+                if self._buffer.startswith(text, self._pos):
+                    self._pos += len(text)
+                    return value
+        raise self.__error("Expecting value")
+
+    def skip_value(self) -> None:
+        # Consume the value that comes next without building it.
+        char = self.peek()
+        if char == '{':
+            for _ in self.iter_object():
+                self.skip_value()
+        elif char == '[':
+            for _ in self.iter_array():
+                self.skip_value()
+        else:
+            self.read_value()
+
+    def end(self) -> None:
+        # Check that nothing but whitespace follows the document.
+        if self.peek() != '':
+            raise self.__error("Extra data")
+
+    def __read_string(self) -> str:
+        # Make sure the closing quote of the string is in the buffer, then
+        # let the json module decode it.
+        end = self._pos + 1
+        while True:
+            end = self._buffer.find('"', end)
+            if end == -1:
+                end = len(self._buffer)
+                start = self._pos
+                if not self.__fill():
+                    break
+                end -= start
+                continue
+            backslashes = 0
+            while self._buffer[end - 1 - backslashes] == '\\':
+                backslashes += 1
+            if backslashes % 2 == 0:
+                break
+            end += 1
+        (value, self._pos) = json.decoder.scanstring(self._buffer, self._pos + 1)
+        return value
+
+    def __read_number(self) -> Any:
+        # Make sure the whole number is in the buffer, then decode it the
+        # same way as the json module.
+        end = self._pos
+        while True:
+            while end < len(self._buffer) and self._buffer[end] in _NUMBER_CHARS:
+                end += 1
+            if end < len(self._buffer):
+                break
+            start = self._pos
+            if not self.__fill():
+                break
+            end -= start
+        match = json.scanner.NUMBER_RE.match(self._buffer, self._pos)
+        if match is None:
+            raise self.__error("Expecting value")
+        (integer, frac, exp) = match.groups()
+        self._pos = match.end()
+        if frac or exp:
+            return float(integer + (frac or '') + (exp or ''))
+        return int(integer)
+
+
+class JsonWriter:
+    '''
+    JsonWriter writes a JSON document to a text file object in chunks of
+    about `chunk_size` characters. Strings are encoded the same way as by
+    json.dumps with its default settings.
+    '''
+    def __init__(self, fp: TextIO, chunk_size: int = 1 << 16):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._pieces: List[str] = []
+        self._size = 0
+
+    def write(self, text: str) -> None:
+        self._pieces.append(text)
+        self._size += len(text)
+        if self._size >= self._chunk_size:
+            self.flush()
+
+    def write_string(self, value: str) -> None:
+        self.write(json.encoder.encode_basestring_ascii(value))
+
+    def flush(self) -> None:
+        if self._pieces:
+            self._fp.write(''.join(self._pieces))
+            self._pieces = []
+            self._size = 0
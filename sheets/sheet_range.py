@@ -1,23 +1,139 @@
-from copy import deepcopy
-from typing import Dict, Optional, Tuple
+from typing import Dict, Hashable, List, Optional, Tuple
 import lark
-from sheets.formula import formula_parse, formula_translate
+from lark import LarkError
+from sheets.formula import ReferenceSplicer, formula_parse, formula_template, \
+    formula_translate, formula_translate_tree, resolve_reference
 from sheets.utils import column_to_number
 
+# A reference of a formula resolved for one cell: the sheet name (None for
+# the cell's own sheet) and the top-left and bottom-right coordinates.
+ResolvedReference = Tuple[Optional[str], Tuple[int, int], Tuple[int, int]]
+
+
+class SharedFormula:
+    '''
+    SharedFormula is a formula shared by a block of cells, e.g. the cells a
+    formula was copied or filled into. The formula is stored once together
+    with the location of the cell it was written for. Every other cell of the
+    block only stores its own location; its contents and tree are produced by
+    translating the shared formula when they are needed.
+    '''
+    def __init__(self, contents: str, tree: lark.Tree, origin: Tuple[int, int]):
+        self._contents = contents
+        self._tree = tree
+        self._origin = origin
+        self._template = None
+        self._references = None
+        self._splicer = None
+
+    def template(self) -> Hashable:
+        # The R1C1 template of the formula, which is the same for every cell
+        # whose references all stay within the sheet.
+        if self._template is None:
+            self._template = formula_template(self._tree, self._origin)
+        return self._template
+
+    def references(self, origin: Tuple[int, int]) -> Optional[List[ResolvedReference]]:
+        # Return the references of the formula for the cell at `origin`, or
+        # None if any of them would fall outside the sheet (and be replaced by
+        # #REF! in the translated formula).
+        if self._references is None:
+            self._references = _template_references(self.template(), [])
+        result = []
+        for (sheet, *refs) in self._references:
+            coords = [resolve_reference(ref, origin) for ref in refs]
+            if None in coords:
+                return None
+            start = (min(c[0] for c in coords), min(c[1] for c in coords))
+            end = (max(c[0] for c in coords), max(c[1] for c in coords))
+            result.append((sheet, start, end))
+        return result
+
+    def contents_at(self, origin: Tuple[int, int]) -> str:
+        # Return the contents of the formula for the cell at origin.
+        if self._splicer is None:
+            self._splicer = ReferenceSplicer(self._tree)
+        return self._splicer.translated(self.__offset(origin))
+
+    def tree_at(self, origin: Tuple[int, int]) -> lark.Tree:
+        # Return the tree of the formula for the cell at origin.
+        return formula_translate_tree(self._tree, self.__offset(origin))
+
+    def __offset(self, origin: Tuple[int, int]) -> Tuple[int, int]:
+        return (origin[0] - self._origin[0], origin[1] - self._origin[1])
+
+
+def _template_references(template: Hashable, result: List[Tuple]) -> List[Tuple]:
+    # Collect the (sheet, *R1C1 references) of every cell and range in a
+    # formula template. References that are already #REF! are skipped.
+    if not isinstance(template, tuple):
+        return result
+    if template[0] in ('cell', 'cell_range'):
+        if all(isinstance(ref, tuple) for ref in template[2:]):
+            result.append(template[1:])
+        return result
+    for child in template[1:]:
+        _template_references(child, result)
+    return result
+
+
 class Contents:
     '''
     Contents represents the contents of a cell. The contents object has no
-    mutating methods, so it is safe to be referenced by many different cells.
-    The Contents object
+    mutating methods and formula trees are immutable, so it is safe to be
+    referenced by many different cells.
+
+    Formula contents that know the location of their cell are translated
+    lazily: translated() returns a Contents referring to a SharedFormula and
+    the new location, and the formula is only re-written when the string or
+    tree is asked for.
     '''
-    def __init__(self, contents: str, tree: Optional[lark.Tree]):
+    def __init__(self, contents: str, tree: Optional[lark.Tree],
+                 origin: Optional[Tuple[int, int]] = None):
         self._contents = contents
         self._tree = tree
+        self._origin = origin
+        self._shared = None
         if self._tree is None and self._contents.startswith("="):
-            self._tree = formula_parse(self._contents)
+            try:
+                self._tree = formula_parse(self._contents)
+            except LarkError:
+                pass
+
+    @staticmethod
+    def shared(formula: SharedFormula, origin: Tuple[int, int]) -> 'Contents':
+        # Return the contents of the cell at `origin` in a block sharing
+        # `formula`.
+        contents = Contents.__new__(Contents)
+        contents._contents = None
+        contents._tree = None
+        contents._origin = origin
+        contents._shared = formula
+        return contents
+
+    def is_shared(self) -> bool:
+        # Whether the string and tree of these contents have yet to be
+        # produced from a shared formula.
+        return self._contents is None
+
+    def shared_formula(self) -> Optional[SharedFormula]:
+        if self._shared is None and self._tree is not None and self._origin is not None:
+            self._shared = SharedFormula(self._contents, self._tree, self._origin)
+        return self._shared
+
+    def origin(self) -> Optional[Tuple[int, int]]:
+        return self._origin
+
+    def template(self) -> Hashable:
+        return self._shared.template()
+
+    def references(self) -> Optional[List[ResolvedReference]]:
+        return self._shared.references(self._origin)
 
     def tree(self) -> lark.Tree:
-        return deepcopy(self._tree)
+        if self.is_shared():
+            return self._shared.tree_at(self._origin)
+        return self._tree
 
     def translated(self, offset: Tuple[int, int]) -> 'Contents':
         '''
@@ -25,12 +141,23 @@ class Contents:
         Raises:
             ValueError - If the translated cell would be outside ZZZZ9999
         '''
+        formula = self.shared_formula()
+        if formula is not None:
+            origin = (self._origin[0] + offset[0], self._origin[1] + offset[1])
+            if formula.references(self._origin) is not None:
+                return Contents.shared(formula, origin)
+            # Some references of this cell are already #REF!, and must stay
+            # #REF! wherever the cell is copied to.
+            (contents, tree) = formula_translate(self.tree(), offset)
+            return Contents(contents, tree, origin)
         if self._tree is not None:
             (contents, tree) = formula_translate(self._tree, offset)
             return Contents(contents, tree)
         return self
 
     def __str__(self):
+        if self.is_shared():
+            return self._shared.contents_at(self._origin)
         return self._contents
 
 class SheetRange:
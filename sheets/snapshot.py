@@ -0,0 +1,240 @@
+'''
+Binary snapshots of workbooks.
+
+A snapshot stores the contents, the computed value and the dependencies of
+every cell, so that a workbook can be opened again without parsing or
+evaluating any formula. The file is made of sections of fixed-width
+little-endian integers that are read straight out of a memory map:
+
+    header      magic, format version, number of sections
+    table       for every section: tag, offset and length in bytes
+    STRS        string count, end offset of every string, UTF-8 text
+    SHTS        for every sheet: name, index of its first cell, cell count
+    KEYS        packed key of every cell (see utils.coordinates_to_key)
+    CONT        contents of every cell
+    KIND        kind of the value of every cell
+    VALS        value of every cell, interpreted according to its kind
+    DEPO        index of the first dependency of every cell, plus the end
+    DEPS        sheet name and location of every dependency
+
+Sheet names, contents, strings and locations are stored once in STRS and
+referred to by their index. Every section starts at a multiple of 8 bytes.
+'''
+import array
+import decimal
+import mmap
+import struct
+import sys
+from typing import Any, Dict, Iterator, List, Tuple
+
+from .cell_error import CellError, CellErrorType, STANDARD_ERRORS
+
+MAGIC = b'SHTSNAP\0'
+
+# Version of the format written by write_snapshot. Files with any other
+# version are rejected.
+VERSION = 1
+
+_HEADER = struct.Struct('<8sII')
+_SECTION = struct.Struct('<4sQQ')
+_SECTIONS = [b'STRS', b'SHTS', b'KEYS', b'CONT', b'KIND', b'VALS', b'DEPO', b'DEPS']
+
+# Kinds of cell values.
+_NONE = 0
+_NUMBER = 1
+_STRING = 2
+_BOOL = 3
+_ERROR = 4
+
+# One cell of a snapshot: packed key, contents, value and dependencies.
+SnapshotCell = Tuple[int, str, Any, List[Tuple[str, str]]]
+
+
+class _Strings:
+    # Interns the strings of a snapshot being written.
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.values: List[str] = []
+
+    def id(self, value: str) -> int:
+        i = self.ids.get(value)
+        if i is None:
+            i = len(self.values)
+            self.ids[value] = i
+            self.values.append(value)
+        return i
+
+
+def _encode_value(value: Any, strings: _Strings) -> Tuple[int, int]:
+    if value is None:
+        return (_NONE, 0)
+    if isinstance(value, bool):
+        return (_BOOL, int(value))
+    if isinstance(value, decimal.Decimal):
+        return (_NUMBER, strings.id(str(value)))
+    if isinstance(value, CellError):
+        return (_ERROR, strings.id(value.get_detail()) * 8 + value.get_type().value)
+    return (_STRING, strings.id(value))
+
+
+def _int_array(values: Any) -> array.array:
+    result = array.array('q', values)
+    if sys.byteorder != 'little':
+        result.byteswap()
+    return result
+
+
+def write_snapshot(path: str, sheets: List[Tuple[str, List[SnapshotCell]]]) -> None:
+    '''
+    Write a snapshot of the given sheets, each a sheet name and the cells of
+    that sheet, to the file at `path`.
+    '''
+    strings = _Strings()
+    sheet_table = []
+    keys = []
+    contents = []
+    kinds = array.array('B')
+    values = []
+    dependency_offsets = [0]
+    dependencies = []
+    for (name, cells) in sheets:
+        sheet_table.extend((strings.id(name), len(keys), len(cells)))
+        for (key, text, value, cell_dependencies) in cells:
+            keys.append(key)
+            contents.append(strings.id(text))
+            (kind, payload) = _encode_value(value, strings)
+            kinds.append(kind)
+            values.append(payload)
+            for (sheet, location) in cell_dependencies:
+                dependencies.extend((strings.id(sheet), strings.id(location)))
+            dependency_offsets.append(len(dependencies) // 2)
+
+    text = bytearray()
+    ends = []
+    for value in strings.values:
+        text += value.encode('utf-8')
+        ends.append(len(text))
+    sections = [
+        _int_array([len(ends), *ends]).tobytes() + bytes(text),
+        _int_array(sheet_table).tobytes(),
+        _int_array(keys).tobytes(),
+        _int_array(contents).tobytes(),
+        kinds.tobytes(),
+        _int_array(values).tobytes(),
+        _int_array(dependency_offsets).tobytes(),
+        _int_array(dependencies).tobytes(),
+    ]
+
+    offset = _HEADER.size + _SECTION.size * len(sections)
+    table = []
+    for (tag, data) in zip(_SECTIONS, sections):
+        offset += -offset % 8
+        table.append(_SECTION.pack(tag, offset, len(data)))
+        offset += len(data)
+
+    with open(path, 'wb') as fp:
+        fp.write(_HEADER.pack(MAGIC, VERSION, len(sections)))
+        for entry in table:
+            fp.write(entry)
+        for data in sections:
+            fp.write(b'\0' * (-fp.tell() % 8))
+            fp.write(data)
+
+
+class Snapshot:
+    '''
+    Snapshot is an open snapshot file. The sections of the file are used in
+    place through a read-only memory map; strings are decoded the first time
+    they are used.
+    '''
+    def __init__(self, path: str):
+        with open(path, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+        if len(view) < _HEADER.size:
+            raise ValueError("Not a workbook snapshot")
+        (magic, version, count) = _HEADER.unpack_from(view, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a workbook snapshot")
+        if version != VERSION:
+            raise ValueError(f"Unsupported snapshot version {version}")
+        self._sections: Dict[bytes, memoryview] = {}
+        for i in range(count):
+            (tag, offset, length) = _SECTION.unpack_from(view, _HEADER.size + i * _SECTION.size)
+            if offset + length > len(view):
+                raise ValueError("Truncated workbook snapshot")
+            self._sections[tag] = view[offset:offset + length]
+        missing = [tag for tag in _SECTIONS if tag not in self._sections]
+        if missing:
+            raise ValueError(f"Snapshot is missing the {missing[0].decode()} section")
+
+        strings = self.__ints(b'STRS', 1)
+        self._string_count = strings[0]
+        self._string_ends = self.__ints(b'STRS', 1 + self._string_count)[1:]
+        self._text = self._sections[b'STRS'][8 * (1 + self._string_count):]
+        self._strings: List[Any] = [None] * self._string_count
+
+    def __ints(self, tag: bytes, count: int = -1) -> memoryview:
+        data = self._sections[tag]
+        if count >= 0:
+            data = data[:8 * count]
+        if sys.byteorder != 'little':
+            swapped = array.array('q', data.tobytes())
+            swapped.byteswap()
+            return memoryview(swapped)
+        return data.cast('q')
+
+    def string(self, i: int) -> str:
+        value = self._strings[i]
+        if value is None:
+            start = self._string_ends[i - 1] if i > 0 else 0
+            value = str(self._text[start:self._string_ends[i]], 'utf-8')
+            self._strings[i] = value
+        return value
+
+    def __value(self, kind: int, payload: int) -> Any:
+        if kind == _NONE:
+            return None
+        if kind == _BOOL:
+            return bool(payload)
+        if kind == _NUMBER:
+            return decimal.Decimal(self.string(payload))
+        if kind == _STRING:
+            return self.string(payload)
+        if kind == _ERROR:
+            error_type = CellErrorType(payload % 8)
+            detail = self.string(payload // 8)
+            standard = STANDARD_ERRORS[error_type]
+            if standard.get_detail() == detail:
+                return standard
+            return CellError(error_type, detail)
+        raise ValueError(f"Unknown value kind {kind} in snapshot")
+
+    def sheet_names(self) -> List[str]:
+        table = self.__ints(b'SHTS')
+        return [self.string(table[i]) for i in range(0, len(table), 3)]
+
+    def cells(self, index: int) -> Iterator[SnapshotCell]:
+        # Iterate over the cells of the sheet at `index`.
+        table = self.__ints(b'SHTS')
+        (start, count) = (table[3 * index + 1], table[3 * index + 2])
+        keys = self.__ints(b'KEYS')
+        contents = self.__ints(b'CONT')
+        kinds = self._sections[b'KIND']
+        values = self.__ints(b'VALS')
+        offsets = self.__ints(b'DEPO')
+        dependencies = self.__ints(b'DEPS')
+        for i in range(start, start + count):
+            cell_dependencies = []
+            for j in range(offsets[i], offsets[i + 1]):
+                cell_dependencies.append((self.string(dependencies[2 * j]),
+                                          self.string(dependencies[2 * j + 1])))
+            yield (keys[i], self.string(contents[i]),
+                   self.__value(kinds[i], values[i]), cell_dependencies)
+
+    def close(self) -> None:
+        self._strings = []
+        self._sections = {}
+        self._string_ends = None
+        self._text = None
+        self._map.close()
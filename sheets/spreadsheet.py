@@ -1,28 +1,42 @@
-from typing import Any, Dict, List, Optional, Tuple, Callable
+from typing import Any, Dict, Iterator, List, MutableMapping, Optional, Tuple, Callable, Union
 
-from .sheet_range import Contents, SheetRange
-from .utils import in_range, location_to_coordinates, coordinates_to_location
-from .cell import Cell
+from .sheet_range import SheetRange
+from .utils import CELL_KEY_BASE, coordinates_to_key, in_range, key_to_coordinates, key_to_location, \
+    location_to_coordinates, location_to_key
+from .cell import Cell, GetRange, LiteralValue, ResolveCell, StoredFormula
+from .cell_store import CellStore
 # import numpy as np
 
 
 class Spreadsheet:
 
-    def __init__(self, name: str, get_cell_value: Callable[[str, str], Any]):
+    def __init__(self, name: str, get_cell_value: Callable[[str, str], Any],
+                 get_range: Optional[GetRange] = None,
+                 resolve_cell: Optional[ResolveCell] = None):
         self._name = name
-        self.cell_contents: Dict[Tuple[int, int], Cell] = {}
+        # Cells by packed cell key (see utils.coordinates_to_key).
+        self.cell_contents: MutableMapping[int, Cell] = {}
+        # Number of changes made to the name or cell contents of the sheet.
+        self._edits = 0
         self._get_cell_value = get_cell_value
+        self._get_range = get_range
+        self._resolve_cell = resolve_cell
 
     def name(self):
         # Return the name of the sheet in the original casing.
         return self._name
 
+    def edits(self) -> int:
+        # Return the number of changes made to the name or the cell contents
+        # of the sheet so far. The values of cells are not part of this.
+        return self._edits
+
     def extent(self) -> Tuple[int, int]:
         if len(self.cell_contents.keys()) == 0:
             return (0, 0)
         # Return a tuple (num-cols, num-rows) indicating the current extent of
         # the specified spreadsheet.
-        coordinates = list(self.cell_contents.keys())
+        coordinates = list(map(key_to_coordinates, self.cell_contents.keys()))
         col_min, row_min = coordinates[0]
         col_max, row_max = coordinates[0]
 
@@ -45,13 +59,15 @@ class Spreadsheet:
 
         return extent
 
-    def build_dependency_graph(self) -> Dict[str, List[str]]:
+    def build_dependency_graph(self, formulas_only: bool = False) -> Dict[str, List[str]]:
+        # Return the dependencies of every cell, or only of the cells that
+        # hold a formula if formulas_only is true.
         result = {}
-        for coords, cell in self.cell_contents.items():
-            vertex = (
-                self.name().lower(),
-                coordinates_to_location(coords).upper())
-            result[vertex] = cell.dependencies()
+        sheet_name = self.name().lower()
+        for key, cell in self.cell_contents.items():
+            if formulas_only and cell.is_literal():
+                continue
+            result[(sheet_name, key_to_location(key))] = cell.dependencies()
         return result
 
     def set_cell_contents(
@@ -74,11 +90,12 @@ class Spreadsheet:
         # rather, the cell's value will be a CellError object indicating the
         # naure of the issue.
 
-        # Get coordinate location of cells
-        cell_coordinates = location_to_coordinates(location)
+        # Get the key of the cell
+        key = location_to_key(location)
+        self._edits += 1
 
         if contents is None:
-            self.cell_contents.pop(cell_coordinates)
+            self.cell_contents.pop(key, None)
             return
 
         # Remove extra whitespace
@@ -86,17 +103,83 @@ class Spreadsheet:
 
         # Add Dictionary element or remove
         if contents == "":
-            self.cell_contents.pop(cell_coordinates)
+            self.cell_contents.pop(key, None)
         else:
             reference = (self.name().lower(), location.upper())
-            self.cell_contents[cell_coordinates] = Cell(
-                reference, contents, self._get_cell_value)
+            self.cell_contents[key] = Cell(
+                reference, contents, self._get_cell_value, self._get_range,
+                self._resolve_cell)
+
+    def set_cell_values(self, values: Dict[int, Optional[Union[LiteralValue, str]]]) -> None:
+        # Set cells by packed cell key to the given literal values, or to
+        # formulas given as text. A value of None empties the cell.
+        self._edits += 1
+        sheet_name = self.name().lower()
+        for key, value in values.items():
+            if value is None:
+                self.cell_contents.pop(key, None)
+                continue
+            reference = (sheet_name, key_to_location(key))
+            self.cell_contents[key] = Cell(
+                reference, value, self._get_cell_value, self._get_range,
+                self._resolve_cell)
+
+    def restore_cell(self, key: int, contents: Union[LiteralValue, StoredFormula]) -> None:
+        # Add a cell whose value is already known, without evaluating it.
+        self._edits += 1
+        self.cell_contents[key] = self.make_cell(key, contents)
+
+    def make_cell(self, key: int, contents: Union[LiteralValue, StoredFormula]) -> Cell:
+        # Return a cell of this sheet whose value is already known.
+        reference = (self.name().lower(), key_to_location(key))
+        return Cell(reference, contents, self._get_cell_value, self._get_range,
+                    self._resolve_cell)
+
+    def use_store(self, store: CellStore) -> None:
+        # Keep the cells of the sheet in `store` instead of in memory. Must be
+        # called before any cells are added.
+        self.cell_contents = store
+
+    def cells_in(self, start: Tuple[int, int], end: Tuple[int, int]) -> Iterator[Tuple[int, Cell]]:
+        # Iterate over the key and cell of every cell from `start` to `end`
+        # (inclusive).
+        if isinstance(self.cell_contents, CellStore):
+            return self.cell_contents.items_in(start, end)
+        return ((key, cell) for key, cell in self.cell_contents.items()
+                if in_range(key_to_coordinates(key), start, end))
+
+    def snapshot_cells(self) -> List[Tuple[int, str, Any, List[Tuple[str, str]]]]:
+        # Return the key, contents, value and dependencies of every cell.
+        return [(key, cell.contents(), cell.value(), cell.dependencies())
+                for key, cell in self.cell_contents.items()]
 
     def get_cell(self, location: str) -> Optional[Cell]:
-        cell_coordinates = location_to_coordinates(location)
-        if cell_coordinates not in self.cell_contents:
-            return None
-        return self.cell_contents[cell_coordinates]
+        return self.cell_contents.get(location_to_key(location))
+
+    def values_at(self, coords: List[Tuple[int, int]]) -> List[Any]:
+        # Return the values of the cells at the given coordinates.
+        result = []
+        for coord in coords:
+            cell = self.cell_contents.get(coordinates_to_key(coord))
+            result.append(cell.value() if cell is not None else None)
+        return result
+
+    def values_in(self, start: Tuple[int, int], end: Tuple[int, int]) -> List[List[Any]]:
+        # Return the values of the cells from `start` to `end` (inclusive) as
+        # a list of rows.
+        cells = self.cell_contents
+        if isinstance(cells, CellStore):
+            # Read the region with one scan rather than a query per cell.
+            cells = dict(cells.items_in(start, end))
+        result = []
+        for row in range(start[1], end[1] + 1):
+            values = []
+            for key in range(start[0] * CELL_KEY_BASE + row, (end[0] + 1) * CELL_KEY_BASE + row,
+                             CELL_KEY_BASE):
+                cell = cells.get(key)
+                values.append(cell.value() if cell is not None else None)
+            result.append(values)
+        return result
 
     def mark_cyclical(self, location: str) -> None:
         cell = self.get_cell(location)
@@ -115,32 +198,27 @@ class Spreadsheet:
         # This method will never return a zero-length string; instead, empty
         # cells are indicated by a value of None.
 
-        cell_coordinates = location_to_coordinates(location)
-
-        if cell_coordinates not in self.cell_contents:
+        cell = self.cell_contents.get(location_to_key(location))
+        if cell is None:
             return None
-        cell = self.cell_contents[cell_coordinates]
-        cell_contents = cell.contents()
-        return cell_contents
+        return cell.contents()
 
-    def snapshot(self) -> Dict[Tuple[str, str], Any]:
-        result = {}
-        for coords, cell in self.cell_contents.items():
-            key = (self.name(), coordinates_to_location(coords))
-            result[key] = cell.value()
-        return result
+    def snapshot(self) -> Dict[Tuple[str, int], Any]:
+        # Return the value of every cell keyed by (sheet name, cell key).
+        name = self.name()
+        return {(name, key): cell.value() for key, cell in self.cell_contents.items()}
 
     def rename_sheet(self, old: str, new: str):
         if self.name().lower() == old.lower():
             self._name = new
+            self._edits += 1
         for cell in self.cell_contents.values():
-            cell.rename_sheet(old, new)
+            if cell.rename_sheet(old, new):
+                self._edits += 1
 
     def copy_sheet(self, other: 'Spreadsheet'):
-        for coord, cell in other.cell_contents.items():
-            self.set_cell_contents(
-                coordinates_to_location(coord),
-                cell.contents())
+        for key, cell in other.cell_contents.items():
+            self.set_cell_contents(key_to_location(key), cell.contents())
 
     def copy_cells(self, start_location: str, end_location: str) -> SheetRange:
         start_coord = location_to_coordinates(start_location)
@@ -148,23 +226,46 @@ class Spreadsheet:
         min_coord = (min(start_coord[0], end_coord[0]), min(start_coord[1], end_coord[1]))
         max_coord = (max(start_coord[0], end_coord[0]), max(start_coord[1], end_coord[1]))
         cells = {}
-        for coord, cell in self.cell_contents.copy().items():
-            if in_range(coord, min_coord, max_coord):
-                cells[coord] = Contents(cell.contents(), cell.tree())
+        for key, cell in self.cells_in(min_coord, max_coord):
+            cells[key_to_coordinates(key)] = cell.copied_contents()
         return SheetRange(min_coord, cells)
 
     def cut_cells(self, start_location: str, end_location: str) -> SheetRange:
         result = self.copy_cells(start_location, end_location)
-        for key in result.cells().keys():
-            self.cell_contents.pop(key)
+        self._edits += 1
+        for coord in result.cells().keys():
+            self.cell_contents.pop(coordinates_to_key(coord))
         return result
 
     def paste_cells(self, to_location: str, cells: SheetRange):
         origin = location_to_coordinates(to_location)
         translated = cells.translated(origin)
+        self._edits += 1
         for coord, contents in translated.items():
-            reference = (self.name().lower(), coordinates_to_location(coord).upper())
-            self.cell_contents[coord] = Cell(reference, contents, self._get_cell_value)
+            key = coordinates_to_key(coord)
+            reference = (self.name().lower(), key_to_location(key))
+            self.cell_contents[key] = Cell(
+                reference, contents, self._get_cell_value, self._get_range,
+                self._resolve_cell)
+
+    def fill_cells(self, source: Tuple[int, int], targets: List[Tuple[int, int]]):
+        # Copy the cell at `source` into every cell in targets, translating
+        # the references of a formula by the distance to each target. All
+        # targets share the formula of the source cell.
+        self._edits += 1
+        cell = self.cell_contents.get(coordinates_to_key(source))
+        if cell is None:
+            for coord in targets:
+                self.cell_contents.pop(coordinates_to_key(coord), None)
+            return
+        contents = cell.copied_contents()
+        for coord in targets:
+            offset = (coord[0] - source[0], coord[1] - source[1])
+            key = coordinates_to_key(coord)
+            reference = (self.name().lower(), key_to_location(key))
+            self.cell_contents[key] = Cell(
+                reference, contents.translated(offset), self._get_cell_value, self._get_range,
+                self._resolve_cell)
 
     def get_cell_value(self, location: str) -> Any:
         # Return the evaluated value of the specified cell on the specified
@@ -180,13 +281,20 @@ class Spreadsheet:
         # decimal place, and will not include a decimal place if the value is a
         # whole number.  For example, this function would not return
         # Decimal('1.000'); rather it would return Decimal('1').
-        cell_coordinates = location_to_coordinates(location)
-
-        if cell_coordinates not in self.cell_contents:
+        cell = self.cell_contents.get(location_to_key(location))
+        if cell is None:
             return None
-        cell = self.cell_contents[cell_coordinates]
-        cell_value = cell.value()
-        return cell_value
+        return cell.value()
+
+    def iter_cell_contents(self, sort: bool = False) -> Iterator[Tuple[str, str]]:
+        # Iterate over the location and contents of every cell, in the order
+        # the cells were set, or row by row if sort is true.
+        keys = self.cell_contents.keys()
+        if sort:
+            keys = sorted(keys, key=lambda key: key % CELL_KEY_BASE * CELL_KEY_BASE
+                          + key // CELL_KEY_BASE)
+        for key in keys:
+            yield (key_to_location(key), self.cell_contents[key].contents())
 
     def save_spreadsheet(self) -> Dict[str, str]:
         # Return a diction of sheet name and cell contents in a format read for
@@ -195,9 +303,8 @@ class Spreadsheet:
         result = {}
         cell_cont = {}
 
-        for coords, cell in self.cell_contents.items():
-            key = coordinates_to_location(coords)
-            cell_cont[key] = cell.contents()
+        for key, cell in self.cell_contents.items():
+            cell_cont[key_to_location(key)] = cell.contents()
 
         result = {"name": self.name(), "cell-contents": cell_cont}
 
@@ -1,9 +1,13 @@
 import re
 import decimal
+import functools
 from typing import Optional, Any, Tuple, Union
 from enum import IntEnum
 
-from sheets.cell_error import CellError, CellErrorType
+from sheets.cell_error import CellError, CellErrorType, STANDARD_ERRORS
+
+# Value of empty cells in arithmetic.
+_ZERO = decimal.Decimal(0)
 
 
 class CellValueType(IntEnum):
@@ -52,15 +56,39 @@ def is_valid_sheet_name(name: str) -> bool:
         return False
     return re.match(r"^[a-zA-Z0-9.?!,:;!@#$%^&*()-_ ]+$", name) is not None
 
-def strip_trailing_zeros(d: decimal.Decimal):
+def _strip_trailing_zeros_text(d: decimal.Decimal) -> decimal.Decimal:
     s = str(d)
     s = s.rstrip('0').rstrip('.') if '.' in s else s
     return decimal.Decimal(s)
 
 
+def strip_trailing_zeros(d: decimal.Decimal) -> decimal.Decimal:
+    # Remove the trailing zeros after the decimal point of a number, as in
+    # its text form ("1.50" -> "1.5", "2.00" -> "2"). Numbers whose text form
+    # is in scientific notation go through the text itself, so that every
+    # result is exactly what stripping the text gives.
+    (sign, digits, exponent) = d.as_tuple()
+    if not isinstance(exponent, int) or d.adjusted() < -6 \
+            or (exponent > 0 and len(digits) > 1):
+        return _strip_trailing_zeros_text(d)
+    if exponent >= 0:
+        return d
+    if digits == (0,):
+        return decimal.Decimal((sign, digits, 0))
+    end = len(digits)
+    while exponent < 0 and digits[end - 1] == 0:
+        end -= 1
+        exponent += 1
+    if end == len(digits):
+        return d
+    return decimal.Decimal((sign, digits[:end], exponent))
+
+
 def convert_to_decimal(x: Any) -> Union[CellError, decimal.Decimal]:
+    if type(x) is decimal.Decimal:
+        return x
     if x is None:
-        return decimal.Decimal(0)
+        return _ZERO
     if isinstance(x, (CellError, decimal.Decimal)):
         return x
     if isinstance(x, bool):
@@ -69,37 +97,34 @@ def convert_to_decimal(x: Any) -> Union[CellError, decimal.Decimal]:
         try:
             return decimal.Decimal(x.strip())
         except decimal.InvalidOperation:
-            return CellError(CellErrorType.TYPE_ERROR,
-                "A value of the wrong type was encountered during evaluation.")
-    return CellError(CellErrorType.TYPE_ERROR,
-        "A value of the wrong type was encountered during evaluation.")
+            return STANDARD_ERRORS[CellErrorType.TYPE_ERROR]
+    return STANDARD_ERRORS[CellErrorType.TYPE_ERROR]
+
 
+# Error literals by their upper-case text.
+_ERROR_LITERALS = {
+    "#ERROR!": STANDARD_ERRORS[CellErrorType.PARSE_ERROR],
+    "#CIRCREF!": STANDARD_ERRORS[CellErrorType.CIRCULAR_REFERENCE],
+    "#REF!": STANDARD_ERRORS[CellErrorType.BAD_REFERENCE],
+    "#NAME?": STANDARD_ERRORS[CellErrorType.BAD_NAME],
+    "#VALUE!": STANDARD_ERRORS[CellErrorType.TYPE_ERROR],
+    "#DIV/0!": STANDARD_ERRORS[CellErrorType.DIVIDE_BY_ZERO],
+}
 
 def string_to_error(s: str) -> Optional[CellError]:
     # Attempt to parse the string as an error.
-    errors = {
-        "#ERROR!": CellError(
-            CellErrorType.PARSE_ERROR,
-            "A formula doesn't parse successfully."),
-        "#CIRCREF!": CellError(
-            CellErrorType.CIRCULAR_REFERENCE,
-            "A cell is part of a circular reference."),
-        "#REF!": CellError(
-            CellErrorType.BAD_REFERENCE,
-            "A cell-reference is invalid in some way."),
-        "#NAME?": CellError(
-            CellErrorType.BAD_NAME,
-            "Unrecognized function name."),
-        "#VALUE!": CellError(
-            CellErrorType.TYPE_ERROR,
-            "A value of the wrong type was encountered during evaluation."),
-        "#DIV/0!": CellError(
-            CellErrorType.DIVIDE_BY_ZERO,
-            "A divide-by-zero was encountered during evaluation."),
-    }
-    if s.upper() in errors:
-        return errors[s.upper()]
-    return None
+    if not s.startswith('#'):
+        return None
+    return _ERROR_LITERALS.get(s.upper())
+
+_ERROR_TEXT = {error.get_type(): text for (text, error) in _ERROR_LITERALS.items()}
+
+def error_to_string(error: CellError) -> str:
+    # Return the literal text of an error, e.g. "#DIV/0!". The detail of the
+    # error is not part of the text.
+    return _ERROR_TEXT[error.get_type()]
+
+_NOT_A_BOOL = CellError(CellErrorType.TYPE_ERROR, "failed to convert string to bool")
 
 def convert_to_bool(x: Any) -> Union[CellError, bool]:
     if x is None:
@@ -111,7 +136,7 @@ def convert_to_bool(x: Any) -> Union[CellError, bool]:
             return True
         if x.lower() == "false":
             return False
-        return CellError(CellErrorType.TYPE_ERROR, "failed to convert string to bool")
+        return _NOT_A_BOOL
     if isinstance(x, decimal.Decimal):
         return not x.is_zero()
     raise ValueError("unreachable")
@@ -126,8 +151,21 @@ def convert_to_str(x: Any) -> Optional[str]:
     return str(x)
 
 
+# Cells are keyed internally by their coordinates packed into a single
+# integer, col * CELL_KEY_BASE + row. Location strings are only produced for
+# the public API.
+CELL_KEY_BASE = 10000
+
+# Location strings are parsed with this pattern, and recently parsed locations
+# are cached.
+_LOCATION_PATTERN = re.compile(r"([A-Z]{1,4})([1-9][0-9]{0,3})")
+_LOCATION_CACHE_SIZE = 1 << 16
+
+
+@functools.lru_cache(maxsize=None)
 def column_to_number(col: str) -> int:
-    # This function converts column values like "AA" to integer values
+    # This function converts column values like "AA" to integer values.
+    # Results are kept in a table, since a sheet only has so many columns.
 
     col = col[::-1]  # Reverse order of characters
     column_as_int = 0
@@ -138,6 +176,7 @@ def column_to_number(col: str) -> int:
     return column_as_int
 
 
+@functools.lru_cache(maxsize=None)
 def number_to_column(col: int) -> str:
     column_as_char = ''
 
@@ -155,31 +194,33 @@ def in_range(coord: Tuple[int, int], start: Tuple[int, int], end: Tuple[int, int
     return start[0] <= coord[0] and coord[0] <= end[0] \
        and start[1] <= coord[1] and coord[1] <= end[1]
 
+@functools.lru_cache(maxsize=_LOCATION_CACHE_SIZE)
 def location_to_coordinates(location: str) -> Tuple[int, int]:
     ''' This function takes in a location string (like "A1" or "ZZ44") and returns a tuple containg
     the coordinates in integers
     '''
-    location = location.upper()
-
-    if re.match(r"^[A-Z]{1,4}[1-9][0-9]{0,3}$", location) is None:
+    match = _LOCATION_PATTERN.fullmatch(location.upper())
+    if match is None:
         raise ValueError("Invalid cell location.")
+    return (column_to_number(match.group(1)), int(match.group(2)))
 
-    splitat = 1
-    for i in range(len(location)):
-        if location[i + 1].isdigit() is False:
-            splitat += 1
-        else:
-            break
 
-    column_index, row_index = location[:splitat], location[splitat:]
+def coordinates_to_key(coordinates: Tuple[int, int]) -> int:
+    return coordinates[0] * CELL_KEY_BASE + coordinates[1]
 
-    # Convert Both Row and Colum indexes to integers
-    row_index = int(row_index)
-    column_index = column_to_number(column_index)
 
-    coordinate_tuple = (column_index, row_index)
+def key_to_coordinates(key: int) -> Tuple[int, int]:
+    return divmod(key, CELL_KEY_BASE)
 
-    return coordinate_tuple
+
+def location_to_key(location: str) -> int:
+    # Raises a ValueError if the location is invalid.
+    return coordinates_to_key(location_to_coordinates(location))
+
+
+def key_to_location(key: int) -> str:
+    (col, row) = divmod(key, CELL_KEY_BASE)
+    return f"{number_to_column(col)}{row}"
 
 
 def coordinates_to_location(coordinates: Tuple[int, int]) -> str:
@@ -191,12 +232,12 @@ def coordinates_to_location(coordinates: Tuple[int, int]) -> str:
 def translate_cell_ref(cell_ref: str, offset: Tuple[int, int]):
     match = re.match(r"(\$?)([A-Za-z]+)(\$?)([1-9][0-9]*)", cell_ref)
     lock_col = len(match.group(1)) > 0
-    col = column_to_number(match.group(2)) + (0 if lock_col else offset[0])
+    col = column_to_number(match.group(2).upper()) + (0 if lock_col else offset[0])
     lock_row = len(match.group(3)) > 0
     row = int(match.group(4)) + (0 if lock_row else offset[1])
-    if 0 >= col or col > 9999 or 0 >= row or row > 9999:
+    if 0 >= col or col > column_to_number('ZZZZ') or 0 >= row or row > 9999:
         return "#REF!"
-    return f"{'?' if lock_col else ''}{number_to_column(col)}{'?' if lock_row else ''}{row}"
+    return f"{'$' if lock_col else ''}{number_to_column(col)}{'$' if lock_row else ''}{row}"
 
 
 def cell_range_to_list(cell_range: str):
@@ -0,0 +1,283 @@
+'''
+Batched evaluation of fill-down / fill-right runs of formulas.
+
+Columns of cells often hold the same relative formula in every row (`=B2*C2`,
+`=B3*C3`, ...). Such cells have equal R1C1 templates (see formula_template),
+so when they need to be recomputed together they can be evaluated as one
+operation over columns of input values instead of once per cell.
+
+Values are carried as scaled integers so that the results are exactly the
+values the Decimal interpreter would produce. If NumPy is installed and the
+values are small enough, the arithmetic runs on int64 arrays. Any row whose
+inputs are not plain numbers (errors, strings, booleans, ...) is left to the
+regular per-cell evaluation, which keeps error values and their priorities
+unchanged.
+
+The module also converts blocks of cell values to NumPy arrays for
+Workbook.get_values.
+'''
+import decimal
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from .cell_error import CellError
+from .formula import resolve_reference
+from .utils import strip_trailing_zeros
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - NumPy is optional
+    np = None
+
+# Runs shorter than this are not worth setting up a batch for.
+MIN_RUN_LENGTH = 8
+
+# Largest magnitude of a scaled integer for which Decimal arithmetic with the
+# default 28 digits of precision is exact.
+_DECIMAL_LIMIT = 10 ** 28
+
+# Largest magnitude of a scaled integer that is evaluated with int64 arrays.
+_INT64_LIMIT = 2 ** 62
+
+# Reads the values of the given cells of a sheet. Raises a KeyError if the
+# sheet does not exist.
+ReadColumn = Callable[[str, List[Tuple[int, int]]], List[Any]]
+
+
+def compile_template(template: Hashable) -> Optional[Tuple]:
+    # Translate a formula template into a small arithmetic program, or return
+    # None if the formula uses anything other than numbers, cell references,
+    # parentheses, unary +/- and the +, - and * operators.
+    if not isinstance(template, tuple):
+        return None
+    kind = template[0]
+    if kind == 'number':
+        return ('const', decimal.Decimal(template[1]))
+    if kind == 'cell':
+        if not isinstance(template[2], tuple):
+            return None
+        return ('ref', template[1], template[2])
+    if kind == 'parens':
+        return compile_template(template[1])
+    if kind == 'unary_op':
+        operand = compile_template(template[2])
+        if operand is None:
+            return None
+        return operand if template[1] == '+' else ('neg', operand)
+    if kind in ('add_expr', 'mul_expr'):
+        ops = {'+': 'add', '-': 'sub', '*': 'mul'}
+        left = compile_template(template[1])
+        right = compile_template(template[3])
+        if template[2] not in ops or left is None or right is None:
+            return None
+        return (ops[template[2]], left, right)
+    return None
+
+
+def plan_runs(order: List[Hashable],
+              dependencies: Callable[[Hashable], List[Hashable]],
+              template_of: Callable[[Hashable], Optional[Hashable]]) -> List[List[Hashable]]:
+    # Split a topologically sorted list of cells into groups that can be
+    # recomputed in the returned order. Cells are assigned to levels so that
+    # every cell only depends on cells in lower levels; cells within a level
+    # that share a template form one run.
+    level = {}
+    for v in order:
+        level[v] = 1 + max((level[u] for u in dependencies(v) if u in level), default=-1)
+
+    runs: Dict[Tuple[int, Hashable], List[Hashable]] = {}
+    result = []
+    for v in sorted(order, key=lambda v: level[v]):
+        template = template_of(v)
+        if template is None:
+            result.append([v])
+            continue
+        key = (level[v], v[0], template)
+        if key not in runs:
+            runs[key] = []
+            result.append(runs[key])
+        runs[key].append(v)
+    return result
+
+
+class _Column:
+    # A column of numbers represented as integers scaled by 10**scale, along
+    # with a bound on the magnitude of the integers. The integers are held in
+    # a list, or in an int64 array when evaluating with NumPy.
+    def __init__(self, values: Any, scale: int, bound: int):
+        self.values = values
+        self.scale = scale
+        self.bound = bound
+
+
+# Context used to scale Decimals to integers without rounding.
+_EXACT = decimal.Context(prec=decimal.MAX_PREC, Emax=decimal.MAX_EMAX,
+                         Emin=decimal.MIN_EMIN)
+
+
+def _to_column(values: List[Any], ok: List[bool]) -> _Column:
+    # Convert cell values to a scaled integer column. Rows whose value is not
+    # a number or empty are marked as not ok.
+    scale = 0
+    for i, v in enumerate(values):
+        if v is None:
+            continue
+        # Numbers with a positive exponent (e.g. 1E+3) keep that form through
+        # the interpreter, so they are left to it.
+        if not isinstance(v, decimal.Decimal) or not v.is_finite() \
+                or v.as_tuple().exponent > 0:
+            ok[i] = False
+            continue
+        scale = max(scale, -v.as_tuple().exponent)
+    ints = []
+    for i, v in enumerate(values):
+        if v is None or not ok[i]:
+            ints.append(0)
+        else:
+            ints.append(int(v.scaleb(scale, context=_EXACT)))
+    return _Column(ints, scale, max(map(abs, ints), default=0))
+
+
+def _map(func, *operands: Any) -> Any:
+    # Apply func elementwise to lists, or directly to arrays.
+    if isinstance(operands[0], list):
+        return [func(*values) for values in zip(*operands)]
+    return func(*operands)
+
+
+def _rescale(column: _Column, scale: int) -> _Column:
+    factor = 10 ** (scale - column.scale)
+    if factor == 1:
+        return column
+    return _Column(_map(lambda x: x * factor, column.values), scale, column.bound * factor)
+
+
+def _apply(op: str, a: _Column, b: _Column, limit: int) -> Optional[_Column]:
+    # Apply a binary operator to two columns, or return None if the result
+    # could exceed `limit`. Bounds are checked before any values are computed
+    # so that int64 arrays never overflow.
+    if op == 'mul':
+        if a.bound * b.bound >= limit:
+            return None
+        return _Column(_map(lambda x, y: x * y, a.values, b.values),
+                       a.scale + b.scale, a.bound * b.bound)
+    scale = max(a.scale, b.scale)
+    # The rescale factor multiplies every value, so it has to stay within the
+    # limit too, even when the values, and with them the bound, are all 0.
+    factors = (10 ** (scale - a.scale), 10 ** (scale - b.scale))
+    if max(factors) >= limit:
+        return None
+    bound = a.bound * factors[0] + b.bound * factors[1]
+    if bound >= limit:
+        return None
+    a = _rescale(a, scale)
+    b = _rescale(b, scale)
+    if op == 'add':
+        return _Column(_map(lambda x, y: x + y, a.values, b.values), scale, bound)
+    return _Column(_map(lambda x, y: x - y, a.values, b.values), scale, bound)
+
+
+def _evaluate(program: Tuple, inputs: Dict[Hashable, _Column], rows: int,
+              limit: int, arrays: bool) -> Optional[_Column]:
+    # Evaluate a compiled program over the input columns. Returns None if an
+    # intermediate value could exceed `limit`.
+    kind = program[0]
+    if kind == 'const':
+        d = program[1]
+        scale = max(0, -d.as_tuple().exponent)
+        value = int(d.scaleb(scale, context=_EXACT))
+        if abs(value) >= limit:
+            return None
+        values = [value] * rows
+        if arrays:
+            values = np.array(values, dtype=np.int64)
+        return _Column(values, scale, abs(value))
+    if kind == 'ref':
+        return inputs[program]
+    if kind == 'neg':
+        operand = _evaluate(program[1], inputs, rows, limit, arrays)
+        if operand is None:
+            return None
+        return _Column(_map(lambda x: -x, operand.values), operand.scale, operand.bound)
+    a = _evaluate(program[1], inputs, rows, limit, arrays)
+    b = _evaluate(program[2], inputs, rows, limit, arrays)
+    if a is None or b is None:
+        return None
+    return _apply(kind, a, b, limit)
+
+
+def _references(program: Tuple, result: List[Tuple]) -> List[Tuple]:
+    if program[0] == 'ref':
+        if program not in result:
+            result.append(program)
+    elif program[0] != 'const':
+        for operand in program[1:]:
+            _references(operand, result)
+    return result
+
+
+def evaluate_run(program: Tuple, sheet: str, origins: List[Tuple[int, int]],
+                 read_column: ReadColumn) -> List[Optional[decimal.Decimal]]:
+    '''
+    Evaluate a compiled program for every cell of a run on `sheet`, given the
+    coordinates of the cells. Returns the value of each cell, or None for the
+    cells that must be evaluated individually.
+    '''
+    rows = len(origins)
+    ok = [True] * rows
+    inputs = {}
+    for ref in _references(program, []):
+        (_, ref_sheet, reference) = ref
+        coords = [resolve_reference(reference, origin) for origin in origins]
+        for i, c in enumerate(coords):
+            if c is None:
+                ok[i] = False
+                coords[i] = origins[i]
+        try:
+            values = read_column(ref_sheet or sheet, coords)
+        except (KeyError, ValueError):
+            return [None] * rows
+        inputs[ref] = _to_column(values, ok)
+
+    result = None
+    if np is not None and all(c.bound < _INT64_LIMIT for c in inputs.values()):
+        arrays = {ref: _Column(np.array(c.values, dtype=np.int64), c.scale, c.bound)
+                  for ref, c in inputs.items()}
+        result = _evaluate(program, arrays, rows, _INT64_LIMIT, True)
+        if result is not None:
+            result.values = result.values.tolist()
+    if result is None:
+        result = _evaluate(program, inputs, rows, _DECIMAL_LIMIT, False)
+    if result is None:
+        return [None] * rows
+
+    values = []
+    for i, v in enumerate(result.values):
+        # Zero results are left to the interpreter, which may produce -0.
+        if not ok[i] or v == 0:
+            values.append(None)
+        else:
+            values.append(strip_trailing_zeros(decimal.Decimal(v).scaleb(-result.scale)))
+    return values
+
+
+def values_to_arrays(rows: List[List[Any]]) -> Tuple[Any, Any]:
+    '''
+    Convert rows of cell values to a 2-D NumPy array of the values and a
+    boolean array marking the errors. The values are floats, with NaN for
+    empty cells and errors, if every value is a number, empty or an error;
+    otherwise the array holds the values as objects.
+    '''
+    if np is None:
+        raise ImportError("NumPy is required for as_numpy=True")
+    errors = np.array([[isinstance(v, CellError) for v in row] for row in rows],
+                      dtype=bool)
+    numeric = all(v is None or isinstance(v, (decimal.Decimal, CellError))
+                  for row in rows for v in row)
+    if numeric:
+        values = np.array([[float(v) if isinstance(v, decimal.Decimal) else np.nan
+                            for v in row] for row in rows], dtype=float)
+    else:
+        values = np.empty(errors.shape, dtype=object)
+        for i, row in enumerate(rows):
+            values[i, :] = row
+    return (values, errors)
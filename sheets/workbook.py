@@ -1,15 +1,119 @@
 
-from typing import Any, Callable, Dict, Iterable, List, Optional, Set, TextIO, Tuple
-import json
+import csv
+import functools
+import hashlib
+import io
+import os
+from typing import Any, BinaryIO, Callable, Dict, Hashable, Iterable, List, Optional, Set, \
+    TextIO, Tuple, Union
 
 from .spreadsheet import Spreadsheet
-from .utils import is_valid_sheet_name
+from .utils import CELL_KEY_BASE, coordinates_to_key, coordinates_to_location, \
+    is_valid_sheet_name, key_to_location, location_to_coordinates, location_to_key
 from .graph import Graph
-from .cell import CellReference
+from .json_stream import JsonReader, JsonWriter
+from .cell_store import CellDatabase
+from .compression import compressed_text
+from .journal import Journal, file_hash, sync_directory
+from .snapshot import MAGIC as SNAPSHOT_MAGIC, Snapshot, write_snapshot
+from .cell import CellHandle, CellReference, LiteralValue, SheetsVersion, StoredFormula, \
+    text_to_value, value_to_text
+from .cell_error import CellErrorType, STANDARD_ERRORS
+from .cell_range import CellRange, RangeIndex, is_range_location
+from .criteria import CriteriaIndexCache
+from .vectorize import MIN_RUN_LENGTH, compile_template, evaluate_run, plan_runs, \
+    values_to_arrays
 
 NotifyFunction = Callable[['Workbook', Iterable[CellReference]], None]
 
 
+def _update_hash(h: Any, *texts: str) -> None:
+    # Add strings to a content hash, each prefixed by its length so that
+    # different sequences of strings never hash the same text.
+    for text in texts:
+        data = text.encode('utf-8', 'surrogatepass')
+        h.update(b'%d:' % len(data))
+        h.update(data)
+
+
+# Number of distinct literals set_region_contents classifies only once.
+_LITERAL_CACHE_SIZE = 1 << 12
+
+# Number of rows export_csv reads from a sheet at a time.
+_CSV_BAND_ROWS = 256
+
+
+# Name and version of the manifest of a workbook directory (see
+# Workbook.save_incremental).
+_MANIFEST = "manifest.json"
+_DIRECTORY_FORMAT = 1
+
+
+def _write_atomically(path: str, write: Callable[[TextIO], None]) -> None:
+    # Write a text file by writing a temporary file and renaming it, so that
+    # the file at `path` is always either complete or not there.
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as fp:
+        write(fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp, path)
+
+
+def _write_manifest(fp: TextIO, manifest: Dict[str, Any]) -> None:
+    out = JsonWriter(fp)
+    out.write('{"format": %d, "generation": %d, "sheets": [' % (
+        manifest["format"], manifest["generation"]))
+    for i, entry in enumerate(manifest["sheets"]):
+        out.write(', {"name": ' if i > 0 else '{"name": ')
+        out.write_string(entry["name"])
+        out.write(', "file": ')
+        out.write_string(entry["file"])
+        out.write('}')
+    out.write(']}')
+    out.flush()
+
+
+def _read_manifest(path: str) -> Optional[Dict[str, Any]]:
+    # Return the manifest of the workbook directory at `path`, or None if
+    # there is none.
+    try:
+        with open(os.path.join(path, _MANIFEST), encoding='utf-8') as fp:
+            reader = JsonReader(fp)
+            manifest = reader.read_value()
+            reader.end()
+    except FileNotFoundError:
+        return None
+    if not isinstance(manifest, dict) or manifest.get("format") != _DIRECTORY_FORMAT:
+        raise ValueError(f"Unsupported workbook directory {path}")
+    return manifest
+
+
+# Names of the Workbook methods that are recorded in a journal.
+_JOURNALED: Set[str] = set()
+
+
+def _journaled(method: Callable) -> Callable:
+    # Record successful calls of a Workbook method that changes the workbook
+    # in the workbook's journal, if it has one (see open_journaled). Calls
+    # made by another recorded method are part of that call and are not
+    # recorded themselves.
+    _JOURNALED.add(method.__name__)
+
+    @functools.wraps(method)
+    def record(self, *args, **kwargs):
+        if self._journal is None or self._journal_depth > 0:
+            return method(self, *args, **kwargs)
+        self._journal_depth += 1
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            self._journal_depth -= 1
+        self._record(method.__name__, list(args), kwargs, result)
+        return result
+    return record
+
+
 class UpdateContext:
     # UpdateContext is intended to wrap all cell value update
     # operations to ensure that the proper methods are called in the
@@ -23,25 +127,50 @@ class UpdateContext:
     # recomputes all values and saves another 'flattened' version of
     # the workbook. Finally, this object triggers a notification for
     # all cells whose value was changed as part of the update.
+    #
+    # If the cells the update changes are given as `updated`, only the values
+    # of those cells and of the formulas recomputed because of them are
+    # saved and compared, so the update does not read every cell. Nothing is
+    # saved if there are no notify functions.
     def __init__(self, workbook: 'Workbook', updated: Optional[List[CellReference]] = None):
         self.workbook = workbook
         self.updated = updated
         self.prev = {}
         self.curr = {}
+        self._whole = True
+        self._notifying = True
 
     def __enter__(self):
         # This method is called before the contents of the 'with' block.
-        # All we do is save a flattened version of the workbook.
-        self.prev = self.workbook.snapshot_flat()
+        # All we do is save a flattened version of the workbook, or of the
+        # updated cells.
+        self._whole = self.updated is None
+        self._notifying = bool(self.workbook.notify_functions)
+        self.workbook._load_all_sheets()
+        if not self._notifying:
+            return
+        if self._whole:
+            self.prev = self.workbook.snapshot_flat()
+        else:
+            self.prev = self.workbook._values_of(self.updated)
 
     def __exit__(self, _type, _value, _traceback):
         # This method is called after the contents of the 'with' block.
         # Here, we recompute all values in the workbook, flatten the
         # workbook, and used the `prev` and `curr` values to call all
         # notify functions with all changed values.
-        self.workbook._recompute_all_values(self.updated)
-        self.curr = self.workbook.snapshot_flat()
-        self.workbook._notify(self.prev, self.curr)
+        if self._whole:
+            self.workbook._recompute_all_values(self.updated)
+            if self._notifying:
+                self.curr = self.workbook.snapshot_flat()
+        else:
+            recomputed = self.workbook._recompute_all_values(
+                self.updated, self.prev if self._notifying else None)
+            if self._notifying:
+                self.curr = self.workbook._values_of(self.updated + recomputed)
+        if self._notifying:
+            self.workbook._notify(self.prev, self.curr)
+        self.workbook._flush_cells()
 
 
 class Workbook:
@@ -54,6 +183,32 @@ class Workbook:
         self.spreadsheets: List[Spreadsheet] = []
         self.notify_functions: List[NotifyFunction] = []
         self.count: int = 0
+        # Grouped indexes over the criteria ranges of SUMIF/COUNTIF/... formulas,
+        # shared by all formulas that use the same range.
+        self._criteria_indexes = CriteriaIndexCache()
+        # Sheets by lower-case name, and the version of the sheet arrangement
+        # that cell handles are resolved against.
+        self._sheets_by_name: Dict[str, Spreadsheet] = {}
+        self._sheets_version = SheetsVersion()
+        # Loaders of the sheets of a lazily opened workbook that have not been
+        # used yet, by lower-case name (see open_lazy).
+        self._unloaded: Dict[str, Callable[[Spreadsheet], None]] = {}
+        # The journal that changes are recorded in, and the snapshot it is
+        # checkpointed to (see open_journaled).
+        self._journal: Optional[Journal] = None
+        self._journal_depth = 0
+        self._snapshot_path: Optional[str] = None
+        self._checkpoint_every: Optional[int] = None
+        # The database the cells are stored in, and the number of unchanged
+        # cells of each sheet kept in memory (see open_database).
+        self._database: Optional[CellDatabase] = None
+        self._cache_size = 0
+        # The directory the workbook was last saved to or loaded from, the
+        # generation of its manifest, and the file and number of edits of
+        # every sheet at that time (see save_incremental).
+        self._saved_directory: Optional[str] = None
+        self._saved_generation = 0
+        self._saved_sheets: Dict[Spreadsheet, Tuple[str, int]] = {}
 
     def num_sheets(self) -> int:
         # Return the number of spreadsheets in the workbook.
@@ -79,67 +234,641 @@ class Workbook:
         # If any expected value in the input JSON is not of the proper type
         # (e.g. an object instead of a list, or a number instead of a string),
         # raise a TypeError with a suitably descriptive message.
-        workbook = json.loads(fp.read())
-
-        if not isinstance(workbook, dict):
+        #
+        # The document is read incrementally, and cells are installed as they
+        # are read, so the file is never held in memory as a whole. Errors are
+        # raised where they are found in the file.
+        reader = JsonReader(fp)
+        if reader.peek() != '{':
+            reader.read_value()
+            reader.end()
             raise TypeError("dictionary does not exists")
 
-        if "sheets" not in workbook:
-            raise KeyError("Missing 'sheets' key in file")
+        new_workbook = Workbook()
+        found_sheets = False
 
-        sheets = workbook["sheets"]
+        # Files written with cache_values hold the values of formulas; they
+        # are used as they are if the content hash matches the file.
+        content_hash = hashlib.sha256()
+        stored_hash = None
+        evaluation_order = None
+        missing = set()
 
-        if not isinstance(sheets, list):
-            raise TypeError("sheets is not a list")
+        context = UpdateContext(new_workbook)
+        with context:
+            for key in reader.iter_object():
+                if key == "evaluation-order":
+                    evaluation_order = reader.read_value()
+                    continue
+                if key == "content-hash":
+                    stored_hash = reader.read_value()
+                    continue
+                if key != "sheets":
+                    reader.read_value()
+                    continue
+                found_sheets = True
 
-        new_workbook = Workbook()
+                if reader.peek() != '[':
+                    reader.read_value()
+                    raise TypeError("sheets is not a list")
 
-        with UpdateContext(new_workbook):
-            for sheet in sheets:
+                for index, _ in enumerate(reader.iter_array()):
+                    (name, digest, uncached) = new_workbook.__load_sheet(reader)
+                    _update_hash(content_hash, name, digest)
+                    missing.update((index, location) for location in uncached)
+            reader.end()
 
-                if not isinstance(sheet["name"], str):
-                    raise TypeError("Sheets key is invalid data type")
+            if found_sheets and stored_hash == content_hash.hexdigest() \
+                    and new_workbook.__evaluate_uncached(evaluation_order, missing):
+                context.updated = []
 
-                if not isinstance(sheet["cell-contents"], dict):
-                    raise TypeError("cell-contents key is invalid data type")
+        if not found_sheets:
+            raise KeyError("Missing 'sheets' key in file")
 
-                new_workbook.new_sheet(sheet["name"])
-                cell_contents = sheet["cell-contents"]
+        return new_workbook
 
-                for location in cell_contents:
-                    if not isinstance(location, str):
-                        raise TypeError("Invalid cell location data type")
+    def __load_sheet(self, reader: JsonReader, target: Optional[Spreadsheet] = None,
+                     use_cache: bool = True) -> Tuple[str, str, List[str]]:
+        # Read one sheet object of a workbook file and add the sheet, or add
+        # its cells to `target` if given. Cells are added as they are read; if
+        # the sheet's name comes after its cells, the cells are kept until the
+        # name is known. Cached values are ignored unless use_cache is true.
+        #
+        # Returns the name of the sheet, the hash of its cells, and the
+        # locations of the formulas that had no cached value.
+        if reader.peek() != '{':
+            reader.read_value()
+            raise TypeError("Sheets element is not an object")
 
-                    if not isinstance(cell_contents[location], str):
+        sheet = None
+        found_contents = False
+        pending = []
+        cached = None
+        cell_hash = hashlib.sha256()
+        uncached = []
+        for key in reader.iter_object():
+            if key == "name":
+                name = reader.read_value()
+                if not isinstance(name, str):
+                    raise TypeError("Sheets key is invalid data type")
+                if target is None:
+                    # No cells are recomputed until the whole file is read,
+                    # when every sheet that formulas refer to exists.
+                    sheet = self.__add_sheet(self.__new_sheet_name(name))
+                else:
+                    sheet = target
+                for (location, contents) in pending:
+                    if self.__load_cell(sheet, cached, location, contents):
+                        uncached.append(location.upper())
+                pending = []
+            elif key == "cell-values" and use_cache:
+                cached = reader.read_value()
+                if not isinstance(cached, dict) or \
+                        not all(v is None or isinstance(v, str) for v in cached.values()):
+                    raise TypeError("cell-values key is invalid data type")
+            elif key == "cell-contents":
+                found_contents = True
+                if reader.peek() != '{':
+                    reader.read_value()
+                    raise TypeError("cell-contents key is invalid data type")
+                for location in reader.iter_object():
+                    contents = reader.read_value()
+                    if not isinstance(contents, str):
                         raise TypeError("Invalid cell contents data type")
+                    _update_hash(cell_hash, location, contents)
+                    if sheet is None:
+                        pending.append((location, contents))
+                    elif self.__load_cell(sheet, cached, location, contents):
+                        uncached.append(location.upper())
+            else:
+                reader.read_value()
 
-                    new_workbook._get_sheet(
-                        sheet["name"]).set_cell_contents(
-                        location, cell_contents[location])
+        if sheet is None:
+            raise KeyError("Missing 'name' key in sheet")
+        if not found_contents:
+            raise KeyError("Missing 'cell-contents' key in sheet")
+        return (name, cell_hash.hexdigest(), uncached)
 
-        return new_workbook
+    @staticmethod
+    def __load_cell(sheet: Spreadsheet, cached: Optional[Dict[str, Optional[str]]],
+                    location: str, contents: str) -> bool:
+        # Add a cell read from a workbook file. A formula with a cached value
+        # is restored with that value, and only parsed once it is needed.
+        # Returns true if the cell holds a formula without a cached value.
+        formula = contents.strip()
+        if not formula.startswith('='):
+            sheet.set_cell_contents(location, contents)
+            return False
+        if cached is not None and location in cached:
+            sheet.restore_cell(location_to_key(location),
+                               StoredFormula(formula, text_to_value(cached[location])))
+            return False
+        sheet.set_cell_contents(location, contents)
+        return True
+
+    def __evaluate_uncached(self, evaluation_order: Any, missing: Set[Tuple[int, str]]) -> bool:
+        # Evaluate the formulas of a loaded file that had no cached value, in
+        # the stored evaluation order. Returns false if some of them are not
+        # part of the order, in which case the whole workbook has to be
+        # recomputed.
+        if not missing:
+            return True
+        if not isinstance(evaluation_order, list):
+            return False
+        for entry in evaluation_order:
+            if not isinstance(entry, list) or len(entry) != 2 \
+                    or not isinstance(entry[0], int) or not isinstance(entry[1], str):
+                return False
+            reference = (entry[0], entry[1])
+            if reference in missing:
+                missing.discard(reference)
+                self.spreadsheets[entry[0]].get_cell(entry[1]).recompute_value()
+        return not missing
 
-    def save_workbook(self, fp: TextIO) -> None:
+    def save_workbook(self, fp: TextIO, sort_cells: bool = False,
+                      cache_values: bool = False) -> None:
         # Instance method (not a static/class method) to save a workbook to a
         # text file or file-like object in JSON format.  Note that the _caller_
         # of this function is expected to have opened the file; this function
         # merely writes the file.
         #
+        # The JSON is written in chunks as it is produced, and is the same
+        # text json.dumps would produce for the workbook. Cells are written in
+        # the order they were set, or row by row if sort_cells is true, which
+        # makes saved files easier to compare.
+        #
+        # If cache_values is true, the file also holds the computed value of
+        # every formula cell ("cell-values" of each sheet), the order in which
+        # formulas are evaluated ("evaluation-order"), and a hash of the sheet
+        # names and cell contents ("content-hash"). load_workbook uses the
+        # cached values instead of evaluating the formulas when the hash
+        # matches the contents; other readers ignore the extra keys.
+        #
         # If an IO write error occurs (unlikely but possible), let any raised
         # exception propagate through.
-        saved_sheets = []
-        result = {}
+        self._load_all_sheets()
+        out = JsonWriter(fp)
+        content_hash = hashlib.sha256()
+        out.write('{"sheets": [')
+        for i, sheet in enumerate(self.spreadsheets):
+            if i > 0:
+                out.write(', ')
+            Workbook.__write_sheet(out, sheet, sort_cells, content_hash if cache_values else None)
+        out.write(']')
+        if cache_values:
+            indexes = {sheet.name().lower(): i for (i, sheet) in enumerate(self.spreadsheets)}
+            g = self.build_dependency_graph(formulas_only=True).transpose()
+            out.write(', "evaluation-order": [')
+            for j, (sheet_name, location) in enumerate(self.__evaluation_order(g)[2]):
+                out.write(', [' if j > 0 else '[')
+                out.write(str(indexes[sheet_name]))
+                out.write(', ')
+                out.write_string(location)
+                out.write(']')
+            out.write('], "content-hash": ')
+            out.write_string(content_hash.hexdigest())
+        out.write('}')
+        out.flush()
 
-        for sheet in self.spreadsheets:
-            saved_sheets.append(sheet.save_spreadsheet())
+    @staticmethod
+    def __write_sheet(out: JsonWriter, sheet: Spreadsheet, sort_cells: bool,
+                      content_hash: Any = None) -> None:
+        # Write the JSON object of one sheet of a workbook file. If a content
+        # hash is given, the values of the formulas are written as well and
+        # the cells are added to the hash (see save_workbook).
+        out.write('{"name": ')
+        out.write_string(sheet.name())
+        cells = sheet.iter_cell_contents(sort_cells)
+        if content_hash is not None:
+            cells = list(cells)
+            out.write(', "cell-values": {')
+            j = 0
+            for (location, contents) in cells:
+                if not contents.startswith('='):
+                    continue
+                out.write(', ' if j > 0 else '')
+                out.write_string(location)
+                text = value_to_text(sheet.get_cell(location).value())
+                if text is None:
+                    out.write(': null')
+                else:
+                    out.write(': ')
+                    out.write_string(text)
+                j += 1
+            out.write('}')
+            cell_hash = hashlib.sha256()
+            for (location, contents) in cells:
+                _update_hash(cell_hash, location, contents)
+            _update_hash(content_hash, sheet.name(), cell_hash.hexdigest())
+        out.write(', "cell-contents": {')
+        for j, (location, contents) in enumerate(cells):
+            if j > 0:
+                out.write(', ')
+            out.write_string(location)
+            out.write(': ')
+            out.write_string(contents)
+        out.write('}}')
+
+    def save_compressed(self, fp: BinaryIO, codec: str = 'gzip', sort_cells: bool = True,
+                        cache_values: bool = False, level: Optional[int] = None) -> None:
+        # Save the workbook to the binary file object `fp` in the JSON format
+        # of save_workbook, compressed with `codec` ('gzip', 'lzma' or 'zlib')
+        # as it is written. Cells are written row by row by default, which
+        # puts similar formulas next to each other and compresses better.
+        # `level` is the compression level (the preset for lzma).
+        with compressed_text(fp, 'w', codec, level) as text:
+            self.save_workbook(text, sort_cells, cache_values)
+
+    @classmethod
+    def load_compressed(cls, fp: BinaryIO, codec: Optional[str] = None) -> 'Workbook':
+        # Load a workbook saved with save_compressed from the binary file
+        # object `fp`, decompressing it as it is read. The codec is detected
+        # from the start of the stream if it is not given. Errors are those
+        # of load_workbook, plus the EOFError of a truncated stream.
+        with compressed_text(fp, 'r', codec) as text:
+            return cls.load_workbook(text)
+
+    def save_snapshot(self, path: str) -> None:
+        # Save the workbook to the file at `path` as a binary snapshot, which
+        # holds the contents, computed value and dependencies of every cell
+        # (see snapshot.py). A snapshot can be opened with open_snapshot()
+        # without parsing or evaluating any formulas.
+        #
+        # If an IO error occurs, let any raised exception propagate through.
+        self._load_all_sheets()
+        write_snapshot(path, [(sheet.name(), sheet.snapshot_cells())
+                              for sheet in self.spreadsheets])
+
+    @classmethod
+    def open_snapshot(cls, path: str) -> 'Workbook':
+        # Open a workbook saved with save_snapshot(). The cells get the
+        # values stored in the snapshot; formulas are only parsed and
+        # evaluated once they have to be recomputed.
+        #
+        # If the file is not a snapshot, or was written in an unsupported
+        # version of the format, a ValueError is raised.
+        snapshot = Snapshot(path)
+        try:
+            workbook = Workbook()
+            # All sheets are created before any cells are added, so that no
+            # update recomputes restored cells.
+            names = snapshot.sheet_names()
+            for name in names:
+                workbook.new_sheet(name)
+            for (index, name) in enumerate(names):
+                Workbook.__restore_sheet(workbook._get_sheet(name), snapshot, index)
+        finally:
+            snapshot.close()
+        return workbook
+
+    @staticmethod
+    def __restore_sheet(sheet: Spreadsheet, snapshot: Snapshot, index: int) -> None:
+        # Add the cells of the sheet at `index` in a snapshot to `sheet`.
+        for (key, contents, value, dependencies) in snapshot.cells(index):
+            if contents.startswith('='):
+                restored = StoredFormula(contents, value, dependencies)
+            else:
+                restored = LiteralValue(value, contents)
+            sheet.restore_cell(key, restored)
+
+    def save_incremental(self, path: str) -> None:
+        # Save the workbook to the directory at `path`, creating it if needed,
+        # as a manifest ("manifest.json") and one file per sheet. Each sheet
+        # file holds the same JSON object as a sheet in a workbook file.
+        #
+        # When the workbook was last saved to or loaded from the same
+        # directory, and the directory has not been saved to since, only the
+        # sheets whose name or cell contents changed are written again. Sheet
+        # files are never overwritten: changed sheets are written to new
+        # files, which the new manifest then replaces the old manifest to
+        # refer to, so the directory always holds a complete workbook. The
+        # manifest counts the saves in its "generation". Files of earlier
+        # generations are removed once the new manifest is in place.
+        #
+        # If an IO error occurs, let any raised exception propagate through.
+        self._load_all_sheets()
+        os.makedirs(path, exist_ok=True)
+        manifest = _read_manifest(path)
+        generation = manifest["generation"] if manifest is not None else 0
+        saved = {}
+        if self._saved_directory == os.path.abspath(path) and \
+                self._saved_generation == generation:
+            saved = self._saved_sheets
+
+        generation += 1
+        entries = []
+        written = {}
+        for i, sheet in enumerate(self.spreadsheets):
+            (file_name, edits) = saved.get(sheet, (None, None))
+            if edits != sheet.edits():
+                file_name = f"sheet-{generation}-{i}.json"
+                _write_atomically(os.path.join(path, file_name),
+                                  lambda fp, sheet=sheet: Workbook.__save_sheet(fp, sheet))
+            entries.append({"name": sheet.name(), "file": file_name})
+            written[sheet] = (file_name, sheet.edits())
+        _write_atomically(os.path.join(path, _MANIFEST), lambda fp: _write_manifest(
+            fp, {"format": _DIRECTORY_FORMAT, "generation": generation, "sheets": entries}))
+        sync_directory(os.path.join(path, _MANIFEST))
+
+        files = {entry["file"] for entry in entries}
+        for file_name in os.listdir(path):
+            if file_name.startswith("sheet-") and file_name not in files:
+                os.remove(os.path.join(path, file_name))
+        self._saved_directory = os.path.abspath(path)
+        self._saved_generation = generation
+        self._saved_sheets = written
+
+    @staticmethod
+    def __save_sheet(fp: TextIO, sheet: Spreadsheet) -> None:
+        out = JsonWriter(fp)
+        Workbook.__write_sheet(out, sheet, False)
+        out.flush()
+
+    @classmethod
+    def load_directory(cls, path: str) -> 'Workbook':
+        # Load a workbook saved with save_incremental() from the directory at
+        # `path`. Saving the workbook to the same directory again only
+        # writes the sheets that changed.
+        #
+        # Errors are raised as by load_workbook(); a missing or unsupported
+        # manifest raises a ValueError.
+        manifest = _read_manifest(path)
+        if manifest is None:
+            raise ValueError(f"{path} does not hold a saved workbook")
+        workbook = Workbook()
+        with UpdateContext(workbook):
+            for entry in manifest["sheets"]:
+                with open(os.path.join(path, entry["file"]), encoding='utf-8') as fp:
+                    reader = JsonReader(fp)
+                    workbook.__load_sheet(reader)
+                    reader.end()
+        workbook._saved_directory = os.path.abspath(path)
+        workbook._saved_generation = manifest["generation"]
+        workbook._saved_sheets = {
+            sheet: (entry["file"], sheet.edits())
+            for (sheet, entry) in zip(workbook.spreadsheets, manifest["sheets"])}
+        return workbook
+
+    @classmethod
+    def open_lazy(cls, path: str) -> 'Workbook':
+        # Open a workbook saved with save_workbook() or save_snapshot() from
+        # the file at `path`, loading each sheet only when it is first used.
+        #
+        # Opening the workbook only reads the names of the sheets and where
+        # they are in the file. A sheet's cells are loaded the first time the
+        # sheet is accessed, either directly or by a formula of another sheet
+        # that is loaded, so only the sheets that are used are ever read.
+        # Formulas are evaluated when their sheet is loaded, unless the file
+        # holds valid cached values for them (see save_workbook).
+        #
+        # Any update to the workbook, and saving it, first loads all sheets
+        # that have not been loaded yet, since cells of any sheet may depend
+        # on the cells being changed. The file must not change until all
+        # sheets are loaded.
+        #
+        # Errors in the file are raised as by load_workbook() and
+        # open_snapshot(); errors in the cells of a sheet are only raised when
+        # the sheet is loaded.
+        with open(path, 'rb') as fp:
+            is_snapshot = fp.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+        workbook = Workbook()
+        if is_snapshot:
+            snapshot = Snapshot(path)
+            try:
+                names = snapshot.sheet_names()
+            finally:
+                snapshot.close()
+            for name in names:
+                workbook.new_sheet(name)
+            for (index, name) in enumerate(names):
+                workbook._unloaded[name.lower()] = \
+                    functools.partial(Workbook.__load_snapshot_sheet, path, index)
+            return workbook
+
+        with open(path, 'rb') as fp, io.TextIOWrapper(fp, encoding='utf-8') as text:
+            (offsets, trusted) = Workbook.__index_json(text)
+        for (name, _) in offsets:
+            workbook.new_sheet(name)
+        for (name, offset) in offsets:
+            workbook._unloaded[name.lower()] = \
+                functools.partial(workbook.__load_json_sheet, path, offset, trusted)
+        return workbook
+
+    @staticmethod
+    def __index_json(fp: TextIO) -> Tuple[List[Tuple[str, int]], bool]:
+        # Read a workbook file without loading any cells. Returns the name of
+        # every sheet with the offset of the sheet object in the file, and
+        # whether the cached values in the file match the contents.
+        reader = JsonReader(fp)
+        if reader.peek() != '{':
+            reader.skip_value()
+            reader.end()
+            raise TypeError("dictionary does not exists")
+
+        offsets = []
+        found_sheets = False
+        content_hash = hashlib.sha256()
+        stored_hash = None
+        for key in reader.iter_object():
+            if key == "content-hash":
+                stored_hash = reader.read_value()
+                continue
+            if key != "sheets":
+                reader.skip_value()
+                continue
+            found_sheets = True
+            if reader.peek() != '[':
+                reader.skip_value()
+                raise TypeError("sheets is not a list")
+            for _ in reader.iter_array():
+                offset = reader.tell()
+                (name, digest) = Workbook.__index_json_sheet(reader)
+                _update_hash(content_hash, name, digest)
+                offsets.append((name, offset))
+        reader.end()
+        if not found_sheets:
+            raise KeyError("Missing 'sheets' key in file")
+        return (offsets, stored_hash == content_hash.hexdigest())
+
+    @staticmethod
+    def __index_json_sheet(reader: JsonReader) -> Tuple[str, str]:
+        # Read one sheet object of a workbook file without loading its cells,
+        # and return the name of the sheet and the hash of its cells.
+        if reader.peek() != '{':
+            reader.skip_value()
+            raise TypeError("Sheets element is not an object")
+        name = None
+        found_contents = False
+        cell_hash = hashlib.sha256()
+        for key in reader.iter_object():
+            if key == "name":
+                name = reader.read_value()
+                if not isinstance(name, str):
+                    raise TypeError("Sheets key is invalid data type")
+            elif key == "cell-contents":
+                found_contents = True
+                if reader.peek() != '{':
+                    reader.skip_value()
+                    raise TypeError("cell-contents key is invalid data type")
+                for location in reader.iter_object():
+                    contents = reader.read_value()
+                    if not isinstance(contents, str):
+                        raise TypeError("Invalid cell contents data type")
+                    _update_hash(cell_hash, location, contents)
+            else:
+                reader.skip_value()
+        if name is None:
+            raise KeyError("Missing 'name' key in sheet")
+        if not found_contents:
+            raise KeyError("Missing 'cell-contents' key in sheet")
+        return (name, cell_hash.hexdigest())
+
+    @staticmethod
+    def __load_snapshot_sheet(path: str, index: int, sheet: Spreadsheet) -> None:
+        snapshot = Snapshot(path)
+        try:
+            Workbook.__restore_sheet(sheet, snapshot, index)
+        finally:
+            snapshot.close()
+
+    def __load_json_sheet(self, path: str, offset: int, trusted: bool,
+                          sheet: Spreadsheet) -> None:
+        # Load the cells of the sheet object at `offset` in a workbook file,
+        # and evaluate the formulas whose cached values cannot be used.
+        with open(path, 'rb') as fp:
+            fp.seek(offset)
+            with io.TextIOWrapper(fp, encoding='utf-8') as text:
+                (_, _, uncached) = self.__load_sheet(JsonReader(text), sheet, use_cache=trusted)
+        # Indexes over the sheet's ranges may have been built by formulas
+        # evaluated while the sheet was only partly loaded.
+        name = sheet.name().lower()
+        self._criteria_indexes.drop_sheet(name)
+        self._recompute_all_values([(name, location) for location in uncached])
+
+    @classmethod
+    def open_journaled(cls, snapshot_path: str, journal_path: str, sync_every: int = 1,
+                       checkpoint_every: Optional[int] = None) -> 'Workbook':
+        # Open a workbook that is kept as a snapshot (see save_snapshot) and a
+        # journal of the changes made since the snapshot was written (see
+        # journal.py). Either file may be missing; a new workbook starts out
+        # empty.
+        #
+        # Every change made to the returned workbook through its methods is
+        # appended to the journal, and forced to disk after every
+        # `sync_every` changes. checkpoint() writes the workbook to the
+        # snapshot and starts the journal over; it is done automatically
+        # after every `checkpoint_every` changes if that is given.
+        #
+        # If the journal is not a journal, a record in it is corrupt, or the
+        # snapshot it applies to is missing, a ValueError is raised.
+        journal = Journal(journal_path, sync_every)
+        try:
+            checkpoint = file_hash(snapshot_path)
+            if checkpoint is None and journal.checkpoint() is not None:
+                raise ValueError(f"The snapshot {snapshot_path} of the journal is missing")
+            if checkpoint is None:
+                workbook = Workbook()
+            else:
+                workbook = Workbook.open_snapshot(snapshot_path)
+            if journal.checkpoint() == checkpoint:
+                for (name, args, kwargs) in journal.records():
+                    if name not in _JOURNALED:
+                        raise ValueError(f"Unknown operation {name} in journal {journal_path}")
+                    getattr(workbook, name)(*args, **kwargs)
+            else:
+                # A checkpoint stopped after replacing the snapshot; the
+                # journal's changes are all part of the snapshot.
+                journal.reset(checkpoint)
+        except BaseException:
+            journal.close()
+            raise
+        workbook._journal = journal
+        workbook._snapshot_path = snapshot_path
+        workbook._checkpoint_every = checkpoint_every
+        return workbook
+
+    def checkpoint(self) -> None:
+        # Write the workbook to the snapshot of its journal and start the
+        # journal over. Raises a ValueError if the workbook has no journal.
+        if self._journal is None:
+            raise ValueError("The workbook has no journal")
+        self._journal.sync()
+        tmp = self._snapshot_path + '.tmp'
+        self.save_snapshot(tmp)
+        with open(tmp, 'rb+') as fp:
+            os.fsync(fp.fileno())
+        os.replace(tmp, self._snapshot_path)
+        sync_directory(self._snapshot_path)
+        self._journal.reset(file_hash(self._snapshot_path))
+
+    def close_journal(self) -> None:
+        # Force the journal to disk and stop recording changes in it.
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    @classmethod
+    def open_database(cls, path: str, cache_size: int = 1 << 16) -> 'Workbook':
+        # Open the workbook stored in the SQLite database at `path`, creating
+        # an empty one if there is no such file (see cell_store.py).
+        #
+        # The cells of the workbook stay in the database; at most
+        # `cache_size` unchanged cells of each sheet are kept in memory, and
+        # the others are read back when they are used. Formulas are restored
+        # with their stored values, so opening the workbook evaluates
+        # nothing. Every change is written to the database at the end of the
+        # update that made it, in a transaction that lasts until commit().
+        # Changes that are not committed are lost when the process stops.
+        #
+        # Setting the contents or values of cells only reads the cells that
+        # depend on the changed cells, which are found through the reverse
+        # dependencies kept in the database. Other operations (moving,
+        # copying or sorting cells, and adding, removing, renaming or copying
+        # sheets) recompute the whole workbook: they read every cell, and keep
+        # the dependencies of every formula in memory while they run, plus the
+        # value of every cell if notify functions are registered. On
+        # workbooks larger than memory, only use them when that fits.
+        database = CellDatabase(path)
+        workbook = Workbook()
+        workbook._database = database
+        workbook._cache_size = cache_size
+        for (sheet_id, name) in database.sheets():
+            sheet = Spreadsheet(name, workbook.get_cell_value, workbook._get_range,
+                                workbook._resolve_cell)
+            sheet.use_store(database.cells(sheet_id, sheet.make_cell, cache_size))
+            workbook.spreadsheets.append(sheet)
+        workbook.count = len(workbook.spreadsheets)
+        workbook.__sheets_changed()
+        return workbook
 
-        result = {"sheets": saved_sheets}
+    def commit(self) -> None:
+        # Commit the changes made to the workbook's database since the last
+        # commit. Raises a ValueError if the workbook has no database.
+        if self._database is None:
+            raise ValueError("The workbook has no database")
+        self._flush_cells()
+        self._database.commit()
 
-        workbook = json.dumps(result)
+    def close_database(self) -> None:
+        # Commit the changes made to the workbook's database and close it.
+        # The workbook can no longer be used afterwards.
+        if self._database is not None:
+            self._flush_cells()
+            self._database.close()
+            self._database = None
 
-        fp.write(workbook)
+    def _record(self, name: str, args: List[Any], kwargs: Dict[str, Any], result: Any) -> None:
+        # Append a change to the journal. Sheets are recorded by the name they
+        # got, which for generated names depends on more than the sheets.
+        if name == 'new_sheet':
+            (args, kwargs) = ([result[1]], {})
+        self._journal.append(name, args, kwargs)
+        if self._checkpoint_every is not None and \
+                self._journal.length >= self._checkpoint_every:
+            self.checkpoint()
 
     # pylint: disable=too-many-arguments
+    @_journaled
     def move_cells(self, sheet_name: str, start_location: str,
             end_location: str, to_location: str, to_sheet: Optional[str] = None) -> None:
         # Move cells from one location to another, possibly moving them to
@@ -189,6 +918,7 @@ class Workbook:
             dst_sheet.paste_cells(to_location, cells)
 
     # pylint: disable=too-many-arguments
+    @_journaled
     def copy_cells(self, sheet_name: str, start_location: str,
             end_location: str, to_location: str, to_sheet: Optional[str] = None) -> None:
         # Copy cells from one location to another, possibly copying them to
@@ -237,6 +967,56 @@ class Workbook:
             dst_sheet = self._get_sheet(to_sheet or sheet_name)
             dst_sheet.paste_cells(to_location, cells)
 
+    @_journaled
+    def fill(self, sheet_name: str, source_location: str, target_range: str,
+             direction: str = 'down') -> None:
+        # Fill the contents of the source cell into every cell of the target
+        # range, e.g. fill("Sheet1", "C1", "C2:C100", "down"). Formulas have
+        # their relative and mixed cell-references updated by the distance to
+        # each target cell, the same as copying the source cell there.
+        #
+        # The direction must be one of "down", "up", "right" or "left". When
+        # filling down or up, the target range must be the part of the source
+        # cell's column below or above the source; when filling right or left,
+        # it must be the part of the source cell's row to the right or left.
+        #
+        # The target range is given as two corners separated by a colon, or
+        # as a single cell location. All target cells are updated together,
+        # so notification functions are called once for the whole fill.
+        #
+        # If the specified sheet name is not found, a KeyError is raised.
+        # If any cell location is invalid, or the target range does not lie
+        # in the given direction from the source cell, a ValueError is raised.
+        #
+        # If a filled formula contains a relative or mixed cell-reference that
+        # would become invalid, the cell-reference is replaced with a #REF!
+        # error-literal in the formula of that cell.
+        sheet = self._get_sheet(sheet_name)
+        source = location_to_coordinates(source_location)
+        corners = [location_to_coordinates(loc) for loc in target_range.split(':')]
+        if len(corners) not in (1, 2):
+            raise ValueError("Invalid target range.")
+        start = (min(c[0] for c in corners), min(c[1] for c in corners))
+        end = (max(c[0] for c in corners), max(c[1] for c in corners))
+
+        if direction in ('down', 'up'):
+            valid = start[0] == source[0] and end[0] == source[0] and \
+                (start[1] > source[1] if direction == 'down' else end[1] < source[1])
+        elif direction in ('right', 'left'):
+            valid = start[1] == source[1] and end[1] == source[1] and \
+                (start[0] > source[0] if direction == 'right' else end[0] < source[0])
+        else:
+            raise ValueError(f"Invalid fill direction {direction!r}.")
+        if not valid:
+            raise ValueError("The target range must lie in the fill direction.")
+
+        targets = [(col, row) for row in range(start[1], end[1] + 1)
+                   for col in range(start[0], end[0] + 1)]
+        updated = [(sheet_name.lower(), coordinates_to_location(coords).upper())
+                   for coords in targets]
+        with UpdateContext(self, updated=updated):
+            sheet.fill_cells(source, targets)
+
     def notify_cells_changed(self, notify_function: NotifyFunction) -> None:
         # Request that all changes to cell values in the workbook are reported
         # to the specified notify_function.  The values passed to the notify
@@ -259,6 +1039,7 @@ class Workbook:
         # this requirement, the behavior is undefined.
         self.notify_functions.append(notify_function)
 
+    @_journaled
     def rename_sheet(self, sheet_name: str, new_sheet_name: str) -> None:
         # Rename the specified sheet to the new sheet name.  Additionally, all
         # cell formulas that referenced the original sheet name are updated to
@@ -287,7 +1068,9 @@ class Workbook:
         with UpdateContext(self):
             for sheet in self.spreadsheets:
                 sheet.rename_sheet(sheet_name, new_sheet_name)
+            self.__sheets_changed()
 
+    @_journaled
     def move_sheet(self, sheet_name: str, index: int) -> None:
         # Move the specified sheet to the specified index in the workbook's
         # ordered sequence of sheets.  The index can range from 0 to
@@ -310,7 +1093,9 @@ class Workbook:
         # Remove the spreadsheet at the current_index and insert it at the
         # given index.
         self.spreadsheets.insert(index, self.spreadsheets.pop(current_index))
+        self.__update_database_sheets()
 
+    @_journaled
     def copy_sheet(self, sheet_name: str) -> Tuple[int, str]:
         # Make a copy of the specified sheet, storing the copy at the end of the
         # workbook's sequence of sheets.  The copy's name is generated by
@@ -346,25 +1131,61 @@ class Workbook:
             self._get_sheet(copy_name).copy_sheet(self._get_sheet(sheet_name))
         return (copy_index, copy_name)
 
-    def build_dependency_graph(self) -> Graph:
+    def build_dependency_graph(self, formulas_only: bool = False) -> Graph:
         # Construct a directed graph in adjacency list form where each vertex
         # is a string representing a cell location and there is a directed edge
         # from each cell to the cells that the value of the cell depends on.
         # Note that cell with no dependencies are still part of the graph, but
         # they have an empty adjacency list.
+        #
+        # A range a formula refers to, e.g. ("sheet1", "A1:A10"), is a single
+        # vertex with an edge to each cell of the graph inside it.
+        #
+        # If formulas_only is true, cells holding a literal value are only
+        # part of the graph if a formula depends on them.
+        return self.__dependency_graph(formulas_only)[0]
+
+    def __dependency_graph(self, formulas_only: bool) -> Tuple[Graph, RangeIndex]:
+        # Return the dependency graph together with an index of its ranges.
         result = {}
         for sheet in self.spreadsheets:
-            result.update(sheet.build_dependency_graph())
-        return Graph[CellReference](result)
+            result.update(sheet.build_dependency_graph(formulas_only))
+        ranges = RangeIndex()
+        for dependencies in result.values():
+            for reference in dependencies:
+                if is_range_location(reference[1]):
+                    ranges.add(reference)
+        if ranges:
+            covered: Dict[CellReference, List[CellReference]] = {}
+            for reference in result:
+                for r in ranges.containing(reference):
+                    covered.setdefault(r, []).append(reference)
+            result.update(covered)
+        return (Graph[CellReference](result), ranges)
 
-    def snapshot_flat(self) -> Dict[Tuple[str, str], Any]:
+    def snapshot_flat(self) -> Dict[Tuple[str, int], Any]:
         # Return a 'flat' representation of the Workbook as a single dict
-        # object.
+        # object, keyed by sheet name and packed cell key.
+        self._load_all_sheets()
         result = {}
         for sheet in self.spreadsheets:
             result.update(sheet.snapshot())
         return result
 
+    def _values_of(self, references: Iterable[CellReference]) -> Dict[Tuple[str, int], Any]:
+        # Return the values of the given cells that are not empty, keyed like
+        # the result of snapshot_flat().
+        result = {}
+        for (sheet_name, location) in references:
+            sheet = self._sheets_by_name.get(sheet_name)
+            if sheet is None:
+                continue
+            key = location_to_key(location)
+            cell = sheet.cell_contents.get(key)
+            if cell is not None:
+                result[(sheet.name(), key)] = cell.value()
+        return result
+
     def list_sheets(self) -> List[str]:
         # Return a list of the spreadsheet names in the workbook, with the
         # capitalization specified at creation, and in the order that the sheets
@@ -379,8 +1200,8 @@ class Workbook:
         # workbook's internal state.
         return list(map(lambda s: s.name(), self.spreadsheets))
 
-    def _notify(self, prev: Dict[CellReference, Any],
-                curr: Dict[CellReference, Any]):
+    def _notify(self, prev: Dict[Tuple[str, int], Any],
+                curr: Dict[Tuple[str, int], Any]):
         # Given a dict of the previous value of all cells and a dict of the current
         # value of all cells, calls all registered notify_functions on any values
         # that differ between prev and current.
@@ -394,7 +1215,7 @@ class Workbook:
         # This is a very naiive notification function, but it is trivially correct.
         # All optimizations should be performed by reducing the number of values
         # passed into this function.
-        changed: Set[CellReference] = set()
+        changed: Set[Tuple[str, int]] = set()
         prev_key_set = set(prev.keys())
         curr_key_set = set(curr.keys())
 
@@ -408,7 +1229,7 @@ class Workbook:
 
         # Call notify functions in the order they were registered and catch
         # and ignore all exceptions that occur.
-        changed = list(changed)
+        changed = [(name, key_to_location(key)) for (name, key) in changed]
         if len(changed) > 0:
             for notify_func in self.notify_functions:
                 try:
@@ -417,6 +1238,7 @@ class Workbook:
                 except BaseException:
                     pass
 
+    @_journaled
     def new_sheet(self, sheet_name: Optional[str] = None) -> Tuple[int, str]:
         # Add a new sheet to the workbook.  If the sheet name is specified, it
         # must be unique.  If the sheet name is None, a unique sheet name is
@@ -429,6 +1251,19 @@ class Workbook:
         #
         # If the spreadsheet name is an empty string (not None), or it is
         # otherwise invalid, a ValueError is raised.
+        sheet_name = self.__new_sheet_name(sheet_name)
+
+        # Create a new spreadsheet. Recompute cell values and notify registered
+        # handlers about any changed values.
+        with UpdateContext(self):
+            self.__add_sheet(sheet_name)
+
+        index = len(self.spreadsheets) - 1
+        return (index, sheet_name)
+
+    def __new_sheet_name(self, sheet_name: Optional[str]) -> str:
+        # Return the name of a sheet being added, generating one if it is
+        # None. Raises a ValueError if the name is invalid or already used.
         self.count += 1
         if sheet_name is None:
             sheet_name = f"Sheet{self.count}"
@@ -439,17 +1274,19 @@ class Workbook:
             if i is not None:
                 raise ValueError(
                     f"A sheet with the name \"{sheet_name}\" already exists.")
+        return sheet_name
 
-        # Create a new spreadsheet. Recompute cell values and notify registered
-        # handlers about any changed values.
-        with UpdateContext(self):
-            self.spreadsheets.append(
-                Spreadsheet(
-                    sheet_name,
-                    self.get_cell_value))
-
-        index = len(self.spreadsheets) - 1
-        return (index, sheet_name)
+    def __add_sheet(self, sheet_name: str) -> Spreadsheet:
+        # Append a new, empty sheet with a name that has been checked to be
+        # valid and unique, without recomputing any cells.
+        sheet = Spreadsheet(sheet_name, self.get_cell_value, self._get_range,
+                            self._resolve_cell)
+        if self._database is not None:
+            sheet.use_store(self._database.cells(
+                self._database.add_sheet(sheet_name), sheet.make_cell, self._cache_size))
+        self.spreadsheets.append(sheet)
+        self.__sheets_changed()
+        return sheet
 
     def _get_sheet_index(self, sheet_name: str) -> Optional[int]:
         # Return the index of the sheet with the given sheet_name or None if no
@@ -464,12 +1301,62 @@ class Workbook:
         # Return the sheet with the given sheet_name or raises a KeyError if no
         # such spreadsheet exists. Note that the sheet_name is
         # case-insensitive.
-        for sheet in self.spreadsheets:
-            if sheet_name.lower() == sheet.name().lower():
-                return sheet
-        raise KeyError(
-            f"A sheet with the name \"{sheet_name}\" does not exist")
+        sheet = self.__sheet_named(sheet_name.lower())
+        if sheet is None:
+            raise KeyError(
+                f"A sheet with the name \"{sheet_name}\" does not exist")
+        return sheet
 
+    def __sheet_named(self, name: str) -> Optional[Spreadsheet]:
+        # Return the sheet with the given lower-case name, loading it first if
+        # it has not been loaded yet, or None if there is no such sheet.
+        sheet = self._sheets_by_name.get(name)
+        if self._unloaded and name in self._unloaded:
+            # The loader is removed first, so that formulas that refer back to
+            # this sheet while it is being loaded see the cells added so far.
+            self._unloaded.pop(name)(sheet)
+        return sheet
+
+    def _load_all_sheets(self) -> None:
+        # Load every sheet of a lazily opened workbook that is not loaded yet.
+        while self._unloaded:
+            self.__sheet_named(next(iter(self._unloaded)))
+
+    def __sheets_changed(self) -> None:
+        # Called whenever a sheet is added, removed or renamed. Rebuilds the
+        # sheet lookup table and invalidates all resolved cell handles.
+        self._sheets_by_name = {sheet.name().lower(): sheet for sheet in self.spreadsheets}
+        self._sheets_version.valid = False
+        self._sheets_version = SheetsVersion()
+        self.__update_database_sheets()
+
+    def __update_database_sheets(self) -> None:
+        # Record the names and order of the sheets in the workbook's database.
+        if self._database is not None:
+            self._database.update_sheets([(sheet.cell_contents.sheet_id, sheet.name())
+                                          for sheet in self.spreadsheets])
+
+    def _flush_cells(self) -> None:
+        # Write the cells changed by an update to the workbook's database.
+        if self._database is not None:
+            for sheet in self.spreadsheets:
+                sheet.cell_contents.flush()
+
+    def _resolve_cell(self, sheet_name: str, location: str) -> CellHandle:
+        # Resolve a cell reference of a formula to a handle. References to a
+        # missing sheet or an invalid location resolve to a #REF! error until
+        # the sheets of the workbook change.
+        sheet = self.__sheet_named(sheet_name.lower())
+        try:
+            key = location_to_key(location)
+        except ValueError:
+            sheet = None
+        if sheet is None:
+            return CellHandle.error(STANDARD_ERRORS[CellErrorType.BAD_REFERENCE],
+                                    self._sheets_version)
+        return CellHandle(sheet.cell_contents, key, self._sheets_version)
+
+    @_journaled
     def del_sheet(self, sheet_name: str) -> None:
         # Delete the spreadsheet with the specified name.
         #
@@ -486,6 +1373,7 @@ class Workbook:
         with UpdateContext(self):
             index = self._get_sheet_index(sheet_name.lower())
             del self.spreadsheets[index]
+            self.__sheets_changed()
 
     def get_sheet_extent(self, sheet_name: str) -> Tuple[int, int]:
         # Return a tuple (num-cols, num-rows) indicating the current extent of
@@ -497,6 +1385,7 @@ class Workbook:
         # If the specified sheet name is not found, a KeyError is raised.
         return self._get_sheet(sheet_name).extent()
 
+    @_journaled
     def set_cell_contents(self, sheet_name: str, location: str,
                           contents: Optional[str]) -> None:
         # Set the contents of the specified cell on the specified sheet.
@@ -523,42 +1412,337 @@ class Workbook:
         with UpdateContext(self, updated=[reference]):
             self._get_sheet(sheet_name).set_cell_contents(location, contents)
 
-    def _recompute_all_values(self, updated: Optional[List[CellReference]]):
+    @_journaled
+    def set_cell_values(self, sheet_name: str, values: Dict[str, Any]) -> None:
+        # Set the values of several cells on the specified sheet at once,
+        # given as a dict from cell location to value, e.g.
+        # set_cell_values("Sheet1", {"A1": 12, "B1": "east", "C1": True}).
+        #
+        # Values may be Decimals, ints, floats, bools, strings or None. They
+        # are stored as the values of the cells without being formatted and
+        # parsed as text: numbers become Decimals (floats by their shortest
+        # representation), and strings are always string values, even if
+        # they look like a number or a formula. Leading and trailing
+        # whitespace is stripped from strings, as from contents, and None or
+        # a string that is empty after stripping empties a cell. The contents
+        # of such a cell are the text that would produce the same value
+        # through set_cell_contents().
+        #
+        # The cells are updated together, so dependent cells are recomputed
+        # and notification functions are called once.
+        #
+        # If the specified sheet name is not found, a KeyError is raised.
+        # If any cell location is invalid, a ValueError is raised, and if any
+        # value is of another type, a TypeError is raised. In either case no
+        # cell is changed.
+        sheet = self._get_sheet(sheet_name)
+        contents = {}
+        for location, value in values.items():
+            contents[location_to_key(location)] = LiteralValue.of(value)
+        updated = [(sheet_name.lower(), key_to_location(key)) for key in contents]
+        with UpdateContext(self, updated=updated):
+            sheet.set_cell_values(contents)
+
+    @_journaled
+    def set_region_contents(self, sheet_name: str, top_left: str,
+                            rows: List[List[Optional[str]]]) -> None:
+        # Set the contents of a block of cells on the specified sheet at once,
+        # given as a list of rows of contents, the first of which goes in the
+        # row of `top_left`, starting at its column.
+        #
+        # Each string is stored exactly as set_cell_contents() would store it:
+        # whitespace is stripped, an empty string or None empties the cell,
+        # text starting with "=" is a formula, and anything else is a literal
+        # number, boolean, error or string ("'" forces a string). The cells
+        # are updated together, so dependent cells are recomputed and
+        # notification functions are called once.
+        #
+        # If the specified sheet name is not found, a KeyError is raised.
+        # If `top_left` is invalid or the block does not fit on the sheet, a
+        # ValueError is raised and no cell is changed.
+        sheet = self._get_sheet(sheet_name)
+        (col, row) = location_to_coordinates(top_left)
+        width = max((len(values) for values in rows), default=0)
+        if width == 0:
+            return
+        # Raises a ValueError if the bottom right cell is off the sheet.
+        location_to_coordinates(coordinates_to_location((col + width - 1, row + len(rows) - 1)))
+
+        # Feeds repeat a lot of values, so each distinct literal is only
+        # classified once (up to a limit, so that unique values don't pile up).
+        literals: Dict[str, Any] = {}
+        contents: Dict[int, Optional[Union[LiteralValue, str]]] = {}
+        for (i, values) in enumerate(rows):
+            key = coordinates_to_key((col, row + i))
+            for text in values:
+                if text is not None:
+                    text = text.strip()
+                if not text:
+                    contents[key] = None
+                elif text[0] == '=':
+                    contents[key] = text
+                else:
+                    value = literals.get(text, literals)
+                    if value is literals:
+                        value = text_to_value(text)
+                        if len(literals) < _LITERAL_CACHE_SIZE:
+                            literals[text] = value
+                    contents[key] = LiteralValue(value, text)
+                key += CELL_KEY_BASE
+        updated = [(sheet_name.lower(), key_to_location(key)) for key in contents]
+        with UpdateContext(self, updated=updated):
+            sheet.set_cell_values(contents)
+
+    def import_csv(self, sheet_name: str, fp: TextIO, top_left: str = "A1",
+                   **fmtparams: Any) -> None:
+        # Read CSV rows from the text file or file-like object `fp` (opened
+        # with newline='') and store them with set_region_contents(), the
+        # first row starting at `top_left`. Keyword arguments are passed to
+        # csv.reader, e.g. delimiter='\t' for TSV. Empty fields empty their
+        # cells.
+        #
+        # Errors are those of set_region_contents(), plus the csv.Error of
+        # malformed input; in either case no cell is changed.
+        self.set_region_contents(sheet_name, top_left, list(csv.reader(fp, **fmtparams)))
+
+    def export_csv(self, sheet_name: str, fp: TextIO, start_location: str = "A1",
+                   end_location: Optional[str] = None, **fmtparams: Any) -> None:
+        # Write the values of the cells from `start_location` to
+        # `end_location` (the bottom right corner of the sheet's extent by
+        # default) to the text file or file-like object `fp` as CSV, one row
+        # at a time. Keyword arguments are passed to csv.writer.
+        #
+        # Values are written as text that import_csv() reads back as the same
+        # value: strings that would read as something else are prefixed with
+        # "'", and errors are written as their error literal. Empty cells are
+        # empty fields.
+        #
+        # If the specified sheet name is not found, a KeyError is raised.
+        # If either location is invalid, a ValueError is raised.
+        sheet = self._get_sheet(sheet_name)
+        start = location_to_coordinates(start_location)
+        if end_location is None:
+            end = sheet.extent()
+        else:
+            end = location_to_coordinates(end_location)
+            start, end = ((min(start[0], end[0]), min(start[1], end[1])),
+                          (max(start[0], end[0]), max(start[1], end[1])))
+        writer = csv.writer(fp, **fmtparams)
+        # Values are read a band of rows at a time, which is one scan of a
+        # sheet kept in a database.
+        for top in range(start[1], end[1] + 1, _CSV_BAND_ROWS):
+            bottom = min(top + _CSV_BAND_ROWS - 1, end[1])
+            for values in sheet.values_in((start[0], top), (end[0], bottom)):
+                writer.writerow(["" if value is None else value_to_text(value)
+                                 for value in values])
+
+    def _recompute_all_values(self, updated: Optional[List[CellReference]],
+                              prev: Optional[Dict[Tuple[str, int], Any]] = None
+                              ) -> List[CellReference]:
+        # Recompute the formulas that depend on the updated cells, or every
+        # formula if `updated` is None. Returns the cells that were
+        # recomputed or marked cyclical. If `prev` is given, the values those
+        # cells had before are added to it, keyed like snapshot_flat(), except
+        # for the updated cells themselves.
+
+        # Nothing depends on an update that changed no cells.
+        if updated is not None and not updated:
+            return []
+
+        # Literal cells never need to be recomputed; they are only part of the
+        # graph as the dependencies of formulas.
+        if updated is not None and self._database is not None:
+            g = self.__database_graph(updated)
+        else:
+            (g, ranges) = self.__dependency_graph(formulas_only=True)
+            g = g.transpose()
+            if updated is not None:
+                # A cell changing changes the ranges it is in, even if the cell
+                # itself is not part of the graph.
+                seeds = list(updated)
+                if ranges:
+                    for reference in updated:
+                        seeds.extend(ranges.containing(reference))
+                g = g.reachable(seeds)
+        self.__invalidate_criteria_indexes(g, updated)
+        (cyclical, g2, update_order) = self.__evaluation_order(g)
+        if prev is not None:
+            changed = set(updated or ())
+            prev.update(self._values_of(reference for reference in cyclical + update_order
+                                        if reference not in changed))
+
+        for reference in cyclical:
+            self.__mark_cyclical(*reference)
+
+        def dependencies(reference: CellReference) -> List[CellReference]:
+            # A cell depends on the cells of the ranges it refers to.
+            result = []
+            for u in g2.in_neighbors(reference):
+                if is_range_location(u[1]):
+                    result.extend(g2.in_neighbors(u))
+                else:
+                    result.append(u)
+            return result
+
+        # Cells that hold the same relative formula and do not depend on each
+        # other are grouped into runs that can be evaluated in one batch.
+        for run in plan_runs(update_order, dependencies, self.__template_of):
+            if len(run) >= MIN_RUN_LENGTH and self.__recompute_run(run):
+                continue
+            for reference in run:
+                sheet, loc = reference
+                try:
+                    if self._get_sheet(sheet).get_cell(loc):
+                        self._get_sheet(sheet).get_cell(loc).recompute_value()
+                except KeyError:
+                    pass
+        # if (reference == modified_cell):
+        #   break
+        return cyclical + update_order
+
+    def __database_graph(self, updated: List[CellReference]) -> Graph:
+        # Return the part of the (transposed) dependency graph reachable from
+        # the updated cells of a workbook kept in a database. The formulas
+        # that depend on a cell are looked up in the database's dependents
+        # tables, so only the affected cells are read. Cells changed by this
+        # update are not in those tables yet, but they are all reachable, and
+        # the edges come from the current formulas of the reachable cells.
+        sheets_by_id = {sheet.cell_contents.sheet_id: sheet for sheet in self.spreadsheets}
+        reachable: Set[CellReference] = set()
+        stack = list(updated)
+        while stack:
+            reference = stack.pop()
+            if reference in reachable:
+                continue
+            reachable.add(reference)
+            for (sheet_id, col, row) in self._database.dependents(
+                    reference[0], location_to_coordinates(reference[1])):
+                sheet = sheets_by_id.get(sheet_id)
+                if sheet is not None:
+                    stack.append((sheet.name().lower(), coordinates_to_location((col, row))))
 
-        # Compute all strongly connected components and mark all cells in a
-        # component with more than 1 vertex as cyclical.
-        g = self.build_dependency_graph().transpose()
-        if updated is not None:
-            g = g.reachable(updated)
+        result = {}
+        ranges = RangeIndex()
+        for reference in reachable:
+            sheet = self._sheets_by_name.get(reference[0])
+            cell = sheet.get_cell(reference[1]) if sheet is not None else None
+            if cell is None or cell.is_literal():
+                result[reference] = []
+                continue
+            result[reference] = [d for d in cell.dependencies()
+                                 if d in reachable or is_range_location(d[1])]
+            for d in result[reference]:
+                if is_range_location(d[1]):
+                    ranges.add(d)
+        covered: Dict[CellReference, List[CellReference]] = {}
+        for reference in reachable:
+            for r in ranges.containing(reference):
+                covered.setdefault(r, []).append(reference)
+        result.update(covered)
+        return Graph[CellReference](result).transpose()
+
+    def __evaluation_order(self, g: Graph) -> Tuple[List[CellReference], Graph,
+                                                    List[CellReference]]:
+        # Split the cells of the (transposed) dependency graph `g` into the
+        # cells that are part of a cycle and the rest, and return the cyclical
+        # cells, the graph of the other cells, and the formula cells among them
+        # in the order in which they have to be evaluated.
+        #
+        # Compute all strongly connected components; all cells in a component
+        # with more than 1 vertex are cyclical.
         components = g.strongly_connected_components()
         cyclical = []
         non_cyclical = []
         for component in components:
-            if len(component) == 1:
+            # A single cell is cyclical if it refers to itself, e.g. through a
+            # range that contains the cell.
+            if len(component) == 1 and component[0] not in g.out_neighbors(component[0]):
                 for reference in component:
                     non_cyclical.append(reference)
             else:
+                # Only cells are cyclical. A range in a cycle is kept, so that
+                # the cells that depend on it are still ordered after the
+                # other cells in the range.
                 for reference in component:
-                    cyclical.append(reference)
-
-        for reference in cyclical:
-            self.__mark_cyclical(*reference)
+                    if is_range_location(reference[1]):
+                        non_cyclical.append(reference)
+                    else:
+                        cyclical.append(reference)
 
         # compute a subgraph containing all vertices not part of a
-        # strong connected component. This subgraph is a DAG. Sort the
-        # vertices in topological order and recompute the value of all cells
-        # in topological order.
+        # strong connected component. Ranges only have edges from and to
+        # cells, so this subgraph is a DAG. Sort the vertices in topological
+        # order, which is the order to recompute the value of the cells in.
         g2 = g.subgraph(non_cyclical)
-        update_order = g2.topological_sort()
-        for reference in update_order:
-            sheet, loc = reference
+        update_order = [reference for reference in g2.topological_sort()
+                        if self.__is_formula(reference)]
+        return (cyclical, g2, update_order)
+
+    def __is_formula(self, reference: CellReference) -> bool:
+        # Return true if the cell holds a formula, and false if it is empty
+        # or holds a literal value.
+        sheet = self._sheets_by_name.get(reference[0])
+        if sheet is None:
+            return False
+        try:
+            cell = sheet.get_cell(reference[1])
+        except ValueError:
+            return False
+        return cell is not None and not cell.is_literal()
+
+    def __template_of(self, reference: CellReference) -> Optional[Hashable]:
+        (sheet, loc) = reference
+        try:
+            cell = self._get_sheet(sheet).get_cell(loc)
+        except (KeyError, ValueError):
+            return None
+        return cell.template() if cell is not None else None
+
+    def __recompute_run(self, run: List[CellReference]) -> bool:
+        # Evaluate a run of cells with the same formula template as one batch.
+        # Cells the batch cannot evaluate exactly are recomputed individually.
+        # Returns false if the template cannot be evaluated in batches.
+        sheet = self._get_sheet(run[0][0])
+        cells = [sheet.get_cell(loc) for (_, loc) in run]
+        program = compile_template(cells[0].template())
+        if program is None:
+            return False
+
+        def read_column(sheet_name, coords):
+            return self._get_sheet(sheet_name).values_at(coords)
+
+        origins = [location_to_coordinates(loc) for (_, loc) in run]
+        values = evaluate_run(program, run[0][0], origins, read_column)
+        for cell, value in zip(cells, values):
+            if value is None:
+                cell.recompute_value()
+            else:
+                cell.set_value(value)
+        return True
+
+    def __invalidate_criteria_indexes(self, g: Graph, updated: Optional[List[CellReference]]):
+        # Every cell whose value may change in this update is a vertex of `g`,
+        # except for updated cells that were emptied. Operations that update
+        # the whole workbook may also remove cells, so they drop all indexes.
+        if updated is None:
+            self._criteria_indexes.clear()
+            return
+        # Large updates are common when no index has been built yet.
+        if not self._criteria_indexes:
+            return
+        for (sheet, loc) in [*g.vertices(), *updated]:
             try:
-                if self._get_sheet(sheet).get_cell(loc):
-                    self._get_sheet(sheet).get_cell(loc).recompute_value()
-            except KeyError:
+                self._criteria_indexes.invalidate(sheet, location_to_coordinates(loc))
+            except ValueError:
                 pass
-        # if (reference == modified_cell):
-        #   break
+
+    def _get_range(self, sheet_name: str, start_location: str, end_location: str) -> CellRange:
+        # Return the range between the two corners on the given sheet. Raises a
+        # KeyError if the sheet does not exist, and a ValueError if either
+        # location is invalid.
+        self._get_sheet(sheet_name)
+        return CellRange(sheet_name, start_location, end_location,
+                         self.get_cell_value, self._criteria_indexes)
 
     def __mark_cyclical(self, sheet_name: str, location: str) -> None:
         self._get_sheet(sheet_name).mark_cyclical(location)
@@ -604,6 +1788,32 @@ class Workbook:
         # Decimal('1.000'); rather it would return Decimal('1').
         return self._get_sheet(sheet_name).get_cell_value(location)
 
+    def get_values(self, sheet_name: str, start_location: str, end_location: str,
+                   as_numpy: bool = False) -> Any:
+        # Return the values of the cells in the region between the two
+        # corners on the specified sheet, as a list of rows, each a list of
+        # the values of the cells in that row from left to right. The corners
+        # may be given in any order; the region includes both of them.
+        #
+        # If as_numpy is true, return a tuple (values, errors) of 2-D NumPy
+        # arrays instead. `values` is a float array if every cell in the
+        # region is empty, a number or an error, with NaN for empty cells and
+        # errors; otherwise it is an object array holding the cell values.
+        # `errors` is a boolean array that is true where the value is a
+        # CellError. NumPy must be installed to use as_numpy.
+        #
+        # If the specified sheet name is not found, a KeyError is raised.
+        # If either location is invalid, a ValueError is raised.
+        sheet = self._get_sheet(sheet_name)
+        (col1, row1) = location_to_coordinates(start_location)
+        (col2, row2) = location_to_coordinates(end_location)
+        rows = sheet.values_in((min(col1, col2), min(row1, row2)),
+                               (max(col1, col2), max(row1, row2)))
+        if not as_numpy:
+            return rows
+        return values_to_arrays(rows)
+
+    @_journaled
     def sort_region(self, sheet_name: str, start_location: str, end_location: str, sort_cols: List[int]):
         # Sort the specified region of a spreadsheet with a stable sort, using
         # the specified columns for the comparison.
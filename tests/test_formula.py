@@ -1,5 +1,7 @@
 import unittest
 from sheets.formula import *
+from sheets.compiler import formula_compile
+from sheets import Workbook, CellErrorType
 
 class TestFormula(unittest.TestCase):
     def test_formula_to_string_add(self):
@@ -44,4 +46,62 @@ class TestFormula(unittest.TestCase):
     def test_formula_rename_sheet_found(self):
         tree = formula_parse("='Sheet3'!A5+'Sheet 4'!A5+Sheet1!A5")
         str = formula_rename_sheet(tree, "Sheet1", "Sheet2")
-        self.assertEqual(str, "=Sheet3!A5+'Sheet 4'!A5+Sheet2!A5")
\ No newline at end of file
+        self.assertEqual(str, "=Sheet3!A5+'Sheet 4'!A5+Sheet2!A5")
+
+    def test_formula_to_string_cell_range(self):
+        tree = formula_parse("=SUM(A1:B2, 'Sheet 2'!$C$3:D4)")
+        str = formula_to_string(tree)
+        self.assertEqual(str, "=SUM(A1:B2,'Sheet 2'!$C$3:D4)")
+
+    def test_formula_rename_sheet_cell_range(self):
+        tree = formula_parse("=SUM(Sheet1!A1:B2)")
+        str = formula_rename_sheet(tree, "Sheet1", "Sheet 2")
+        self.assertEqual(str, "=SUM('Sheet 2'!A1:B2)")
+
+    def test_formula_translate(self):
+        tree = formula_parse("=a1+$B2*C$3-Sheet2!$D$4+SUM('Sheet 2'!A1:b2)")
+        (str, _) = formula_translate(tree, (1, 2))
+        self.assertEqual(str, "=B3+$B4*D$3-Sheet2!$D$4+SUM('Sheet 2'!B3:C4)")
+        (str, _) = formula_translate(tree, (0, -1))
+        self.assertEqual(str, "=#REF!+$B1*C$3-Sheet2!$D$4+SUM(#REF!)")
+
+    def test_reference_splicer(self):
+        formulas = ["=a1+$B2*C$3-Sheet2!$D$4", "=SUM('Sheet 2'!A1:b2)&\"x\"",
+                    "=IF(A1 > 0, -(B2), F())", "=ZZZZ9999+A1", "=1+2"]
+        for formula in formulas:
+            tree = formula_parse(formula)
+            splicer = ReferenceSplicer(tree)
+            for offset in [(0, 0), (1, 2), (-1, 0), (0, -1), (3, -2)]:
+                self.assertEqual(splicer.translated(offset),
+                                 formula_translate(tree, offset)[0])
+
+    def test_formula_compile_folds_constants(self):
+        tree = formula_compile(formula_parse('=2*3+A1'))
+        self.assertEqual(tree.children[0].data, 'value')
+        self.assertEqual(tree.children[2].data, 'bound_cell')
+        tree = formula_compile(formula_parse('=IF(TRUE, A1, B1)'))
+        self.assertEqual(tree.data, 'bound_cell')
+        tree = formula_compile(formula_parse('=CHOOSE(1+1, A1, B1)'))
+        self.assertEqual(tree.children, ('B1',))
+        tree = formula_compile(formula_parse('=INDIRECT("A" & "1")'))
+        self.assertEqual(tree.data, 'bound_call')
+
+    def test_folded_formulas_keep_values(self):
+        wb = Workbook()
+        wb.new_sheet("Sheet1")
+        wb.set_cell_contents("Sheet1", "A1", "1.50")
+        wb.set_cell_contents("Sheet1", "B1", '=("x"&"y")&A1')
+        self.assertEqual(wb.get_cell_value("Sheet1", "B1"), "xy1.5")
+        wb.set_cell_contents("Sheet1", "B2", "=IF(FALSE, A1)")
+        self.assertEqual(wb.get_cell_value("Sheet1", "B2"), False)
+        wb.set_cell_contents("Sheet1", "B3", "=IF(1/0, A1)")
+        self.assertEqual(wb.get_cell_value("Sheet1", "B3").get_type(),
+                         CellErrorType.DIVIDE_BY_ZERO)
+        wb.set_cell_contents("Sheet1", "B4", "=SUM(IF(TRUE, A1:A3))")
+        self.assertEqual(wb.get_cell_value("Sheet1", "B4").get_type(),
+                         CellErrorType.TYPE_ERROR)
+        # Cells in pruned branches are still dependencies.
+        wb.set_cell_contents("Sheet1", "B5", "=IF(TRUE, 1, B6)")
+        wb.set_cell_contents("Sheet1", "B6", "=B5")
+        self.assertEqual(wb.get_cell_value("Sheet1", "B5").get_type(),
+                         CellErrorType.CIRCULAR_REFERENCE)
@@ -39,5 +39,97 @@ class TestFunction(unittest.TestCase):
         # w.set_cell_contents("Sheet1", "D3", "=min(C3:A3)")
         # self.assertIsInstance(w.get_cell_value("Sheet1", "D3"), CellError)
 
+    def _region_workbook(self):
+        w = Workbook()
+        w.new_sheet("Sheet1")
+        rows = [("east", "10"), ("west", "5"), ("EAST", "2.5"), ("north", "x"), (None, "7")]
+        for i, (region, amount) in enumerate(rows, 1):
+            if region is not None:
+                w.set_cell_contents("Sheet1", f"B{i}", region)
+            w.set_cell_contents("Sheet1", f"C{i}", amount)
+        return w
+
+    def test_sumif(self):
+        w = self._region_workbook()
+        w.set_cell_contents("Sheet1", "D1", '=SUMIF(B1:B5, "east", C1:C5)')
+        self.assertEqual(w.get_cell_value("Sheet1", "D1"), decimal.Decimal("12.5"))
+        w.set_cell_contents("Sheet1", "D2", '=SUMIF(C1:C5, ">=5")')
+        self.assertEqual(w.get_cell_value("Sheet1", "D2"), decimal.Decimal(22))
+
+        # The index over B1:B5 is updated when cells in the range change.
+        w.set_cell_contents("Sheet1", "B2", "East")
+        self.assertEqual(w.get_cell_value("Sheet1", "D1"), decimal.Decimal("17.5"))
+        w.set_cell_contents("Sheet1", "C3", "=C1*2")
+        self.assertEqual(w.get_cell_value("Sheet1", "D1"), decimal.Decimal(35))
+        w.set_cell_contents("Sheet1", "B1", None)
+        self.assertEqual(w.get_cell_value("Sheet1", "D1"), decimal.Decimal(25))
+        w.move_cells("Sheet1", "B3", "B3", "F3")
+        self.assertEqual(w.get_cell_value("Sheet1", "D1"), decimal.Decimal(5))
+
+    def test_countif_averageif(self):
+        w = self._region_workbook()
+        w.set_cell_contents("Sheet1", "D1", '=COUNTIF(B1:B5, "<>east")')
+        self.assertEqual(w.get_cell_value("Sheet1", "D1"), 3)
+        w.set_cell_contents("Sheet1", "D2", '=COUNTIF(B1:B5, "")')
+        self.assertEqual(w.get_cell_value("Sheet1", "D2"), 1)
+        w.set_cell_contents("Sheet1", "D3", '=AVERAGEIF(B1:B5, "east", C1:C5)')
+        self.assertEqual(w.get_cell_value("Sheet1", "D3"), decimal.Decimal("6.25"))
+        w.set_cell_contents("Sheet1", "D4", '=AVERAGEIF(B1:B5, "south", C1:C5)')
+        self.assertEqual(w.get_cell_value("Sheet1", "D4").get_type(),
+                         CellErrorType.DIVIDE_BY_ZERO)
+
+    def test_sumifs(self):
+        w = self._region_workbook()
+        w.set_cell_contents("Sheet1", "D1", '=SUMIFS(C1:C5, B1:B5, "east", C1:C5, ">5")')
+        self.assertEqual(w.get_cell_value("Sheet1", "D1"), 10)
+        w.set_cell_contents("Sheet1", "C3", "20")
+        self.assertEqual(w.get_cell_value("Sheet1", "D1"), 30)
+
+    def test_conditional_aggregate_errors(self):
+        w = self._region_workbook()
+        w.set_cell_contents("Sheet1", "D1", '=SUMIF(B1:B5, "east", C1:C4)')
+        self.assertEqual(w.get_cell_value("Sheet1", "D1").get_type(), CellErrorType.TYPE_ERROR)
+        w.set_cell_contents("Sheet1", "D2", '=SUMIF(Sheet9!B1:B5, "east")')
+        self.assertEqual(w.get_cell_value("Sheet1", "D2").get_type(), CellErrorType.BAD_REFERENCE)
+        w.set_cell_contents("Sheet1", "D3", '=COUNTIF(B1:D5, "east")')
+        self.assertEqual(w.get_cell_value("Sheet1", "D3").get_type(),
+                         CellErrorType.CIRCULAR_REFERENCE)
+        w.set_cell_contents("Sheet1", "C1", "#DIV/0!")
+        self.assertEqual(w.get_cell_value("Sheet1", "D1").get_type(), CellErrorType.TYPE_ERROR)
+        w.set_cell_contents("Sheet1", "D4", '=SUMIF(B1:B5, "east", C1:C5)')
+        self.assertEqual(w.get_cell_value("Sheet1", "D4").get_type(),
+                         CellErrorType.DIVIDE_BY_ZERO)
+        w.set_cell_contents("Sheet1", "D5", '=A1:A5')
+        self.assertEqual(w.get_cell_value("Sheet1", "D5").get_type(), CellErrorType.TYPE_ERROR)
+
+    def test_sum_range(self):
+        w = self._region_workbook()
+        w.set_cell_contents("Sheet1", "D1", '=SUM(C1:C5, 1)')
+        self.assertEqual(w.get_cell_value("Sheet1", "D1"), decimal.Decimal("25.5"))
+        w.set_cell_contents("Sheet1", "D2", '=MAX(C1:C5)')
+        self.assertEqual(w.get_cell_value("Sheet1", "D2"), 10)
+        w.set_cell_contents("Sheet1", "D3", '=MIN(C1:C5, 3)')
+        self.assertEqual(w.get_cell_value("Sheet1", "D3"), decimal.Decimal("2.5"))
+        w.set_cell_contents("Sheet1", "D4", '=AVERAGE(C1:C2)')
+        self.assertEqual(w.get_cell_value("Sheet1", "D4"), decimal.Decimal("7.5"))
+
+    def test_bound_calls(self):
+        w = Workbook()
+        w.new_sheet("Sheet1")
+        w.set_cell_contents("Sheet1", "A1", "=NOSUCHFUNC(1)")
+        self.assertEqual(w.get_cell_value("Sheet1", "A1").get_type(), CellErrorType.BAD_NAME)
+        w.set_cell_contents("Sheet1", "A2", "=IF(TRUE, 1, 2, 3)")
+        self.assertEqual(w.get_cell_value("Sheet1", "A2").get_type(), CellErrorType.TYPE_ERROR)
+        w.set_cell_contents("Sheet1", "A3", "=NOT()")
+        self.assertEqual(w.get_cell_value("Sheet1", "A3").get_type(), CellErrorType.TYPE_ERROR)
+        w.set_cell_contents("Sheet1", "A4", "=IFERROR(1/0, \"bad\")")
+        self.assertEqual(w.get_cell_value("Sheet1", "A4"), "bad")
+        w.set_cell_contents("Sheet1", "A5", "=IFERROR(B1 + 2)")
+        self.assertEqual(w.get_cell_value("Sheet1", "A5"), 2)
+        w.set_cell_contents("Sheet1", "B1", "#REF!")
+        self.assertEqual(w.get_cell_value("Sheet1", "A5"), "")
+        w.set_cell_contents("Sheet1", "A6", "=IFERROR(INDIRECT(\"B1\"), 7)")
+        self.assertEqual(w.get_cell_value("Sheet1", "A6"), 7)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,3 +1,4 @@
+import decimal
 import unittest
 from sheets.utils import *
 
@@ -63,5 +64,27 @@ class TestUtils(unittest.TestCase):
         test = cell_range_to_list("C1:A5")
         self.assertEqual(test, ["A1","A2","A3","A4","A5","B1","B2","B3","B4","B5","C1","C2","C3","C4","C5"])
 
+    def test_cell_keys(self):
+        self.assertEqual(location_to_key("a1"), 10001)
+        self.assertEqual(location_to_key("ZZZZ9999"), 475254 * 10000 + 9999)
+        self.assertEqual(key_to_location(location_to_key("zz44")), "ZZ44")
+        self.assertEqual(key_to_coordinates(coordinates_to_key((3, 9999))), (3, 9999))
+        for location in ["A0", "A10000", "AAAAA1", "1A", "A1 ", ""]:
+            with self.assertRaises(ValueError):
+                location_to_key(location)
+
+    def test_strip_trailing_zeros(self):
+        for (text, expected) in [("1.50", "1.5"), ("2.00", "2"), ("100", "100"),
+                                 ("-0.000", "-0"), ("0.0000010", "0.000001"),
+                                 ("1E+3", "1E+3"), ("1.20E-7", "1.20E-7")]:
+            result = strip_trailing_zeros(decimal.Decimal(text))
+            self.assertEqual(str(result), expected)
+        # Results match stripping the text form of the number.
+        for text in ["1.0E+10", "12.3400", "0E-8", "7.000000001"]:
+            d = decimal.Decimal(text)
+            s = str(d)
+            s = s.rstrip('0').rstrip('.') if '.' in s else s
+            self.assertEqual(strip_trailing_zeros(d).as_tuple(), decimal.Decimal(s).as_tuple())
+
 if __name__ == '__main__':
     unittest.main()
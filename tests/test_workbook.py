@@ -1,13 +1,20 @@
 import decimal
 import io
+import json
+import os
+import sqlite3
+import tempfile
 from typing import Any,  List, Tuple
 import unittest
 from unittest.mock import patch
 from sheets import Workbook, CellError, CellErrorType
+from sheets.cell import Cell
+from sheets.cell_store import CellStore
 from sheets.graph import Graph
 
 
 from sheets.utils import coordinates_to_location
+from sheets.vectorize import np
 
 class TestWorkbook(unittest.TestCase):
 
@@ -185,6 +192,168 @@ class TestWorkbook(unittest.TestCase):
         self.assertEqual(len(g.vertices()), 3)
         self.assertSetEqual(set(g.out_neighbors(("sheet2","C3"))), set([("sheet1","A5"), ("sheet1","B6")]))
 
+    def test_range_dependencies(self):
+        w = Workbook()
+        w.new_sheet("Sheet1")
+        for r in range(1, 201):
+            w.set_cell_contents("Sheet1", f"A{r}", str(r))
+        for n in range(1, 51):
+            w.set_cell_contents("Sheet1", f"C{n}", f"=SUMIF(A1:A9999, {n})")
+
+        # A range is one vertex, with an edge from each formula using it and
+        # an edge to each cell in it, not an edge from every formula to every
+        # cell.
+        g = w.build_dependency_graph()
+        self.assertEqual(len(g.edges()), 50 + 200)
+        self.assertEqual(g.out_neighbors(("sheet1", "C7")), [("sheet1", "A1:A9999")])
+
+        # Cells inside the range still update the formulas.
+        w.set_cell_contents("Sheet1", "A3000", "7")
+        self.assertEqual(w.get_cell_value("Sheet1", "C7"), 14)
+        w.set_cell_contents("Sheet1", "A7", None)
+        self.assertEqual(w.get_cell_value("Sheet1", "C7"), 7)
+
+        # Formulas inside a range are evaluated before the range is used, and
+        # a range containing the formula that uses it is a cycle.
+        w.set_cell_contents("Sheet1", "D1", "=SUM(E1:E3)")
+        w.set_cell_contents("Sheet1", "E3", "=C7 * 2")
+        w.set_cell_contents("Sheet1", "E2", "=E3 + 1")
+        self.assertEqual(w.get_cell_value("Sheet1", "D1"), 29)
+        w.set_cell_contents("Sheet1", "A7", "7")
+        self.assertEqual(w.get_cell_value("Sheet1", "D1"), 57)
+        w.set_cell_contents("Sheet1", "E1", "=D1")
+        for location in ("D1", "E1"):
+            self.assertEqual(w.get_cell_value("Sheet1", location).get_type(),
+                             CellErrorType.CIRCULAR_REFERENCE)
+        self.assertEqual(w.get_cell_value("Sheet1", "E2"), 29)
+
+        # Copies of a formula with a growing range depend on the cells above.
+        w.new_sheet("Sheet2")
+        w.set_cell_contents("Sheet2", "A1", "1")
+        w.set_cell_contents("Sheet2", "B1", "=SUM(A$1:A1)")
+        for r in range(2, 11):
+            w.set_cell_contents("Sheet2", f"A{r}", f"=B{r - 1}")
+        w.copy_cells("Sheet2", "B1", "B1", "B2")
+        w.copy_cells("Sheet2", "B1", "B2", "B3")
+        w.copy_cells("Sheet2", "B1", "B4", "B5")
+        w.copy_cells("Sheet2", "B1", "B2", "B9")
+        self.assertEqual(w.get_cell_value("Sheet2", "B10"), 512)
+
+    def test_range_with_circular_formula(self):
+        w = Workbook()
+        w.new_sheet("Sheet1")
+        w.set_cell_contents("Sheet1", "B8", "=B2+A2")
+        w.set_cell_contents("Sheet1", "A8", "=SUMIF(A1:B8,\">1\")")
+        w.set_cell_contents("Sheet1", "B2", "1000")
+        w.set_cell_contents("Sheet1", "D4", "=SUMIF(A1:B8,\">1\")")
+        w.set_cell_contents("Sheet1", "A2", "0.1")
+
+        # A8 is in the range it refers to, but the other formulas using the
+        # range are still evaluated after the cells in it.
+        self.assertEqual(w.get_cell_value("Sheet1", "A8").get_type(),
+                         CellErrorType.CIRCULAR_REFERENCE)
+        self.assertEqual(w.get_cell_value("Sheet1", "D4"), decimal.Decimal("2000.1"))
+
+        fp = io.StringIO()
+        w.save_workbook(fp)
+        w2 = Workbook.load_workbook(io.StringIO(fp.getvalue()))
+        self.assertEqual(w2.get_cell_value("Sheet1", "D4"), decimal.Decimal("2000.1"))
+
+    def test_literal_cells_are_not_recomputed(self):
+        w = Workbook()
+        w.new_sheet("Sheet1")
+        w.set_cell_contents("Sheet1", "A1", "1.50")
+        w.set_cell_contents("Sheet1", "A2", "'=A1")
+        w.set_cell_contents("Sheet1", "A3", "=A1*2")
+        g = w.build_dependency_graph(formulas_only=True)
+        self.assertSetEqual(set(g.vertices()), {("sheet1", "A1"), ("sheet1", "A3")})
+
+        cell = w._get_sheet("Sheet1").get_cell("A1")
+        self.assertTrue(cell.is_literal())
+        self.assertFalse(w._get_sheet("Sheet1").get_cell("A3").is_literal())
+        with patch.object(Cell, "_recompute_formula") as recompute:
+            w.set_cell_contents("Sheet1", "A2", "text")
+            recompute.assert_not_called()
+        w.set_cell_contents("Sheet1", "A1", "TRUE")
+        self.assertEqual(w.get_cell_value("Sheet1", "A1"), True)
+        self.assertEqual(w.get_cell_value("Sheet1", "A2"), "text")
+        self.assertEqual(w.get_cell_value("Sheet1", "A3"), 2)
+
+    def test_set_cell_values(self):
+        w = Workbook()
+        w.new_sheet("Sheet1")
+        w.set_cell_contents("Sheet1", "D1", "=A1+B1+C1")
+        w.set_cell_contents("Sheet1", "E1", "old")
+        changed = []
+        w.notify_cells_changed(lambda wb, cells: changed.extend(cells))
+        w.set_cell_values("Sheet1", {"a1": 2, "B1": decimal.Decimal("1.50"),
+                                     "C1": 0.25, "A2": True, "B2": "=A1",
+                                     "C2": "12", "E1": None})
+        self.assertEqual(w.get_cell_value("Sheet1", "D1"), decimal.Decimal("3.75"))
+        self.assertEqual(w.get_cell_value("Sheet1", "B1"), decimal.Decimal("1.5"))
+        self.assertEqual(w.get_cell_value("Sheet1", "B2"), "=A1")
+        self.assertEqual(w.get_cell_value("Sheet1", "C2"), "12")
+        self.assertIsNone(w.get_cell_value("Sheet1", "E1"))
+        self.assertEqual(sorted(changed), sorted([
+            ("Sheet1", "A1"), ("Sheet1", "B1"), ("Sheet1", "C1"), ("Sheet1", "D1"),
+            ("Sheet1", "A2"), ("Sheet1", "B2"), ("Sheet1", "C2"), ("Sheet1", "E1")]))
+
+        # Contents are text that produces the same value.
+        for (location, contents) in [("A1", "2"), ("B1", "1.5"), ("C1", "0.25"),
+                                     ("A2", "TRUE"), ("B2", "'=A1"), ("C2", "'12")]:
+            self.assertEqual(w.get_cell_contents("Sheet1", location), contents)
+
+        with self.assertRaises(TypeError):
+            w.set_cell_values("Sheet1", {"A3": 1, "A4": [1]})
+        with self.assertRaises(ValueError):
+            w.set_cell_values("Sheet1", {"A3": 1, "A0": 1})
+        self.assertIsNone(w.get_cell_value("Sheet1", "A3"))
+
+        # Whitespace is stripped from strings as from contents, so the values
+        # survive saving and loading the workbook.
+        w.set_cell_values("Sheet1", {"A5": "x ", "B5": "\t", "C5": " 'y",
+                                     "D5": " 12 "})
+        self.assertEqual(w.get_cell_value("Sheet1", "A5"), "x")
+        self.assertIsNone(w.get_cell_value("Sheet1", "B5"))
+        fp = io.StringIO()
+        w.save_workbook(fp)
+        w2 = Workbook.load_workbook(io.StringIO(fp.getvalue()))
+        for location in ("A1", "B1", "C1", "A2", "B2", "C2", "A5", "B5", "C5", "D5"):
+            self.assertEqual(w2.get_cell_value("Sheet1", location),
+                             w.get_cell_value("Sheet1", location))
+            w2.set_cell_contents("Sheet1", location, w.get_cell_contents("Sheet1", location))
+            self.assertEqual(w2.get_cell_value("Sheet1", location),
+                             w.get_cell_value("Sheet1", location))
+
+    def test_get_values(self):
+        w = Workbook()
+        w.new_sheet("Sheet1")
+        w.set_cell_contents("Sheet1", "A1", "1")
+        w.set_cell_contents("Sheet1", "B1", "=A1/0")
+        w.set_cell_contents("Sheet1", "A2", "2.5")
+        w.set_cell_contents("Sheet1", "C2", "text")
+        self.assertEqual(w.get_values("Sheet1", "C2", "a1"), [
+            [1, w.get_cell_value("Sheet1", "B1"), None],
+            [decimal.Decimal("2.5"), None, "text"],
+        ])
+        self.assertEqual(w.get_values("Sheet1", "D5", "D5"), [[None]])
+        with self.assertRaises(KeyError):
+            w.get_values("Sheet2", "A1", "B2")
+        with self.assertRaises(ValueError):
+            w.get_values("Sheet1", "A1", "B0")
+
+        if np is None:
+            with self.assertRaises(ImportError):
+                w.get_values("Sheet1", "A1", "B2", as_numpy=True)
+            return
+        (values, errors) = w.get_values("Sheet1", "A1", "B2", as_numpy=True)
+        self.assertEqual(values.dtype, float)
+        self.assertEqual(values[1][0], 2.5)
+        self.assertEqual(errors.tolist(), [[False, True], [False, False]])
+        (values, errors) = w.get_values("Sheet1", "A1", "C2", as_numpy=True)
+        self.assertEqual(values.dtype, object)
+        self.assertEqual(values[1][2], "text")
+
     def test_build_cyclical_graph(self):
         w = Workbook()
         w.new_sheet("Sheet1")
@@ -404,6 +573,33 @@ class TestWorkbook(unittest.TestCase):
             with self.assertRaises(TypeError):
                 Workbook.load_workbook(fp)
 
+    def test_load_workbook_streaming(self):
+        text = ('{"sheets": [{"cell-contents": {"A1": "=B1*2", "B1": "4"}, "name": "Data"},'
+                ' {"name": "Other", "extra": [1, {"x": null}], "cell-contents": '
+                '{"C3": "=Data!A1+1", "D4": "\\"quoted\\" \\u00e9"}}], "version": 1.5}')
+        reads = []
+
+        class Chunked(io.StringIO):
+            def read(self, size=-1):
+                reads.append(size)
+                return super().read(size)
+
+        w = Workbook.load_workbook(Chunked(text))
+        self.assertTrue(all(size > 0 for size in reads))
+        self.assertEqual(w.list_sheets(), ["Data", "Other"])
+        self.assertEqual(w.get_cell_value("Data", "A1"), 8)
+        self.assertEqual(w.get_cell_value("Other", "C3"), 9)
+        self.assertEqual(w.get_cell_value("Other", "D4"), '"quoted" \u00e9')
+
+        for bad in ['{"sheets": [{"name": "S", "cell-contents": {}}', '{"sheets": []} []',
+                    '{"sheets": [{"name": "S", "cell-contents": {"A1": "1",}}]}']:
+            with self.assertRaises(json.JSONDecodeError):
+                Workbook.load_workbook(io.StringIO(bad))
+        with self.assertRaises(TypeError):
+            Workbook.load_workbook(io.StringIO('[{"sheets": []}]'))
+        with self.assertRaises(TypeError):
+            Workbook.load_workbook(io.StringIO('{"sheets": [["name"]]}'))
+
     def test_save_workbook(self):
         fp = io.StringIO("")
         w = Workbook()
@@ -413,6 +609,462 @@ class TestWorkbook(unittest.TestCase):
         w.save_workbook(fp)
         self.assertEqual(fp.getvalue(), '{"sheets": [{"name": "Sheet1", "cell-contents": {"B5": "5"}}, {"name": "Sheet2", "cell-contents": {}}]}')
 
+    def test_save_workbook_streaming(self):
+        w = Workbook()
+        w.new_sheet("Sheet1")
+        w.new_sheet("Data 2")
+        for (location, contents) in [("C2", "=A1 & \"é\""), ("A2", "'\\t"),
+                                     ("B1", "3"), ("A1", "\u2603")]:
+            w.set_cell_contents("Sheet1", location, contents)
+        for row in range(1, 200):
+            w.set_cell_contents("Sheet1", f"D{row}", "x" * 100)
+        expected = json.dumps({"sheets": [s.save_spreadsheet() for s in w.spreadsheets]})
+
+        writes = []
+
+        class Recording(io.StringIO):
+            def write(self, text):
+                writes.append(text)
+                return super().write(text)
+
+        fp = Recording()
+        w.save_workbook(fp)
+        self.assertEqual(fp.getvalue(), expected)
+        self.assertGreater(len(writes), 0)
+
+        fp = io.StringIO()
+        w.save_workbook(fp, sort_cells=True)
+        locations = list(json.loads(fp.getvalue())["sheets"][0]["cell-contents"])
+        self.assertEqual(locations[:5], ["A1", "B1", "D1", "A2", "C2"])
+        self.assertEqual(json.loads(fp.getvalue()), json.loads(expected))
+
+    def test_save_workbook_cached_values(self):
+        w = Workbook()
+        w.new_sheet("Data")
+        w.new_sheet("Calc")
+        w.set_cell_contents("Data", "A1", "4")
+        w.set_cell_contents("Data", "A2", "=A1 * 2")
+        w.set_cell_contents("Calc", "A1", "=Data!A2 + 1")
+        w.set_cell_contents("Calc", "A2", "=A1/0")
+        w.set_cell_contents("Calc", "A3", "=B3")
+        w.set_cell_contents("Calc", "B3", "=A3")
+        w.set_cell_contents("Calc", "A4", "=\"#REF!\" & \"\"")
+        w.set_cell_contents("Calc", "A5", "=Data!A1 > 3")
+        w.set_cell_contents("Calc", "A6", "=Z99")
+
+        fp = io.StringIO()
+        w.save_workbook(fp, cache_values=True)
+        saved = json.loads(fp.getvalue())
+        self.assertEqual(saved["sheets"][1]["cell-values"]["A2"], "#DIV/0!")
+        self.assertEqual(saved["sheets"][1]["cell-values"]["A6"], None)
+        order = saved["evaluation-order"]
+        self.assertLess(order.index([0, "A2"]), order.index([1, "A1"]))
+        self.assertNotIn([1, "A3"], order)
+
+        def values(w2):
+            return [w2.get_cell_value(s, f"{c}{r}") for s in ("Data", "Calc")
+                    for c in "AB" for r in range(1, 7)]
+
+        def same(a, b):
+            if isinstance(a, CellError):
+                return isinstance(b, CellError) and a.get_type() == b.get_type()
+            return a == b
+
+        w2 = Workbook.load_workbook(io.StringIO(fp.getvalue()))
+        for (a, b) in zip(values(w), values(w2)):
+            self.assertTrue(same(a, b), (a, b))
+        w2.set_cell_contents("Data", "A1", "5")
+        self.assertEqual(w2.get_cell_value("Calc", "A1"), decimal.Decimal(11))
+
+        # The cached values are trusted while the hash matches the contents.
+        saved["sheets"][1]["cell-values"]["A1"] = "100"
+        w2 = Workbook.load_workbook(io.StringIO(json.dumps(saved)))
+        self.assertEqual(w2.get_cell_value("Calc", "A1"), decimal.Decimal(100))
+
+        # Formulas without a cached value are evaluated in the stored order.
+        del saved["sheets"][0]["cell-values"]["A2"]
+        del saved["sheets"][1]["cell-values"]["A1"]
+        w2 = Workbook.load_workbook(io.StringIO(json.dumps(saved)))
+        self.assertEqual(w2.get_cell_value("Calc", "A1"), decimal.Decimal(9))
+
+        # Changed contents invalidate the cached values.
+        saved["sheets"][1]["cell-values"]["A1"] = "100"
+        saved["sheets"][0]["cell-contents"]["A1"] = "5"
+        w2 = Workbook.load_workbook(io.StringIO(json.dumps(saved)))
+        self.assertEqual(w2.get_cell_value("Calc", "A1"), decimal.Decimal(11))
+
+    def test_save_workbook_cached_values_refer_to_later_sheet(self):
+        w = Workbook()
+        w.new_sheet("A")
+        w.new_sheet("B")
+        w.set_cell_contents("A", "A1", "=B!A1+1")
+        w.set_cell_contents("A", "A2", "=B!A2*2")
+        w.set_cell_contents("B", "A1", "5")
+        w.set_cell_contents("B", "A2", "=A!A1")
+
+        fp = io.StringIO()
+        w.save_workbook(fp, cache_values=True)
+        w2 = Workbook.load_workbook(io.StringIO(fp.getvalue()))
+        self.assertEqual(w2.get_cell_value("A", "A1"), decimal.Decimal(6))
+        self.assertEqual(w2.get_cell_value("A", "A2"), decimal.Decimal(12))
+
+        # Formulas without a cached value are evaluated once every sheet
+        # they refer to is loaded.
+        saved = json.loads(fp.getvalue())
+        del saved["sheets"][0]["cell-values"]["A1"]
+        w2 = Workbook.load_workbook(io.StringIO(json.dumps(saved)))
+        self.assertEqual(w2.get_cell_value("A", "A1"), decimal.Decimal(6))
+        self.assertEqual(w2.get_cell_value("B", "A2"), decimal.Decimal(6))
+
+    def test_snapshot(self):
+        w = Workbook()
+        w.new_sheet("Data")
+        w.new_sheet("Calc")
+        w.set_cell_values("Data", {"A1": 1.5, "A2": 2, "A3": "text", "A4": True})
+        w.set_cell_contents("Calc", "A1", "=SUM(Data!A1:A2)")
+        w.set_cell_contents("Calc", "A2", "=A1/0")
+        w.set_cell_contents("Calc", "A3", "=B3")
+        w.set_cell_contents("Calc", "B3", "=A3")
+        w.set_cell_contents("Calc", "A4", "'007")
+        w.set_cell_contents("Calc", "A5", "=Data!A3 & \"é\"")
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "workbook.snapshot")
+            w.save_snapshot(path)
+            with patch.object(Cell, "_recompute_formula") as recompute:
+                w2 = Workbook.open_snapshot(path)
+                recompute.assert_not_called()
+
+            with open(path, "r+b") as fp:
+                fp.write(b"NOTASNAP")
+            with self.assertRaises(ValueError):
+                Workbook.open_snapshot(path)
+
+        self.assertEqual(w2.list_sheets(), ["Data", "Calc"])
+        for sheet in w.list_sheets():
+            for (location, _) in w._get_sheet(sheet).iter_cell_contents():
+                self.assertEqual(w2.get_cell_contents(sheet, location),
+                                 w.get_cell_contents(sheet, location))
+                self.assertEqual(str(w2.get_cell_value(sheet, location)),
+                                 str(w.get_cell_value(sheet, location)))
+        self.assertIs(w2.get_cell_value("Calc", "A3"), w.get_cell_value("Calc", "A3"))
+
+        # Restored formulas are evaluated when their dependencies change.
+        w2.set_cell_contents("Data", "A2", "4")
+        self.assertEqual(w2.get_cell_value("Calc", "A1"), decimal.Decimal("5.5"))
+        w2.set_cell_contents("Calc", "B3", "1")
+        self.assertEqual(w2.get_cell_value("Calc", "A3"), 1)
+
+    def test_open_lazy(self):
+        w = Workbook()
+        for name in ("Report", "Data", "Other", "Back"):
+            w.new_sheet(name)
+        w.set_cell_contents("Data", "A1", "2")
+        w.set_cell_contents("Data", "A2", "=Back!A1 * 10")
+        w.set_cell_contents("Report", "A1", "=SUM(Data!A1:A2)")
+        w.set_cell_contents("Report", "A2", "=A1 & \"é\"")
+        w.set_cell_contents("Other", "A1", "=Data!A1 + 1")
+        w.set_cell_contents("Back", "A1", "=Data!A1 + 1")
+        w.set_cell_contents("Back", "B1", "=1/0")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, name) for name in ("plain.json", "cached.json", "snap")]
+            with open(paths[0], "w", encoding="utf-8") as fp:
+                w.save_workbook(fp)
+            with open(paths[1], "w", encoding="utf-8") as fp:
+                w.save_workbook(fp, cache_values=True)
+            w.save_snapshot(paths[2])
+
+            for path in paths:
+                w2 = Workbook.open_lazy(path)
+                self.assertEqual(w2.list_sheets(), w.list_sheets())
+                self.assertEqual(w2.get_cell_value("Report", "A2"), "32é")
+                # Other was never used; Data and Back were pulled in by Report.
+                self.assertEqual(len(w2.spreadsheets[2].cell_contents), 0)
+                self.assertEqual(w2.get_cell_value("Data", "A2"), decimal.Decimal(30))
+                self.assertEqual(w2.get_cell_value("Back", "B1").get_type(),
+                                 CellErrorType.DIVIDE_BY_ZERO)
+
+                # Updates load the remaining sheets first.
+                w2.set_cell_contents("Data", "A1", "3")
+                self.assertEqual(w2.get_cell_value("Other", "A1"), decimal.Decimal(4))
+                self.assertEqual(w2.get_cell_value("Report", "A1"), decimal.Decimal(43))
+
+    def test_open_lazy_formula_before_its_range(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "workbook.json")
+            with open(path, "w", encoding="utf-8") as fp:
+                json.dump({"sheets": [{"name": "Sheet1", "cell-contents": {
+                    "C1": "=SUMIF(A1:A8,\">1\")",
+                    "C2": "=COUNTIF(Sheet2!A1:A2,\">1\")",
+                    "A8": "2.5"}},
+                    {"name": "Sheet2", "cell-contents": {
+                        "C1": "=SUMIF(Sheet1!A1:A8,\">1\",A1:A8)",
+                        "A1": "=Sheet1!C2 + 2",
+                        "A8": "4"}}]}, fp)
+
+            # The formulas are evaluated before the cells of their ranges are
+            # read from the file.
+            w = Workbook.open_lazy(path)
+            self.assertEqual(w.get_cell_value("Sheet1", "C1"), decimal.Decimal("2.5"))
+            self.assertEqual(w.get_cell_value("Sheet2", "C1"), decimal.Decimal(4))
+            w.set_cell_contents("Sheet1", "A8", "1")
+            self.assertEqual(w.get_cell_value("Sheet1", "C1"), 0)
+            self.assertEqual(w.get_cell_value("Sheet2", "C1"), 0)
+
+    def test_journal(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            snapshot = os.path.join(tmp, "book.snap")
+            journal = os.path.join(tmp, "book.journal")
+
+            w = Workbook.open_journaled(snapshot, journal, sync_every=3)
+            w.new_sheet()
+            w.set_cell_contents("Sheet1", "A1", "=B1 * 2")
+            w.set_cell_values("Sheet1", {"B1": decimal.Decimal("1.5"), "B2": True})
+            w.copy_sheet("Sheet1")
+            w.move_cells("Sheet1_1", "A1", "B2", "C3")
+            w.checkpoint()
+            w.rename_sheet("Sheet1", "Main")
+            w.move_sheet("Main", 1)
+            w.close_journal()
+            self.assertFalse(os.path.exists(journal + ".tmp"))
+
+            # A record that was only partly written is dropped.
+            with open(journal, "a", encoding="utf-8") as fp:
+                fp.write('["set_cell_contents",["Main","A9"')
+
+            w2 = Workbook.open_journaled(snapshot, journal)
+            self.assertEqual(w2.list_sheets(), ["Sheet1_1", "Main"])
+            for sheet in w.list_sheets():
+                for (location, _) in w._get_sheet(sheet).iter_cell_contents():
+                    self.assertEqual(w2.get_cell_contents(sheet, location),
+                                     w.get_cell_contents(sheet, location))
+                    self.assertEqual(w2.get_cell_value(sheet, location),
+                                     w.get_cell_value(sheet, location))
+            self.assertIsNone(w2.get_cell_contents("Main", "A9"))
+            w2.set_cell_contents("Main", "A9", "x")
+            w2.close_journal()
+
+            # A checkpoint that replaced the snapshot but did not start the
+            # journal over does not apply the journal twice.
+            w3 = Workbook.open_journaled(snapshot, journal, checkpoint_every=2)
+            with open(journal, "rb") as fp:
+                stale = fp.read()
+            w3.move_cells("Main", "A9", "A9", "A10")
+            w3.close_journal()
+            with open(journal, "wb") as fp:
+                fp.write(stale + b'["move_cells",["Main","A9","A9","A10"]]\n')
+            w4 = Workbook.open_journaled(snapshot, journal)
+            self.assertIsNone(w4.get_cell_contents("Main", "A9"))
+            self.assertEqual(w4.get_cell_contents("Main", "A10"), "x")
+            w4.close_journal()
+
+            with open(journal, "w", encoding="utf-8") as fp:
+                fp.write("not a journal\n")
+            with self.assertRaises(ValueError):
+                Workbook.open_journaled(snapshot, journal)
+
+    def test_open_database(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "book.db")
+            w = Workbook.open_database(path, cache_size=2)
+            w.new_sheet("Data")
+            w.new_sheet("Calc")
+            w.set_cell_values("Data", {f"A{row}": row for row in range(1, 11)})
+            w.set_cell_contents("Calc", "A1", "=SUM(Data!A1:A10)")
+            w.set_cell_contents("Calc", "B1", "=A1 / 0")
+            w.set_cell_contents("Calc", "C1", "=Data!A1 & \"x\"")
+            w.copy_cells("Calc", "A1", "C1", "A2")
+            w.move_cells("Data", "A9", "A10", "B1")
+            w.new_sheet("Scratch")
+            w.set_cell_contents("Scratch", "A1", "1")
+            w.del_sheet("Scratch")
+            w.rename_sheet("Data", "Input")
+            w.move_sheet("Calc", 0)
+            self.assertEqual(w.get_cell_value("Calc", "A1"), decimal.Decimal(36))
+            self.assertEqual(w.get_cell_contents("Calc", "A1"), "=SUM(Input!A1:A10)")
+            w.commit()
+            w.close_database()
+
+            w2 = Workbook.open_database(path, cache_size=2)
+            self.assertEqual(w2.list_sheets(), ["Calc", "Input"])
+            self.assertEqual(w2.get_cell_contents("Calc", "A2"), "=SUM(Input!A2:A11)")
+            self.assertEqual(w2.get_cell_value("Calc", "A1"), decimal.Decimal(36))
+            self.assertEqual(w2.get_cell_value("Calc", "B2").get_type(),
+                             CellErrorType.DIVIDE_BY_ZERO)
+            self.assertEqual(w2.get_cell_value("Calc", "C2"), "2x")
+            self.assertEqual(w2.get_values("Input", "A1", "B2"),
+                             [[decimal.Decimal(1), decimal.Decimal(9)],
+                              [decimal.Decimal(2), decimal.Decimal(10)]])
+            self.assertEqual(w2.get_sheet_extent("Input"), (2, 8))
+
+            w2.set_cell_contents("Input", "A1", "100")
+            self.assertEqual(w2.get_cell_value("Calc", "A1"), decimal.Decimal(135))
+            self.assertEqual(w2.get_cell_value("Calc", "C1"), "100x")
+            w2.close_database()
+
+            w3 = Workbook.open_database(path)
+            self.assertEqual(w3.get_cell_value("Calc", "A1"), decimal.Decimal(135))
+            w3.close_database()
+
+    def test_open_database_edits_read_affected_cells(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "book.db")
+            w = Workbook.open_database(path, cache_size=4)
+            w.new_sheet("Data")
+            w.set_cell_values("Data", {f"A{row}": row for row in range(1, 201)})
+            w.set_cell_contents("Data", "B1", "=SUM(A1:A200)")
+            w.set_cell_contents("Data", "C1", "=B1 * 2")
+            w.set_cell_contents("Data", "D1", "=A5")
+            w.commit()
+            w.close_database()
+
+            # Databases written before the dependents tables existed get them
+            # when they are opened.
+            conn = sqlite3.connect(path)
+            conn.execute("DELETE FROM cell_dependents")
+            conn.execute("DELETE FROM range_dependents")
+            conn.execute("PRAGMA user_version = 0")
+            conn.commit()
+            conn.close()
+
+            w = Workbook.open_database(path, cache_size=4)
+            changed = []
+            w.notify_cells_changed(lambda _, cells: changed.extend(cells))
+            # Editing a cell reads the cells that depend on it, not the sheet.
+            with patch.object(CellStore, "items", side_effect=AssertionError), \
+                    patch.object(CellStore, "__iter__", side_effect=AssertionError):
+                w.set_cell_contents("Data", "A5", "105")
+                w.set_cell_contents("Data", "E1", "=C1 + D1")
+                w.set_cell_values("Data", {"A6": None})
+            self.assertEqual(w.get_cell_value("Data", "C1"), decimal.Decimal(40388))
+            self.assertEqual(w.get_cell_value("Data", "E1"), decimal.Decimal(40493))
+            self.assertEqual(sorted(changed), [
+                ("Data", "A5"), ("Data", "A6"), ("Data", "B1"), ("Data", "B1"),
+                ("Data", "C1"), ("Data", "C1"), ("Data", "D1"), ("Data", "E1"), ("Data", "E1")])
+            w.close_database()
+
+    def test_save_incremental(self):
+        w = Workbook()
+        for name in ("Data", "Calc", "Notes"):
+            w.new_sheet(name)
+        w.set_cell_contents("Data", "A1", "2")
+        w.set_cell_contents("Calc", "A1", "=Data!A1 * 3")
+        w.set_cell_contents("Notes", "A1", "'hello")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "book")
+
+            def files():
+                return sorted(f for f in os.listdir(path) if f != "manifest.json")
+
+            w.save_incremental(path)
+            self.assertEqual(files(), ["sheet-1-0.json", "sheet-1-1.json", "sheet-1-2.json"])
+
+            # Only the changed sheet is written again.
+            w.set_cell_contents("Data", "A1", "5")
+            w.save_incremental(path)
+            self.assertEqual(files(), ["sheet-1-1.json", "sheet-1-2.json", "sheet-2-0.json"])
+
+            # Renaming a sheet changes the sheets that refer to it.
+            w.rename_sheet("Data", "Input")
+            w.del_sheet("Notes")
+            w.save_incremental(path)
+            self.assertEqual(files(), ["sheet-3-0.json", "sheet-3-1.json"])
+
+            w2 = Workbook.load_directory(path)
+            self.assertEqual(w2.list_sheets(), ["Input", "Calc"])
+            self.assertEqual(w2.get_cell_contents("Calc", "A1"), w.get_cell_contents("Calc", "A1"))
+            self.assertEqual(w2.get_cell_value("Calc", "A1"), decimal.Decimal(15))
+
+            w2.move_sheet("Calc", 0)
+            w2.set_cell_contents("Calc", "B1", "x")
+            w2.save_incremental(path)
+            self.assertEqual(files(), ["sheet-3-0.json", "sheet-4-0.json"])
+            self.assertEqual(Workbook.load_directory(path).list_sheets(), ["Calc", "Input"])
+
+            # Another workbook saving to the directory writes every sheet.
+            w.save_incremental(path)
+            self.assertEqual(files(), ["sheet-5-0.json", "sheet-5-1.json"])
+
+    def test_save_compressed(self):
+        w = Workbook()
+        w.new_sheet("Sheet1")
+        for row in range(1, 201):
+            w.set_cell_contents("Sheet1", f"A{row}", f"=B{row} + 1")
+            w.set_cell_contents("Sheet1", f"B{row}", str(row))
+        text = io.StringIO()
+        w.save_workbook(text, sort_cells=True)
+
+        for codec in ("gzip", "lzma", "zlib"):
+            fp = io.BytesIO()
+            w.save_compressed(fp, codec)
+            self.assertLess(len(fp.getvalue()), len(text.getvalue()) // 3)
+
+            # The codec is detected when loading.
+            fp.seek(0)
+            w2 = Workbook.load_compressed(fp)
+            self.assertEqual(w2.get_cell_value("Sheet1", "A200"), decimal.Decimal(201))
+            out = io.StringIO()
+            w2.save_workbook(out, sort_cells=True)
+            self.assertEqual(out.getvalue(), text.getvalue())
+
+            with self.assertRaises(EOFError):
+                Workbook.load_compressed(io.BytesIO(fp.getvalue()[:-20]), codec)
+
+        with self.assertRaises(ValueError):
+            Workbook.load_compressed(io.BytesIO(text.getvalue().encode()))
+        with self.assertRaises(ValueError):
+            w.save_compressed(io.BytesIO(), "bz2")
+
+    def test_import_export_csv(self):
+        w = Workbook()
+        w.new_sheet("Sheet1")
+        w.set_cell_contents("Sheet1", "E1", "=SUM(B2:B4)")
+        w.set_cell_contents("Sheet1", "C4", "old")
+        feed = ("name,amount,flag\n"
+                "east, 12.50 ,true\n"
+                "west,#DIV/0!,'007\n"
+                "north,=B2*2,\n")
+        w.import_csv("Sheet1", io.StringIO(feed, newline=""), "A1")
+
+        for location in ("A2", "B2", "C2", "B3", "C3", "C4"):
+            contents = w.get_cell_contents("Sheet1", location)
+            w2 = Workbook()
+            w2.new_sheet("Sheet1")
+            w2.set_cell_contents("Sheet1", location, contents)
+            self.assertEqual(repr(w.get_cell_value("Sheet1", location)),
+                             repr(w2.get_cell_value("Sheet1", location)))
+        self.assertEqual(w.get_cell_value("Sheet1", "C3"), "007")
+        self.assertIsNone(w.get_cell_contents("Sheet1", "C4"))
+        self.assertEqual(w.get_cell_value("Sheet1", "B4"), decimal.Decimal(25))
+        self.assertIsInstance(w.get_cell_value("Sheet1", "E1"), CellError)
+
+        out = io.StringIO()
+        w.export_csv("Sheet1", out)
+        self.assertEqual(out.getvalue().splitlines(), [
+            "name,amount,flag,,#DIV/0!",
+            "east,12.5,TRUE,,",
+            "west,#DIV/0!,'007,,",
+            "north,25,,,",
+        ])
+        out = io.StringIO()
+        w.export_csv("Sheet1", out, "C3", "B2", delimiter="\t")
+        self.assertEqual(out.getvalue(), "12.5\tTRUE\r\n#DIV/0!\t'007\r\n")
+
+        # Exported values read back as the same values.
+        w.new_sheet("Copy")
+        out = io.StringIO()
+        w.export_csv("Sheet1", out)
+        w.import_csv("Copy", io.StringIO(out.getvalue(), newline=""))
+        for location in ("A1", "B2", "C2", "B3", "C3", "B4"):
+            self.assertEqual(repr(w.get_cell_value("Copy", location)),
+                             repr(w.get_cell_value("Sheet1", location)))
+
+        with self.assertRaises(ValueError):
+            w.import_csv("Sheet1", io.StringIO("1,2\n3,4\n"), "ZZZZ9999")
+        self.assertEqual(w.get_cell_value("Sheet1", "A1"), "name")
+
     def test_notify_cells_changed(self):
         queue = []
         def on_update(workbook, changed: List[Tuple[Any, Any]]):
@@ -701,6 +1353,227 @@ class TestWorkbook(unittest.TestCase):
         assert isinstance(wb.get_cell_value('Sheet1', 'A2'), bool)
         assert not wb.get_cell_value('Sheet1', 'A2')
 
+    def test_shared_dependency_is_not_cyclical(self):
+        w = Workbook()
+        w.new_sheet("Sheet1")
+        w.set_cell_contents("Sheet1", "A1", "10")
+        w.set_cell_contents("Sheet1", "A2", "=A1*2")
+        w.set_cell_contents("Sheet1", "A3", "=A1+A2")
+        w.set_cell_contents("Sheet1", "A1", "1")
+        self.assertEqual(w.get_cell_value("Sheet1", "A3"), 3)
+
+    def test_filled_down_column(self):
+        # A long run of the same relative formula is evaluated as a batch;
+        # the values must match per-cell evaluation, including error rows.
+        w = Workbook()
+        w.new_sheet("Sheet1")
+        w.set_cell_contents("Sheet1", "D1", "0.5")
+        for r in range(1, 21):
+            w.set_cell_contents("Sheet1", f"A{r}", str(r))
+            w.set_cell_contents("Sheet1", f"B{r}", f"{r}.25")
+            w.set_cell_contents("Sheet1", f"C{r}", f"=A{r}*B{r}-$D$1+A{r}")
+        w.set_cell_contents("Sheet1", "A5", "hello")
+        w.set_cell_contents("Sheet1", "B7", "=1/0")
+        w.set_cell_contents("Sheet1", "B9", None)
+        for r in range(1, 21):
+            value = w.get_cell_value("Sheet1", f"C{r}")
+            if r == 5:
+                self.assertEqual(value.get_type(), CellErrorType.TYPE_ERROR)
+            elif r == 7:
+                self.assertEqual(value.get_type(), CellErrorType.DIVIDE_BY_ZERO)
+            elif r == 9:
+                self.assertEqual(value, decimal.Decimal("8.5"))
+            else:
+                expected = r * (decimal.Decimal(r) + decimal.Decimal("0.25")) \
+                    - decimal.Decimal("0.5") + r
+                self.assertEqual(value, expected)
+
+        w.set_cell_contents("Sheet1", "D1", "1")
+        self.assertEqual(w.get_cell_value("Sheet1", "C2"), decimal.Decimal("5.5"))
+        self.assertEqual(str(w.get_cell_value("Sheet1", "C4")), "20")
+
+    def test_filled_down_column_with_different_scales(self):
+        # Values with very different exponents cannot be brought to a common
+        # scale in int64 (or within the Decimal precision), even when the
+        # values themselves are 0; those runs are evaluated cell by cell.
+        def check():
+            w = Workbook()
+            w.new_sheet("Sheet1")
+            for r in range(1, 21):
+                w.set_cell_contents("Sheet1", f"A{r}", "0")
+                w.set_cell_contents("Sheet1", f"B{r}", "1E-30")
+                w.set_cell_contents("Sheet1", f"C{r}", f"=A{r}+B{r}")
+            w.copy_cells("Sheet1", "C1", "C20", "D1")
+            self.assertEqual(w.get_cell_value("Sheet1", "D20"), decimal.Decimal("2E-30"))
+            for r in range(1, 21):
+                w.set_cell_contents("Sheet1", f"A{r}", "0.001")
+            # Adding a sheet recomputes column C as one run.
+            w.new_sheet("Sheet2")
+            self.assertEqual(w.get_cell_value("Sheet1", "C3"),
+                             decimal.Decimal("0.001000000000000000000000000001"))
+
+        check()
+        if np is not None:
+            with patch("sheets.vectorize.np", None):
+                check()
+
+    def test_references_follow_sheet_changes(self):
+        w = Workbook()
+        w.new_sheet("Sheet1")
+        w.set_cell_contents("Sheet1", "A1", "=Data!B2+A2")
+        w.set_cell_contents("Sheet1", "A2", "1")
+        self.assertEqual(w.get_cell_value("Sheet1", "A1").get_type(),
+                         CellErrorType.BAD_REFERENCE)
+
+        w.new_sheet("Data")
+        w.set_cell_contents("Data", "B2", "5")
+        self.assertEqual(w.get_cell_value("Sheet1", "A1"), 6)
+
+        w.rename_sheet("Data", "Other")
+        w.new_sheet("Data")
+        self.assertEqual(w.get_cell_contents("Sheet1", "A1"), "=Other!B2+A2")
+        w.set_cell_contents("Other", "B2", "7")
+        self.assertEqual(w.get_cell_value("Sheet1", "A1"), 8)
+
+        w.del_sheet("Other")
+        self.assertEqual(w.get_cell_value("Sheet1", "A1").get_type(),
+                         CellErrorType.BAD_REFERENCE)
+
+    def test_error_values_are_shared(self):
+        w = Workbook()
+        w.new_sheet("Sheet1")
+        w.new_sheet("Data")
+        w.set_cell_contents("Sheet1", "A1", "=Data!A1")
+        for r in range(2, 6):
+            w.set_cell_contents("Sheet1", f"A{r}", f"=A{r - 1}+1")
+        w.set_cell_contents("Sheet1", "B1", "#ref!")
+        w.del_sheet("Data")
+        errors = {id(w.get_cell_value("Sheet1", f"A{r}")) for r in range(1, 6)}
+        self.assertEqual(len(errors), 1)
+        self.assertIs(w.get_cell_value("Sheet1", "A1"), w.get_cell_value("Sheet1", "B1"))
+        self.assertEqual(w.get_cell_value("Sheet1", "A5").get_type(),
+                         CellErrorType.BAD_REFERENCE)
+
+        # Shared errors cannot be changed through one of the cells.
+        with self.assertRaises(AttributeError):
+            w.get_cell_value("Sheet1", "A1")._detail = "changed"
+        self.assertEqual(w.get_cell_value("Sheet1", "A2").get_detail(),
+                         "A cell-reference is invalid in some way.")
+
+    def test_error_values_compare_by_content(self):
+        self.assertEqual(CellError(CellErrorType.TYPE_ERROR, "x"),
+                         CellError(CellErrorType.TYPE_ERROR, "x"))
+        self.assertNotEqual(CellError(CellErrorType.TYPE_ERROR, "x"),
+                            CellError(CellErrorType.TYPE_ERROR, "y"))
+        self.assertNotEqual(CellError(CellErrorType.TYPE_ERROR, "x"),
+                            CellError(CellErrorType.BAD_NAME, "x"))
+
+        # Errors with their own detail are not reported as changed when they
+        # are computed again.
+        changed = []
+        w = Workbook()
+        w.notify_cells_changed(lambda _, cells: changed.extend(cells))
+        w.new_sheet("Sheet1")
+        w.set_cell_contents("Sheet1", "A1", "=AVERAGEIF(B1:B3, 1)")
+        self.assertEqual(w.get_cell_value("Sheet1", "A1").get_type(),
+                         CellErrorType.DIVIDE_BY_ZERO)
+        changed.clear()
+        w.new_sheet("Sheet2")
+        self.assertEqual(changed, [])
+
+    def test_copy_shared_formula(self):
+        w = Workbook()
+        w.new_sheet("Sheet1")
+        w.new_sheet("Other")
+        for r in range(1, 10):
+            w.set_cell_contents("Sheet1", f"A{r}", str(r))
+        w.set_cell_contents("Other", "A1", "100")
+        w.set_cell_contents("Sheet1", "B1", "=A1*2+$A$1+Other!$A1+SUM(A1:A2)")
+        w.copy_cells("Sheet1", "B1", "B1", "B2")
+        w.copy_cells("Sheet1", "B1", "B2", "B3")
+        w.copy_cells("Sheet1", "B1", "B4", "B5")
+        self.assertEqual(w.get_cell_contents("Sheet1", "B8"),
+                         "=A8*2+$A$1+Other!$A8+SUM(A8:A9)")
+        self.assertEqual(w.get_cell_value("Sheet1", "B8"), 34)
+        self.assertEqual(w.get_cell_value("Sheet1", "B1"), 106)
+
+        # Copies of the formula depend on the cells they refer to.
+        w.set_cell_contents("Sheet1", "A9", "0")
+        self.assertEqual(w.get_cell_value("Sheet1", "B8"), 25)
+        w.set_cell_contents("Other", "A8", "1")
+        self.assertEqual(w.get_cell_value("Sheet1", "B8"), 26)
+
+        w.rename_sheet("Other", "Renamed")
+        self.assertEqual(w.get_cell_contents("Sheet1", "B8"),
+                         "=A8*2+$A$1+Renamed!$A8+SUM(A8:A9)")
+        self.assertEqual(w.get_cell_value("Sheet1", "B8"), 26)
+
+        # References moved off the sheet become #REF! and stay #REF!.
+        w.set_cell_contents("Sheet1", "C5", "=A4+B$1")
+        w.copy_cells("Sheet1", "C5", "C5", "D1")
+        self.assertEqual(w.get_cell_contents("Sheet1", "D1"), "=#REF!+C$1")
+        w.copy_cells("Sheet1", "D1", "D1", "D5")
+        self.assertEqual(w.get_cell_contents("Sheet1", "D5"), "=#REF!+C$1")
+        self.assertEqual(w.get_cell_value("Sheet1", "D5").get_type(),
+                         CellErrorType.BAD_REFERENCE)
+
+    def test_copy_shared_formula_then_rename_sheet(self):
+        w = Workbook()
+        w.new_sheet("Sheet1")
+        w.set_cell_contents("Sheet1", "A1", "=A6+1")
+        w.copy_cells("Sheet1", "A1", "A1", "B1")
+        w.rename_sheet("Sheet1", "Renamed")
+
+        # The copy still depends on the cell it refers to on the renamed sheet.
+        w.set_cell_contents("Renamed", "B6", "5")
+        self.assertEqual(w.get_cell_value("Renamed", "B1"), 6)
+        w.set_cell_contents("Renamed", "A6", "2")
+        self.assertEqual(w.get_cell_value("Renamed", "A1"), 3)
+
+    def test_fill(self):
+        queue = []
+        def on_update(workbook, changed: List[Tuple[Any, Any]]):
+            queue.append(changed)
+        w = Workbook()
+        w.new_sheet("Sheet1")
+        for r in range(1, 101):
+            w.set_cell_contents("Sheet1", f"A{r}", str(r))
+        w.set_cell_contents("Sheet1", "B1", "=A1*2+$A$1")
+        w.notify_cells_changed(on_update)
+
+        w.fill("Sheet1", "B1", "B2:b100", "down")
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(len(queue[0]), 99)
+        self.assertEqual(w.get_cell_contents("Sheet1", "B100"), "=A100*2+$A$1")
+        self.assertEqual(w.get_cell_value("Sheet1", "B100"), 201)
+        w.set_cell_contents("Sheet1", "A1", "3")
+        self.assertEqual(w.get_cell_value("Sheet1", "B50"), 103)
+
+        w.fill("Sheet1", "B3", "C3:E3", "right")
+        self.assertEqual(w.get_cell_contents("Sheet1", "E3"), "=D3*2+$A$1")
+        self.assertEqual(w.get_cell_value("Sheet1", "E3"), 93)
+
+        w.fill("Sheet1", "B3", "B1", "up")
+        self.assertEqual(w.get_cell_contents("Sheet1", "B1"), "=A1*2+$A$1")
+        w.set_cell_contents("Sheet1", "B5", "=A2+1")
+        w.fill("Sheet1", "B5", "B3:B4", "up")
+        self.assertEqual(w.get_cell_contents("Sheet1", "B3"), "=#REF!+1")
+        self.assertEqual(w.get_cell_contents("Sheet1", "B4"), "=A1+1")
+
+        with self.assertRaises(ValueError):
+            w.fill("Sheet1", "B1", "C2:C10", "down")
+        with self.assertRaises(ValueError):
+            w.fill("Sheet1", "B5", "B2:B10", "down")
+        with self.assertRaises(ValueError):
+            w.fill("Sheet1", "B1", "B2:B10", "sideways")
+        with self.assertRaises(KeyError):
+            w.fill("Sheet2", "B1", "B2:B10", "down")
+
+        # Filling from an empty cell empties the target range.
+        w.fill("Sheet1", "F1", "F2:F100", "down")
+        w.fill("Sheet1", "B101", "B1:B100", "up")
+        self.assertEqual(w.get_sheet_extent("Sheet1"), (5, 100))
+
 """
     def test_error_order_priority(self):
         w=Workbook()